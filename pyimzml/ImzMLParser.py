@@ -14,21 +14,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from array import array
 from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import copy
+from hashlib import sha1
+import io
+from io import BytesIO
+import mmap
+import os
 import sys
 import re
+import threading
+import weakref
+import zipfile
 from pathlib import Path
 
 from warnings import warn
 import numpy as np
 
+from pyimzml.compression import NoCompression, compression_from_param_group
 from pyimzml.metadata import Metadata, SpectrumData
 from pyimzml.ontology.ontology import convert_cv_param
 
 PRECISION_DICT = {"32-bit float": 'f', "64-bit float": 'd', "32-bit integer": 'i', "64-bit integer": 'l'}
 SIZE_DICT = {'f': 4, 'd': 8, 'i': 4, 'l': 8}
 INFER_IBD_FROM_IMZML = object()
+INDEX_CACHE_VERSION = 4
+MIN_INDEX_CHUNK_SIZE = 2**24
 XMLNS_PREFIX = "{http://psi.hupo.org/ms/mzml}"
+# serializes seek and read on files that cannot be read with os.pread
+_SEEK_LOCK = threading.Lock()
+# index arrays of PortableSpectrumReader that share_memory moves into shared memory
+_SHARED_INDEX_FIELDS = ['coordinates', 'mzOffsets', 'mzLengths', 'intensityOffsets', 'intensityLengths',
+                        'mobilityOffsets', 'mobilityLengths', 'mzEncodedLengths', 'intensityEncodedLengths',
+                        'mobilityEncodedLengths']
 
 param_group_elname = "referenceableParamGroup"
 data_processing_elname = "dataProcessing"
@@ -36,7 +57,7 @@ instrument_confid_elname = "instrumentConfiguration"
 
 
 def choose_iterparse(parse_lib=None):
-    if parse_lib == 'ElementTree':
+    if parse_lib in ('ElementTree', 'fast'):
         from xml.etree.ElementTree import iterparse
     elif parse_lib == 'lxml':
         from lxml.etree import iterparse
@@ -45,6 +66,157 @@ def choose_iterparse(parse_lib=None):
     return iterparse
 
 
+_SPECTRUM_START_RE = re.compile(rb'<spectrum[\s>]')
+# Matches either the start of a <spectrum>, a referenceableParamGroupRef (group 2: ref) or one of the cvParams needed
+# for the index (group 4: accession number). The mzML schema puts the referenceableParamGroupRef of a
+# <binaryDataArray> before its cvParams, so the last seen ref tells which array an offset or length belongs to.
+# Attribute values may be enclosed in either double or single quotes.
+_INDEX_TOKEN_RE = re.compile(
+    rb'<spectrum[\s>]'
+    rb'|<referenceableParamGroupRef\s[^>]*?ref\s*=\s*(["\'])(.*?)\1'
+    rb'|<cvParam\s[^>]*?accession\s*=\s*(["\'])IMS:(100010[234]|100005[012])\3[^>]*>'
+)
+_VALUE_RE = re.compile(rb'\svalue\s*=\s*(["\'])(.*?)\1')
+_UUID_RE = re.compile(rb'<cvParam\s[^>]*?accession\s*=\s*(["\'])IMS:1000080\1[^>]*>')
+
+
+@contextmanager
+def _open_imzml_buffer(source):
+    """
+    Yields the content of an .imzML file as an object supporting find() and regular expressions,
+    memory-mapping it if possible.
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+    else:
+        yield source.read()
+
+
+def _scan_spectrum_index(buf, start, end, array_refs):
+    """
+    Extracts the external offsets, array lengths and coordinates of all <spectrum> elements between the byte
+    positions start and end of an .imzML buffer, without building any XML elements.
+
+    :param buf:
+        bytes-like object or mmap holding the .imzML file
+    :param array_refs:
+        ids of the referenceableParamGroups of the binary data arrays to extract, e.g. [mz group id, intensity group
+        id]
+    :return:
+        (offsets, lengths, encoded_lengths, coordinates) where offsets, lengths and encoded_lengths hold one
+        array('q') per entry of array_refs and coordinates is a flat array('q') of (x, y, z) triples. Missing
+        encoded lengths are stored as -1, as they are only needed for compressed arrays
+    """
+    columns = dict((ref.encode('utf-8'), i) for i, ref in enumerate(array_refs))
+    offsets = [array('q') for _ in array_refs]
+    lengths = [array('q') for _ in array_refs]
+    encoded_lengths = [array('q') for _ in array_refs]
+    coordinates = array('q')
+
+    def append_spectrum(spectrum_offsets, spectrum_lengths, spectrum_encoded_lengths, xyz):
+        if None in spectrum_offsets or None in spectrum_lengths or None in xyz:
+            raise ValueError("Spectrum %d is missing an external offset, array length or position"
+                             % (len(coordinates) // 3))
+        for column in range(len(array_refs)):
+            offsets[column].append(spectrum_offsets[column])
+            lengths[column].append(spectrum_lengths[column])
+            encoded_lengths[column].append(spectrum_encoded_lengths[column])
+        coordinates.extend(xyz)
+
+    spectrum_offsets = spectrum_lengths = spectrum_encoded_lengths = xyz = column = None
+    for match in _INDEX_TOKEN_RE.finditer(buf, start, end):
+        ref, accession = match.group(2), match.group(4)
+        if ref is None and accession is None:
+            if spectrum_offsets is not None:
+                append_spectrum(spectrum_offsets, spectrum_lengths, spectrum_encoded_lengths, xyz)
+            spectrum_offsets = [None] * len(array_refs)
+            spectrum_lengths = [None] * len(array_refs)
+            spectrum_encoded_lengths = [-1] * len(array_refs)
+            xyz = [None, None, 1]
+            column = None
+        elif ref is not None:
+            column = columns.get(ref)
+        elif spectrum_offsets is not None:
+            value = _VALUE_RE.search(match.group(0))
+            if value is None:
+                raise ValueError("cvParam IMS:%s has no value" % accession.decode('ascii'))
+            value = int(value.group(2))
+            if accession == b'1000102':
+                if column is not None:
+                    spectrum_offsets[column] = value
+            elif accession == b'1000103':
+                if column is not None:
+                    spectrum_lengths[column] = value
+            elif accession == b'1000104':
+                if column is not None:
+                    spectrum_encoded_lengths[column] = value
+            else:
+                xyz[int(accession[-1:])] = value
+    if spectrum_offsets is not None:
+        append_spectrum(spectrum_offsets, spectrum_lengths, spectrum_encoded_lengths, xyz)
+    return offsets, lengths, encoded_lengths, coordinates
+
+
+def _read_uuid(buf):
+    """
+    Returns the universally unique identifier (IMS:1000080) from the <fileDescription> of an .imzML buffer, or an
+    empty string if there is none.
+    """
+    end = buf.find(b'<spectrumList')
+    match = _UUID_RE.search(buf, 0, end if end != -1 else len(buf))
+    value = _VALUE_RE.search(match.group(0)) if match is not None else None
+    return value.group(2).decode('utf-8') if value is not None else ''
+
+
+def _scan_spectrum_index_file(path, start, end, array_refs):
+    with _open_imzml_buffer(path) as buf:
+        return _scan_spectrum_index(buf, start, end, array_refs)
+
+
+def _split_spectrum_ranges(buf, start, end, n_chunks):
+    """
+    Splits the byte range [start, end) of an .imzML buffer into at most n_chunks consecutive ranges that each begin
+    at a <spectrum> element (except the first one), so that they can be scanned independently.
+    Chunks are never made smaller than MIN_INDEX_CHUNK_SIZE bytes.
+    """
+    n_chunks = max(1, min(n_chunks, (end - start) // MIN_INDEX_CHUNK_SIZE))
+    bounds = [start]
+    for k in range(1, n_chunks):
+        match = _SPECTRUM_START_RE.search(buf, max(bounds[-1] + 1, start + (end - start) * k // n_chunks), end)
+        if match is None:
+            break
+        bounds.append(match.start())
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _tostring(elem):
+    if type(elem).__module__.startswith('lxml'):
+        from lxml.etree import tostring
+    else:
+        from xml.etree.ElementTree import tostring
+    return tostring(elem)
+
+
+def _index_cache_path(imzml_path, index_cache):
+    imzml_path = Path(imzml_path)
+    if index_cache is True:
+        return str(imzml_path.with_name(imzml_path.name + '.idx'))
+    # files with the same name from different directories may share a cache directory
+    path_hash = sha1(str(imzml_path.resolve()).encode('utf-8')).hexdigest()[:12]
+    return str(Path(index_cache) / ('%s.%s.idx' % (imzml_path.name, path_hash)))
+
+
+def _is_compressed(compression):
+    return compression is not None and not isinstance(compression, NoCompression)
+
+
+def _get_encoded_length(elem):
+    encoded_length = _get_cv_param(elem, 'IMS:1000104')
+    return int(encoded_length) if encoded_length is not None else -1
+
+
 def _get_cv_param(elem, accession, deep=False, convert=False):
     base = './/' if deep else ''
     node = elem.find('%s%scvParam[@accession="%s"]' % (base, XMLNS_PREFIX, accession))
@@ -61,9 +233,18 @@ class ImzMLParser:
 
     Iteratively reads the .imzML file into memory while pruning the per-spectrum metadata (everything in
     <spectrumList> elements) during initialization. Returns a spectrum upon calling getspectrum(i). The binary file
-    is read in every call of getspectrum(i). Use enumerate(parser.coordinates) to get all coordinates with their
-    respective index. Coordinates are always 3-dimensional. If the third spatial dimension is not present in
-    the data, it will be set to zero.
+    is read in every call of getspectrum(i), unless use_mmap=True is given, in which case it is memory-mapped once
+    and getspectrum(i) returns read-only views into the mapping. Reads use positional I/O (os.pread), which does not
+    move a shared file position, so getspectrum and getspectra can be called from several threads at once.
+    Use enumerate(parser.coordinates) to get all coordinates with their respective index. Coordinates are always
+    3-dimensional. If the third spatial dimension is not present in the data, it will be set to one.
+
+    The spectrum index (mzOffsets, intensityOffsets, mzLengths, intensityLengths and their mobility counterparts)
+    is stored as NumPy arrays of int64 offsets and uint32 lengths, and parser.coordinates is an (N, 3) int32 array.
+
+    Binary data arrays that are compressed (see pyimzml.compression) are detected from their referenceableParamGroups
+    and decompressed when read. For those arrays the encoded lengths in bytes are kept in mzEncodedLengths,
+    intensityEncodedLengths and mobilityEncodedLengths, which are None for uncompressed arrays.
 
     The global metadata fields in the imzML file are stored in parser.metadata.
     Spectrum-specific metadata fields are not stored by default due to avoid memory issues,
@@ -77,6 +258,9 @@ class ImzMLParser:
             ibd_file=INFER_IBD_FROM_IMZML,
             include_spectra_metadata=None,
             include_mobility=False,
+            use_mmap=False,
+            index_cache=None,
+            index_processes=None,
     ):
         """
         Opens the two files corresponding to the file name, reads the entire .imzML
@@ -86,7 +270,10 @@ class ImzMLParser:
             name of the XML file. Must end with .imzML. Binary data file must be named equally but ending with .ibd
             Alternatively an open file or Buffer Protocol object can be supplied, if ibd_file is also supplied
         :param parse_lib:
-            XML-parsing library to use: 'ElementTree' or 'lxml', the later will be used if argument not provided
+            XML-parsing library to use: 'ElementTree', 'lxml' or 'fast'. ElementTree will be used if argument not
+            provided. 'fast' parses the header with ElementTree, but extracts the offsets, lengths and coordinates
+            of the spectra by scanning the raw bytes, which is much faster for large files. It falls back to
+            ElementTree if include_spectra_metadata is given.
         :param ibd_file:
             File or Buffer Protocol object for the .ibd file. Leave blank to infer it from the imzml filename.
             Set to None if no data from the .ibd file is needed (getspectrum calls will not work)
@@ -103,6 +290,22 @@ class ImzMLParser:
             bool: True or False
             Whether imzML schema should include trapped ion mobility spectrometry data. Units/metadata based
             on Bruker TIMS data.
+        :param use_mmap:
+            bool: True or False
+            Whether to memory-map the .ibd file once instead of seeking and reading it on every getspectrum call.
+            If True, getspectrum returns read-only NumPy views into the mapping instead of freshly allocated arrays.
+            File-like objects that cannot be mapped (e.g. gzip.GzipFile) are read as without use_mmap.
+        :param index_cache:
+            None, True, or a directory path.
+            If given, the spectrum index (offsets, lengths, coordinates, precisions, polarity) and the header XML
+            are stored in a binary sidecar file after the first parse, and later parsers of the same file load it
+            instead of reading the whole .imzML again. If True, the sidecar is written next to the .imzML file as
+            ``<name>.imzML.idx``, otherwise it is written into the given directory.
+            The sidecar is keyed on the size, modification time and universally unique identifier (IMS:1000080)
+            of the .imzML file and on include_mobility, and is silently rebuilt if it does not match. It is only used if filename is a path and include_spectra_metadata is None.
+        :param index_processes:
+            None or int. Only used with parse_lib='fast' if filename is a path. If greater than 1, the <spectrumList>
+            is split into chunks at <spectrum> boundaries which are scanned in a pool of this many processes.
         """
         # Whether to include ion mobility data.
         self.include_mobility = include_mobility
@@ -115,12 +318,16 @@ class ImzMLParser:
         # maps each number format character to its amount of bytes used
         self.sizeDict = dict(SIZE_DICT)
         self.filename = filename
-        self.mzOffsets = []
-        self.intensityOffsets = []
-        self.mzLengths = []
-        self.intensityLengths = []
-        # list of all (x,y,z) coordinates as tuples.
-        self.coordinates = []
+        # The index is accumulated in compact typed arrays while parsing and converted to NumPy arrays afterwards:
+        # int64 offsets, uint32 lengths and an (N, 3) int32 array of all (x,y,z) coordinates.
+        self.mzOffsets = array('q')
+        self.intensityOffsets = array('q')
+        self.mzLengths = array('q')
+        self.intensityLengths = array('q')
+        self.coordinates = array('q')
+        # only allocated for compressed arrays, see __process_metadata
+        self.mzEncodedLengths = self.intensityEncodedLengths = None
+        self.mzCompression = self.intensityCompression = NoCompression()
         self.root = None
         self.metadata = None
         self.polarity = None
@@ -132,8 +339,10 @@ class ImzMLParser:
                 k: [] for k in include_spectra_metadata
             }
         if self.include_mobility == True:
-            self.mobilityOffsets = []
-            self.mobilityLengths = []
+            self.mobilityOffsets = array('q')
+            self.mobilityLengths = array('q')
+            self.mobilityEncodedLengths = None
+            self.mobilityCompression = NoCompression()
 
         if self.include_mobility == True:
             self.mzGroupId = self.intGroupId = self.mobGroupId = self.mzPrecision = self.intensityPrecision = self.mobilityPrecision = None
@@ -141,18 +350,35 @@ class ImzMLParser:
             self.mzGroupId = self.intGroupId = self.mzPrecision = self.intensityPrecision = None
 
         self.iterparse = choose_iterparse(parse_lib)
-        self.__iter_read_spectrum_meta(include_spectra_metadata)
+        cache_path = None
+        if index_cache and include_spectra_metadata is None and isinstance(filename, (str, Path)):
+            cache_path = _index_cache_path(filename, index_cache)
+        if cache_path is None or not self.__load_index_cache(cache_path):
+            if parse_lib == 'fast' and include_spectra_metadata is None:
+                self.__fast_read_spectrum_meta(index_processes)
+            else:
+                self.__iter_read_spectrum_meta(self.filename, include_spectra_metadata)
+            self.__fix_offsets()
+            if cache_path is not None:
+                self.__save_index_cache(cache_path)
         if ibd_file is INFER_IBD_FROM_IMZML:
             # name of the binary file
             ibd_filename = self._infer_bin_filename(self.filename)
             self.m = open(ibd_filename, "rb")
         else:
             self.m = ibd_file
+        self._ibd_mmap = None
+        if use_mmap and self.m is not None:
+            self._ibd_mmap = _map_ibd(self.m)
+
+        # All spectra of continuous data share one m/z array, which is then only read once
+        self.continuous = _is_continuous(self.mzOffsets, self.mzLengths)
+        self._mz_array_cache = None
 
         # Dict for basic imzML metadata other than those required for reading
         # spectra. See method __readimzmlmeta()
         self.imzmldict = self.__readimzmlmeta()
-        self.imzmldict['max count of pixels z'] = np.asarray(self.coordinates)[:,2].max()
+        self.imzmldict['max count of pixels z'] = self.coordinates[:, 2].max()
 
     @staticmethod
     def _infer_bin_filename(imzml_path):
@@ -167,13 +393,15 @@ class ImzMLParser:
 
     # system method for use of 'with ... as'
     def __exit__(self, exc_t, exc_v, trace):
+        # arrays returned in mmap mode keep the mapping alive on their own
+        self._ibd_mmap = None
         if self.m is not None:
             self.m.close()
 
-    def __iter_read_spectrum_meta(self, include_spectra_metadata):
+    def __iter_read_spectrum_meta(self, source, include_spectra_metadata):
         """
         This method should only be called by __init__. Reads the data formats, coordinates and offsets from
-        the .imzML file and initializes the respective attributes. While traversing the XML tree, the per-spectrum
+        the .imzML source and initializes the respective attributes. While traversing the XML tree, the per-spectrum
         metadata is pruned, i.e. the <spectrumList> element(s) are left behind empty.
 
         Supported accession values for the number formats: "MS:1000521", "MS:1000523", "IMS:1000141" or
@@ -181,7 +409,7 @@ class ImzMLParser:
         """
         mz_group = int_group = None
         slist = None
-        elem_iterator = self.iterparse(self.filename, events=("start", "end"))
+        elem_iterator = self.iterparse(source, events=("start", "end"))
 
         if sys.version_info > (3,):
             _, self.root = next(elem_iterator)
@@ -200,25 +428,143 @@ class ImzMLParser:
                     self.__read_polarity(elem)
                     is_first_spectrum = False
                 slist.remove(elem)
-        self.__fix_offsets()
+
+    def __fast_read_spectrum_meta(self, processes=None):
+        """
+        This method should only be called by __init__. Does the same as __iter_read_spectrum_meta, but only runs
+        the XML parser over the header and the first spectrum. The offsets, lengths and coordinates of all other
+        spectra are picked out of the raw bytes by _scan_spectrum_index, optionally in a pool of processes.
+        """
+        with _open_imzml_buffer(self.filename) as buf:
+            list_start = buf.find(b'<spectrumList')
+            list_end = buf.rfind(b'</spectrumList>')
+            first_spectrum = _SPECTRUM_START_RE.search(buf, list_start + 1) if list_start != -1 else None
+            if first_spectrum is None or list_end == -1:
+                # nothing to scan, e.g. an empty <spectrumList/>
+                self.__iter_read_spectrum_meta(BytesIO(buf[:]), None)
+                return
+            first_end = buf.find(b'</spectrum>', first_spectrum.start()) + len(b'</spectrum>')
+            self.__iter_read_spectrum_meta(BytesIO(buf[:first_end] + buf[list_end:]), None)
+
+            array_refs = [self.mzGroupId, self.intGroupId]
+            if self.include_mobility == True:
+                array_refs.append(self.mobGroupId)
+            ranges = [(first_end, list_end)]
+            if processes is not None and processes > 1 and isinstance(self.filename, (str, Path)):
+                ranges = _split_spectrum_ranges(buf, first_end, list_end, processes * 4)
+            if len(ranges) == 1:
+                results = [_scan_spectrum_index(buf, first_end, list_end, array_refs)]
+
+        if len(ranges) > 1:
+            starts, ends = zip(*ranges)
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(_scan_spectrum_index_file, [str(self.filename)] * len(ranges),
+                                            starts, ends, [array_refs] * len(ranges)))
+
+        for offsets, lengths, encoded_lengths, coordinates in results:
+            self.mzOffsets.extend(offsets[0])
+            self.mzLengths.extend(lengths[0])
+            self.intensityOffsets.extend(offsets[1])
+            self.intensityLengths.extend(lengths[1])
+            if self.mzEncodedLengths is not None:
+                self.mzEncodedLengths.extend(encoded_lengths[0])
+            if self.intensityEncodedLengths is not None:
+                self.intensityEncodedLengths.extend(encoded_lengths[1])
+            if self.include_mobility == True:
+                self.mobilityOffsets.extend(offsets[2])
+                self.mobilityLengths.extend(lengths[2])
+                if self.mobilityEncodedLengths is not None:
+                    self.mobilityEncodedLengths.extend(encoded_lengths[2])
+            self.coordinates.extend(coordinates)
 
     def __fix_offsets(self):
-        # clean up the mess after morons who use signed 32-bit where unsigned 64-bit is appropriate
-        def fix(array):
-            fixed = []
-            delta = 0
-            prev_value = float('nan')
-            for value in array:
-                if value < 0 and prev_value >= 0:
-                    delta += 2**32
-                fixed.append(value + delta)
-                prev_value = value
-            return fixed
-
-        self.mzOffsets = fix(self.mzOffsets)
-        self.intensityOffsets = fix(self.intensityOffsets)
+        """
+        Converts the index accumulated while parsing into NumPy arrays and repairs wrapped-around offsets.
+        """
+        self.mzOffsets = _fix_offsets(self.mzOffsets)
+        self.intensityOffsets = _fix_offsets(self.intensityOffsets)
+        self.mzLengths = np.asarray(self.mzLengths, dtype=np.uint32)
+        self.intensityLengths = np.asarray(self.intensityLengths, dtype=np.uint32)
+        self.coordinates = np.asarray(self.coordinates, dtype=np.int32).reshape(-1, 3)
         if self.include_mobility == True:
-            self.mobilityOffsets = fix(self.mobilityOffsets)
+            self.mobilityOffsets = _fix_offsets(self.mobilityOffsets)
+            self.mobilityLengths = np.asarray(self.mobilityLengths, dtype=np.uint32)
+        # encoded lengths are int64, as missing ones are stored as -1
+        for name in ('mzEncodedLengths', 'intensityEncodedLengths', 'mobilityEncodedLengths'):
+            if getattr(self, name, None) is not None:
+                setattr(self, name, np.asarray(getattr(self, name), dtype=np.int64))
+
+    def __index_fields(self):
+        fields = ['coordinates', 'mzOffsets', 'mzLengths', 'intensityOffsets', 'intensityLengths']
+        if self.include_mobility == True:
+            fields += ['mobilityOffsets', 'mobilityLengths']
+        fields += [name for name in ('mzEncodedLengths', 'intensityEncodedLengths', 'mobilityEncodedLengths')
+                   if getattr(self, name, None) is not None]
+        return fields
+
+    def __index_cache_key(self):
+        """
+        :return:
+            (size, mtime, include_mobility), uuid of the .imzML file. The UUID tells regenerated files apart when
+            their size and mtime are unchanged, e.g. on filesystems with a coarse mtime resolution
+        """
+        stat = os.stat(self.filename)
+        with _open_imzml_buffer(self.filename) as buf:
+            uuid = _read_uuid(buf)
+        return (stat.st_size, stat.st_mtime_ns, bool(self.include_mobility)), uuid
+
+    def __load_index_cache(self, cache_path):
+        """
+        Restores the spectrum index from the sidecar file at cache_path. The header XML is parsed again to
+        rebuild self.root and self.metadata, which is cheap since it contains no spectra.
+
+        :return: True if the sidecar was valid and has been loaded, otherwise False
+        """
+        key, uuid = self.__index_cache_key()
+        try:
+            with np.load(cache_path, allow_pickle=False) as npz:
+                if npz['version'] != INDEX_CACHE_VERSION or tuple(npz['key'].tolist()) != key \
+                        or str(npz['uuid']) != uuid:
+                    return False
+                header = npz['header'].tobytes()
+                polarity = str(npz['polarity']) or None
+                index = {name: npz[name] for name in npz.files if name.startswith('index_')}
+        except (OSError, EOFError, ValueError, KeyError, TypeError, AttributeError, zipfile.BadZipFile):
+            return False
+
+        elem_iterator = self.iterparse(BytesIO(header), events=("start", "end"))
+        _, self.root = next(elem_iterator)
+        for event, elem in elem_iterator:
+            pass
+        self.__process_metadata()
+        try:
+            index = {name: index['index_' + name] for name in self.__index_fields()}
+        except KeyError:
+            return False
+        self.polarity = polarity
+        for name, values in index.items():
+            setattr(self, name, values)
+        return True
+
+    def __save_index_cache(self, cache_path):
+        key, uuid = self.__index_cache_key()
+        cache = {
+            'version': np.array(INDEX_CACHE_VERSION),
+            'key': np.array(key, dtype=np.int64),
+            'uuid': np.array(uuid),
+            'header': np.frombuffer(_tostring(self.root), dtype=np.uint8),
+            'polarity': np.array(self.polarity or ''),
+        }
+        cache.update(('index_' + name, np.asarray(getattr(self, name))) for name in self.__index_fields())
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **cache)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            warn('Could not write index cache "%s": %s' % (cache_path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     def __process_metadata(self):
         if self.metadata is None:
@@ -226,17 +572,20 @@ class ImzMLParser:
             for param_id, param_group in self.metadata.referenceable_param_groups.items():
                 if 'm/z array' in param_group.param_by_name:
                     self.mzGroupId = param_id
+                    self.mzCompression = compression_from_param_group(param_group)
                     for name, dtype in self.precisionDict.items():
                         if name in param_group.param_by_name:
                             self.mzPrecision = dtype
                 if 'intensity array' in param_group.param_by_name:
                     self.intGroupId = param_id
+                    self.intensityCompression = compression_from_param_group(param_group)
                     for name, dtype in self.precisionDict.items():
                         if name in param_group.param_by_name:
                             self.intensityPrecision = dtype
                 if self.include_mobility == True:
                     if 'mean inverse reduced ion mobility array' in param_group.param_by_name:
                         self.mobGroupId = param_id
+                        self.mobilityCompression = compression_from_param_group(param_group)
                         for name, dtype in self.precisionDict.items():
                             if name in param_group.param_by_name:
                                 self.mobilityPrecision = dtype
@@ -247,6 +596,12 @@ class ImzMLParser:
             if self.include_mobility == True:
                 if not hasattr(self, 'mobilityPrecision'):
                     raise RuntimeError("Could not determine mobility precision")
+            if _is_compressed(self.mzCompression):
+                self.mzEncodedLengths = array('q')
+            if _is_compressed(self.intensityCompression):
+                self.intensityEncodedLengths = array('q')
+            if self.include_mobility == True and _is_compressed(self.mobilityCompression):
+                self.mobilityEncodedLengths = array('q')
 
     def __process_spectrum(self, elem, include_spectra_metadata):
         arrlistelem = elem.find('%sbinaryDataArrayList' % self.sl)
@@ -267,17 +622,23 @@ class ImzMLParser:
         self.mzLengths.append(int(_get_cv_param(mz_group, 'IMS:1000103')))
         self.intensityOffsets.append(int(_get_cv_param(int_group, 'IMS:1000102')))
         self.intensityLengths.append(int(_get_cv_param(int_group, 'IMS:1000103')))
+        if self.mzEncodedLengths is not None:
+            self.mzEncodedLengths.append(_get_encoded_length(mz_group))
+        if self.intensityEncodedLengths is not None:
+            self.intensityEncodedLengths.append(_get_encoded_length(int_group))
         if self.include_mobility == True:
             self.mobilityOffsets.append(int(_get_cv_param(mob_group, 'IMS:1000102')))
             self.mobilityLengths.append(int(_get_cv_param(mob_group, 'IMS:1000103')))
+            if self.mobilityEncodedLengths is not None:
+                self.mobilityEncodedLengths.append(_get_encoded_length(mob_group))
         scan_elem = elem.find('%sscanList/%sscan' % (self.sl, self.sl))
         x = _get_cv_param(scan_elem, 'IMS:1000050')
         y = _get_cv_param(scan_elem, 'IMS:1000051')
         z = _get_cv_param(scan_elem, 'IMS:1000052')
         if z is not None:
-            self.coordinates.append((int(x), int(y), int(z)))
+            self.coordinates.extend((int(x), int(y), int(z)))
         else:
-            self.coordinates.append((int(x), int(y), 1))
+            self.coordinates.extend((int(x), int(y), 1))
 
         if include_spectra_metadata == 'full':
             self.spectrum_full_metadata.append(
@@ -400,17 +761,25 @@ class ImzMLParser:
         mobility_array: numpy.ndarray
             Sequence of mobility values corresponding to mz_array. Only returned if
             self.include_mobility == True.
+
+        If the parser was created with use_mmap=True, the arrays are read-only views into the mapped .ibd file.
+        For continuous data (see self.continuous), the m/z array is read only once and the same read-only array is
+        returned for every spectrum.
         """
-        if self.include_mobility == True:
-            mz_bytes, intensity_bytes, mobility_bytes = self.get_spectrum_as_string(index)
-        elif self.include_mobility == False:
-            mz_bytes, intensity_bytes = self.get_spectrum_as_string(index)
+        if self.continuous:
+            mz_array = self._shared_mz_array()
+        else:
+            mz_array = self._read_array(self.mzOffsets[index], self.mzLengths[index], self.mzPrecision,
+                                        self.mzCompression, _encoded_length(self.mzEncodedLengths, index))
+        intensity_array = self._read_array(self.intensityOffsets[index], self.intensityLengths[index],
+                                           self.intensityPrecision, self.intensityCompression,
+                                           _encoded_length(self.intensityEncodedLengths, index))
         # TODO: Last pixel/frame seems to have incorrect byte sizes? unsure if pyimzML issue or TIMSCONVERT issue
-        mz_array = np.frombuffer(mz_bytes, dtype=self.mzPrecision)
-        intensity_array = np.frombuffer(intensity_bytes, dtype=self.intensityPrecision)
         if len(mz_array) == len(intensity_array):
             if self.include_mobility == True:
-                mobility_array = np.frombuffer(mobility_bytes, dtype=self.mobilityPrecision)
+                mobility_array = self._read_array(self.mobilityOffsets[index], self.mobilityLengths[index],
+                                                  self.mobilityPrecision, self.mobilityCompression,
+                                                  _encoded_length(self.mobilityEncodedLengths, index))
                 return mz_array, intensity_array, mobility_array
             elif self.include_mobility == False:
                 return mz_array, intensity_array
@@ -421,11 +790,328 @@ class ImzMLParser:
             elif self.include_mobility == False:
                 return np.zeros(1), np.zeros(1)
 
+    def getspectra(self, indices, max_gap=2**16):
+        """
+        Reads the spectra at the specified indices from the .ibd file with as few reads as possible.
+
+        The byte ranges of all requested arrays are sorted by their position in the .ibd file, and ranges that
+        overlap or are less than max_gap bytes apart are merged into one sequential read. This avoids most of the
+        seeks that calling getspectrum for every index would do, which dominate on network file systems.
+
+        :param indices:
+            sequence of indices of the desired spectra in the .imzML file
+        :param max_gap:
+            ranges that are at most this many bytes apart are read together, including the bytes between them
+
+        :return:
+            list with one tuple per index, in the same order as indices, as they would be returned by getspectrum
+        """
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if self._ibd_mmap is not None:
+            # there are no reads to save
+            return [self.getspectrum(i) for i in indices]
+
+        columns = self.__array_columns()
+        if self.continuous:
+            columns = columns[1:]
+        arrays = _read_coalesced(self._read_bytes, columns, indices, max_gap)
+        if self.continuous:
+            arrays.insert(0, [self._shared_mz_array()] * len(indices))
+
+        spectra = []
+        for index, spectrum in zip(indices, zip(*arrays)):
+            if len(spectrum[0]) != len(spectrum[1]):
+                warn("Spectrum %d has different length for m/z and intensity arrays" % index)
+                spectrum = tuple(np.zeros(1) for _ in spectrum)
+            spectra.append(spectrum)
+        return spectra
+
+    def map_spectra(self, func, indices=None, processes=None, chunksize=None):
+        """
+        Calls func on every spectrum in a pool of processes and returns the results as a list, in the order of
+        indices. See imap_spectra.
+        """
+        return list(self.imap_spectra(func, indices, processes, chunksize))
+
+    def imap_spectra(self, func, indices=None, processes=None, chunksize=None):
+        """
+        Calls func on every spectrum in a pool of processes, e.g. for peak picking, and yields the results in the
+        order of indices as they become available.
+
+        Every worker process gets a PortableSpectrumReader whose index is in shared memory (see
+        PortableSpectrumReader.share_memory, before Python 3.8 a pickled copy of the index) and opens the .ibd file
+        once, and is then sent chunks of consecutive indices. Within a chunk, the spectra are read in the order of their offsets in the .ibd
+        file. The .ibd file must be a file on disk.
+
+        :param func:
+            function that is called with the arrays that getspectrum returns, e.g. func(mzs, intensities), and
+            returns the result for that spectrum. It must be picklable, i.e. defined at the top level of a module
+        :param indices:
+            indices of the spectra to process. All spectra if None
+        :param processes:
+            number of worker processes. os.cpu_count() if None
+        :param chunksize:
+            number of spectra per task. By default, every process gets about 4 tasks
+        """
+        indices = np.arange(len(self.coordinates)) if indices is None else np.asarray(indices, dtype=np.int64).ravel()
+        ibd_path = getattr(self.m, 'name', None)
+        if not isinstance(ibd_path, (str, Path)) or not os.path.isfile(ibd_path):
+            raise ValueError("map_spectra and imap_spectra need the .ibd file to be a file on disk")
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if chunksize is None:
+            chunksize = max(1, -(-len(indices) // (processes * 4)))
+        chunks = [indices[start:start + chunksize] for start in range(0, len(indices), chunksize)]
+        reader = self.portable_spectrum_reader()
+        try:
+            # the workers attach to one copy of the index instead of unpickling their own
+            reader = reader.share_memory()
+        except ImportError:
+            # multiprocessing.shared_memory needs Python 3.8+, every worker unpickles its own copy of the index then
+            pass
+        with reader,\
+             ProcessPoolExecutor(max_workers=processes, initializer=_init_map_worker,
+                                 initargs=(reader, str(ibd_path))) as executor:
+            for results in executor.map(_map_spectra_chunk, [func] * len(chunks), chunks):
+                for result in results:
+                    yield result
+
+    def partition(self, n_parts, by='bytes'):
+        """
+        Splits the spectra into n_parts partitions for distributed processing, e.g. with Spark or Dask.
+
+        :param n_parts:
+            number of partitions. Some may be empty if there are fewer spectra
+        :param by:
+            * 'bytes': consecutive spectra in the .ibd file with about the same number of bytes to read each,
+              which balances processed data with very different spectrum sizes
+            * 'pixels': consecutive spectra in the .ibd file with the same number of spectra each
+            * 'spatial_tiles': roughly rectangular tiles of the image with the same number of spectra each
+
+        :return:
+            list of n_parts arrays of spectrum indices, each sorted by the offsets of the spectra in the .ibd file
+        """
+        return _partition(self.coordinates, self.__array_columns(), n_parts, by)
+
+    def __array_columns(self):
+        """
+        Returns (offsets, lengths, precision, compression, encoded lengths) for the m/z, intensity and, if included,
+        the mobility arrays.
+        """
+        columns = [
+            (self.mzOffsets, self.mzLengths, self.mzPrecision, self.mzCompression, self.mzEncodedLengths),
+            (self.intensityOffsets, self.intensityLengths, self.intensityPrecision, self.intensityCompression,
+             self.intensityEncodedLengths),
+        ]
+        if self.include_mobility == True:
+            columns.append((self.mobilityOffsets, self.mobilityLengths, self.mobilityPrecision,
+                            self.mobilityCompression, self.mobilityEncodedLengths))
+        return columns
+
+    def _read_array(self, offset, length, dtype, compression=None, encoded_length=None):
+        """
+        Reads length values of the given number format starting at offset in the .ibd file. If compression is
+        given, encoded_length bytes are read and decompressed instead.
+        """
+        if self._ibd_mmap is None:
+            return _read_file_array(self.m, offset, length, dtype, compression, encoded_length)
+        if _is_compressed(compression):
+            return _decode_array(self._read_bytes(offset, _encoded_nbytes(encoded_length)), dtype, compression)
+        return _view_array(self._ibd_mmap, offset, length, dtype)
+
+    def _read_bytes(self, offset, nbytes):
+        """
+        Reads nbytes bytes starting at offset in the .ibd file into a writable buffer, or returns a read-only view
+        of them in mmap mode.
+        """
+        if self._ibd_mmap is not None:
+            return self._ibd_mmap[int(offset):int(offset) + int(nbytes)]
+        return _pread(self.m, offset, nbytes)
+
+    def _shared_mz_array(self):
+        """
+        Returns the m/z array that all spectra of a continuous dataset share. It is read on the first call only.
+        """
+        if self._mz_array_cache is None:
+            mz_array = self._read_array(self.mzOffsets[0], self.mzLengths[0], self.mzPrecision, self.mzCompression,
+                                        _encoded_length(self.mzEncodedLengths, 0))
+            mz_array.flags.writeable = False
+            self._mz_array_cache = mz_array
+        return self._mz_array_cache
+
+    def _get_intensity_range(self, index, start, stop):
+        """
+        Reads only the values start:stop of the intensity array of the spectrum at the specified index.
+        Like slicing, start and stop are clipped to the length of the array. Compressed arrays are decompressed as
+        a whole and then sliced.
+        """
+        if _is_compressed(self.intensityCompression):
+            return self._read_array(self.intensityOffsets[index], self.intensityLengths[index],
+                                    self.intensityPrecision, self.intensityCompression,
+                                    _encoded_length(self.intensityEncodedLengths, index))[start:stop]
+        length = int(self.intensityLengths[index])
+        start, stop = min(start, length), min(stop, length)
+        offset = int(self.intensityOffsets[index]) + start * self.sizeDict[self.intensityPrecision]
+        return self._read_array(offset, max(stop - start, 0), self.intensityPrecision)
+
+    def to_datacube(self, dtype=None, mz_range=None, layout='pixels', z=1):
+        """
+        Loads the intensities of all spectra of a continuous dataset into one dense array.
+
+        If the intensity arrays are uncompressed and evenly spaced in the .ibd file, as they are when written
+        back-to-back, they are read with a single bulk read. If the parser was created with use_mmap=True and no
+        conversion is needed, a read-only view into the mapped .ibd file is returned instead, so nothing is read until
+        it is accessed.
+
+        :param dtype:
+            NumPy data type of the returned datacube. Defaults to the intensity precision of the file
+        :param mz_range:
+            (lower, upper) tuple. If given, only the m/z values lower <= x <= upper are included
+        :param layout:
+            'pixels' returns an array of shape (number of spectra, number of m/z values) in the order of
+            self.coordinates, 'image' returns an array of shape (max count of pixels y, max count of pixels x,
+            number of m/z values) where pixels without a spectrum are zero
+        :param z:
+            z Value of the pixels to include for the 'image' layout, if spectrogram is 3-dimensional.
+
+        :return: the m/z axis and the datacube
+        :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+        :raises ValueError: if the dataset is not continuous
+        """
+        if not self.continuous or not np.all(self.intensityLengths == self.intensityLengths[0]):
+            raise ValueError("A datacube can only be built for continuous data")
+        if layout not in ('pixels', 'image'):
+            raise ValueError('layout must be "pixels" or "image". Received: {}'.format(layout))
+        mzs = self._shared_mz_array()
+        start, stop = 0, len(mzs)
+        if mz_range is not None:
+            start = int(np.searchsorted(mzs, mz_range[0], side='left'))
+            stop = int(np.searchsorted(mzs, mz_range[1], side='right'))
+        stop = max(start, min(stop, int(self.intensityLengths[0])))
+        precision = np.dtype(self.intensityPrecision)
+        dtype = precision if dtype is None else np.dtype(dtype)
+
+        n_spectra = len(self.intensityOffsets)
+        row_offsets = self.intensityOffsets + start * precision.itemsize
+        strides = np.diff(self.intensityOffsets)
+        stride = int(strides[0]) if len(strides) else 0
+        if not _is_compressed(self.intensityCompression) and np.all(strides == stride) and stride >= 0:
+            first_offset = int(row_offsets[0])
+            if self._ibd_mmap is not None:
+                buffer = self._ibd_mmap
+            else:
+                # one sequential read from the first to the last requested value
+                buffer = self._read_bytes(first_offset, stride * (n_spectra - 1) + (stop - start) * precision.itemsize)
+                first_offset = 0
+            datacube = np.ndarray((n_spectra, stop - start), dtype=precision, buffer=buffer,
+                                  offset=first_offset, strides=(stride, precision.itemsize))
+        else:
+            datacube = np.empty((n_spectra, stop - start), dtype=dtype)
+            for i in range(n_spectra):
+                datacube[i] = self._get_intensity_range(i, start, stop)
+
+        if layout == 'image':
+            image = np.zeros((self.imzmldict["max count of pixels y"], self.imzmldict["max count of pixels x"],
+                              stop - start), dtype=dtype)
+            in_plane = self.coordinates[:, 2] == z
+            image[self.coordinates[in_plane, 1] - 1, self.coordinates[in_plane, 0] - 1] = datacube[in_plane]
+            return mzs[start:stop], image
+        if datacube.dtype == dtype and (datacube.flags.c_contiguous or self._ibd_mmap is not None):
+            return mzs[start:stop], datacube
+        return mzs[start:stop], datacube.astype(dtype)
+
+    def to_sparse(self, bin_width=None, mz_grid=None, ppm=None, dtype=np.float32):
+        """
+        Bins all spectra into a sparse matrix with one row per spectrum and one column per m/z bin. This is the
+        memory-efficient counterpart of to_datacube for processed data, where every spectrum has its own m/z array.
+
+        The spectra are streamed one by one. Intensities that fall into the same bin of a spectrum are summed, and
+        only the non-empty bins are kept, so the matrix is assembled from concatenated arrays in a single pass.
+        Exactly one of bin_width, mz_grid and ppm must be given. Requires scipy, e.g. ``pip install pyimzML[sparse]``.
+
+        :param bin_width:
+            width of the m/z bins. The bins are aligned to multiples of bin_width and span the observed m/z range
+        :param mz_grid:
+            increasing sequence of bin edges. Values outside of the grid are dropped
+        :param ppm:
+            relative width of the m/z bins in parts per million. The bins span the observed m/z range. Values with a
+            m/z that is not positive are dropped
+        :param dtype:
+            NumPy data type of the matrix values
+
+        :return: the bin edges (one more than there are columns) and the matrix
+        :rtype: Tuple[numpy.ndarray, scipy.sparse.csr_matrix]
+        """
+        from scipy.sparse import csr_matrix
+
+        if sum(arg is not None for arg in (bin_width, mz_grid, ppm)) != 1:
+            raise ValueError("Exactly one of bin_width, mz_grid and ppm must be given")
+        if mz_grid is not None:
+            mz_grid = np.asarray(mz_grid, dtype=np.float64)
+
+            def to_bins(mzs):
+                return np.searchsorted(mz_grid, mzs, side='right') - 1
+        elif bin_width is not None:
+            def to_bins(mzs):
+                return np.floor(np.asarray(mzs, dtype=np.float64) / bin_width).astype(np.int64)
+        else:
+            log_step = np.log1p(ppm * 1e-6)
+
+            def to_bins(mzs):
+                return np.floor(np.log(np.asarray(mzs, dtype=np.float64)) / log_step).astype(np.int64)
+
+        n_bins = len(mz_grid) - 1 if mz_grid is not None else None
+        indices, data = [], []
+        indptr = np.zeros(len(self.coordinates) + 1, dtype=np.int64)
+        shared_bins = None
+        for i in range(len(self.coordinates)):
+            mzs, ints = self.getspectrum(i)[:2]
+            if ppm is not None:
+                # the logarithmic bins only cover positive m/z values
+                positive = np.asarray(mzs) > 0
+                if not np.all(positive):
+                    mzs, ints = np.asarray(mzs)[positive], np.asarray(ints)[positive]
+            if self.continuous:
+                if shared_bins is None:
+                    shared_bins = to_bins(mzs)
+                bins = shared_bins
+            else:
+                bins = to_bins(mzs)
+            if n_bins is not None:
+                in_grid = (bins >= 0) & (bins < n_bins)
+                bins, ints = bins[in_grid], np.asarray(ints)[in_grid]
+            if len(bins) and np.any(bins[1:] < bins[:-1]):
+                order = np.argsort(bins, kind='stable')
+                bins, ints = bins[order], np.asarray(ints)[order]
+            n_values = 0
+            if len(bins):
+                # bins are sorted now, so equal bins are adjacent and can be summed with reduceat
+                starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+                indices.append(bins[starts])
+                data.append(np.add.reduceat(np.asarray(ints, dtype=np.float64), starts).astype(dtype))
+                n_values = len(starts)
+            indptr[i + 1] = indptr[i] + n_values
+
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        data = np.concatenate(data) if data else np.zeros(0, dtype=dtype)
+        if n_bins is not None:
+            edges = mz_grid
+        else:
+            first_bin = int(indices.min()) if len(indices) else 0
+            n_bins = int(indices.max()) - first_bin + 1 if len(indices) else 0
+            indices -= first_bin
+            bin_numbers = np.arange(first_bin, first_bin + n_bins + 1)
+            edges = bin_numbers * bin_width if bin_width is not None else np.exp(bin_numbers * log_step)
+        index_dtype = np.int32 if max(n_bins, len(indices)) < 2**31 else np.int64
+        matrix = csr_matrix((data, indices.astype(index_dtype), indptr.astype(index_dtype)),
+                            shape=(len(self.coordinates), n_bins))
+        return edges, matrix
+
     def get_spectrum_as_string(self, index):
         """
         Reads m/z array and intensity array of the spectrum at specified location
         from the binary file as a byte string. The string can be unpacked by the struct
-        module. To get the arrays as numbers, use getspectrum
+        module. Compressed arrays are decompressed first. To get the arrays as numbers, use getspectrum
 
         :param index:
             Index of the desired spectrum in the .imzML file
@@ -444,26 +1130,14 @@ class ImzMLParser:
             the spectrum
             Only returned if self.include_mobility == True
         """
-        if self.include_mobility == True:
-            offsets = [self.mzOffsets[index], self.intensityOffsets[index], self.mobilityOffsets[index]]
-            lengths = [self.mzLengths[index], self.intensityLengths[index], self.mobilityLengths[index]]
-        elif self.include_mobility == False:
-            offsets = [self.mzOffsets[index], self.intensityOffsets[index]]
-            lengths = [self.mzLengths[index], self.intensityLengths[index]]
-        lengths[0] *= self.sizeDict[self.mzPrecision]
-        lengths[1] *= self.sizeDict[self.intensityPrecision]
-        if self.include_mobility == True:
-            lengths[2] *= self.sizeDict[self.mobilityPrecision]
-        self.m.seek(offsets[0])
-        mz_string = self.m.read(lengths[0])
-        self.m.seek(offsets[1])
-        intensity_string = self.m.read(lengths[1])
-        if self.include_mobility == True:
-            self.m.seek(offsets[2])
-            mobility_string = self.m.read(lengths[2])
-            return mz_string, intensity_string, mobility_string
-        elif self.include_mobility == False:
-            return mz_string, intensity_string
+        strings = []
+        for offsets, lengths, precision, compression, encoded_lengths in self.__array_columns():
+            if _is_compressed(compression):
+                buffer = self._read_bytes(offsets[index], _encoded_nbytes(encoded_lengths[index]))
+                strings.append(compression.decode(buffer, precision).tobytes())
+            else:
+                strings.append(bytes(self._read_bytes(offsets[index], int(lengths[index]) * self.sizeDict[precision])))
+        return tuple(strings)
 
     def portable_spectrum_reader(self):
         """
@@ -473,15 +1147,249 @@ class ImzMLParser:
         The PortableSpectrumReader can be safely pickled and unpickled, making it useful for reading the spectra
         in a distributed environment such as PySpark or PyWren.
         """
+        compression = dict(mzCompression=self.mzCompression, mzEncodedLengths=self.mzEncodedLengths,
+                           intensityCompression=self.intensityCompression,
+                           intensityEncodedLengths=self.intensityEncodedLengths)
         if self.include_mobility == True:
             return PortableSpectrumReader(self.coordinates,
                                           self.mzPrecision, self.mzOffsets, self.mzLengths,
                                           self.intensityPrecision, self.intensityOffsets, self.intensityLengths,
-                                          self.mobilityPrecision, self.mobilityOffsets, self.mobilityLengths)
+                                          self.mobilityPrecision, self.mobilityOffsets, self.mobilityLengths,
+                                          mobilityCompression=self.mobilityCompression,
+                                          mobilityEncodedLengths=self.mobilityEncodedLengths, **compression)
         elif self.include_mobility == False:
             return PortableSpectrumReader(self.coordinates,
                                           self.mzPrecision, self.mzOffsets, self.mzLengths,
-                                          self.intensityPrecision, self.intensityOffsets, self.intensityLengths)
+                                          self.intensityPrecision, self.intensityOffsets, self.intensityLengths,
+                                          **compression)
+
+
+def _fix_offsets(offsets):
+    # clean up the mess after morons who use signed 32-bit where unsigned 64-bit is appropriate:
+    # every step from a non-negative to a negative offset is a wrap-around by 2**32
+    offsets = np.asarray(offsets, dtype=np.int64)
+    is_negative = offsets < 0
+    wraps = np.zeros(len(offsets), dtype=np.int64)
+    wraps[1:] = np.cumsum(is_negative[1:] & ~is_negative[:-1])
+    return offsets + wraps * 2**32
+
+
+def _coalesce_ranges(offsets, nbytes, max_gap=0):
+    """
+    Merges byte ranges that overlap or are at most max_gap bytes apart.
+
+    :return:
+        (block_starts, block_ends, block_ids) where block_ids[k] is the index of the merged block that contains the
+        range starting at offsets[k]
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    ends = offsets + np.asarray(nbytes, dtype=np.int64)
+    if len(offsets) == 0:
+        return offsets, ends, np.zeros(0, dtype=np.int64)
+    order = np.argsort(offsets, kind='stable')
+    sorted_starts, sorted_ends = offsets[order], ends[order]
+    reach = np.maximum.accumulate(sorted_ends)
+    is_block_start = np.r_[True, sorted_starts[1:] > reach[:-1] + max_gap]
+    first_in_block = np.flatnonzero(is_block_start)
+    block_ids = np.empty(len(offsets), dtype=np.int64)
+    block_ids[order] = np.cumsum(is_block_start) - 1
+    return sorted_starts[first_in_block], np.maximum.reduceat(sorted_ends, first_in_block), block_ids
+
+
+def _read_coalesced(read_bytes, columns, indices, max_gap):
+    """
+    Reads the arrays of the spectra at indices with as few calls of read_bytes(offset, nbytes) as possible,
+    see ImzMLParser.getspectra.
+
+    :param columns:
+        (offsets, lengths, precision, compression, encoded lengths) of each kind of array
+    :return:
+        one list of arrays per column, in the order of indices
+    """
+    offsets, nbytes, dtypes, compressions = [], [], [], []
+    for column_offsets, column_lengths, dtype, compression, column_encoded_lengths in columns:
+        offsets.append(np.asarray(column_offsets)[indices])
+        if _is_compressed(compression):
+            nbytes.append(_encoded_nbytes(np.asarray(column_encoded_lengths)[indices]))
+        else:
+            nbytes.append(np.asarray(column_lengths)[indices].astype(np.int64) * SIZE_DICT[dtype])
+        dtypes += [dtype] * len(indices)
+        compressions += [compression] * len(indices)
+    offsets, nbytes = np.concatenate(offsets), np.concatenate(nbytes)
+    block_starts, block_ends, block_ids = _coalesce_ranges(offsets, nbytes, max_gap)
+    blocks = [memoryview(read_bytes(start, end - start)) for start, end in zip(block_starts, block_ends)]
+
+    arrays = []
+    for block_id, offset, n, dtype, compression in zip(block_ids, offsets, nbytes, dtypes, compressions):
+        start = int(offset - block_starts[block_id])
+        arrays.append(_decode_array(blocks[block_id][start:start + int(n)], dtype, compression))
+    return [arrays[k * len(indices):(k + 1) * len(indices)] for k in range(len(columns))]
+
+
+def _partition(coordinates, columns, n_parts, by):
+    """
+    Implements ImzMLParser.partition and PortableSpectrumReader.partition. columns are as for _read_coalesced.
+    """
+    if n_parts < 1:
+        raise ValueError("n_parts must be at least 1")
+    coordinates = np.asarray(coordinates).reshape(-1, 3)
+    n = len(coordinates)
+    byte_order = np.argsort(np.asarray(columns[1][0]), kind='stable')
+    if by == 'pixels':
+        return np.array_split(byte_order, n_parts)
+    elif by == 'bytes':
+        nbytes = np.zeros(n, dtype=np.float64)
+        for i, (offsets, lengths, dtype, compression, encoded_lengths) in enumerate(columns):
+            if i == 0 and _is_continuous(np.asarray(offsets), np.asarray(lengths)):
+                continue  # the shared m/z array is read once
+            if _is_compressed(compression):
+                nbytes += _encoded_nbytes(encoded_lengths)
+            else:
+                nbytes += np.asarray(lengths, dtype=np.float64) * SIZE_DICT[dtype]
+        nbytes = nbytes[byte_order]
+        # cut where the middle of a spectrum passes a multiple of the target size
+        middles = np.cumsum(nbytes) - nbytes / 2
+        cuts = np.searchsorted(middles, np.arange(1, n_parts) * (nbytes.sum() / n_parts))
+        return np.split(byte_order, cuts)
+    elif by == 'spatial_tiles':
+        x, y = coordinates[:, 0], coordinates[:, 1]
+        width = x.max() - x.min() + 1 if n else 1
+        height = y.max() - y.min() + 1 if n else 1
+        # the grid of n_rows * n_columns == n_parts tiles whose tiles are closest to squares
+        n_rows = min((r for r in range(1, n_parts + 1) if n_parts % r == 0),
+                     key=lambda r: abs(np.log((height / r) / (width / (n_parts // r)))))
+        tiles = []
+        for strip in np.array_split(np.lexsort((y, x)), n_parts // n_rows):
+            strip = strip[np.lexsort((x[strip], y[strip]))]
+            tiles += [np.sort(tile) for tile in np.array_split(strip, n_rows)]
+        offsets = np.asarray(columns[1][0])
+        return [tile[np.argsort(offsets[tile], kind='stable')] for tile in tiles]
+    raise ValueError("by must be 'bytes', 'pixels' or 'spatial_tiles'")
+
+
+def _is_continuous(mz_offsets, mz_lengths):
+    """
+    Checks whether all spectra point at the same m/z array, as they do in imzML files of type "continuous"
+    (IMS:1000030). The offsets are checked instead of the file description, as only they guarantee that
+    sharing the m/z array is safe.
+    """
+    return len(mz_offsets) > 0 and bool(np.all(mz_offsets == mz_offsets[0]) and np.all(mz_lengths == mz_lengths[0]))
+
+
+def _raw_fileno(file):
+    """
+    Returns the file descriptor of a file object whose bytes are those of a file on disk, or None. Wrappers such as
+    gzip.GzipFile have a file descriptor as well, but it refers to the encoded file underneath.
+    """
+    if isinstance(file, (io.BufferedReader, io.BufferedRandom)):
+        file = file.raw
+    if not isinstance(file, io.FileIO):
+        return None
+    try:
+        return file.fileno()
+    except (OSError, ValueError):
+        return None
+
+
+def _map_ibd(ibd_file):
+    """
+    Maps the whole .ibd file read-only into memory. Objects that are not backed by a real file descriptor
+    (e.g. ``bytes`` or ``io.BytesIO``) are wrapped without copying where possible. Returns None for other file-like
+    objects, which have to be read instead.
+    """
+    fd = _raw_fileno(ibd_file)
+    if fd is None:
+        if isinstance(ibd_file, io.BytesIO):
+            # getbuffer() would keep the BytesIO from being closed or resized while any returned array is alive,
+            # whereas getvalue() shares its memory until it is modified
+            ibd_file = ibd_file.getvalue()
+        try:
+            mapped = np.frombuffer(ibd_file, dtype=np.uint8)
+        except TypeError:
+            return None
+        mapped.flags.writeable = False
+        return mapped
+    # unlike np.memmap, mmap does not move the file position, so that concurrent positional reads are unaffected
+    if os.fstat(fd).st_size == 0:
+        return np.empty(0, dtype=np.uint8)
+    return np.frombuffer(mmap.mmap(fd, 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+
+
+def _view_array(buffer, offset, length, dtype):
+    return np.frombuffer(buffer, dtype=dtype, count=int(length), offset=int(offset))
+
+
+def _decode_array(buffer, dtype, compression=None):
+    if _is_compressed(compression):
+        return compression.decode(buffer, dtype)
+    return np.frombuffer(buffer, dtype=dtype)
+
+
+def _encoded_length(encoded_lengths, index):
+    return None if encoded_lengths is None else int(encoded_lengths[index])
+
+
+def _encoded_nbytes(encoded_lengths):
+    """
+    Checks that the encoded lengths of compressed arrays, which are -1 if the file did not specify them, are known.
+    """
+    if encoded_lengths is None or np.any(np.asarray(encoded_lengths) < 0):
+        raise ValueError("Compressed binary data arrays must specify their encoded length (IMS:1000104)")
+    if np.ndim(encoded_lengths) == 0:
+        return int(encoded_lengths)
+    return np.asarray(encoded_lengths, dtype=np.int64)
+
+
+def _read_file_array(file, offset, length, dtype, compression=None, encoded_length=None):
+    """
+    Reads length values of the given number format, or encoded_length bytes of compressed data, starting at offset
+    in a file.
+    """
+    if _is_compressed(compression):
+        return _decode_array(_pread(file, offset, _encoded_nbytes(encoded_length)), dtype, compression)
+    return np.frombuffer(_pread(file, offset, int(length) * SIZE_DICT[dtype]), dtype=dtype)
+
+
+def _pread(file, offset, nbytes):
+    """
+    Reads nbytes bytes starting at offset, or fewer at the end of the file, without using the file position of file.
+    Several threads can read the same file at once this way, and the reads release the GIL. Other file-like objects
+    than files on disk (e.g. io.BytesIO or gzip.GzipFile) and platforms without os.preadv fall back to seek and read.
+    """
+    offset, nbytes = int(offset), int(nbytes)
+    fd = _raw_fileno(file)
+    if fd is None or not hasattr(os, 'preadv'):
+        with _SEEK_LOCK:
+            file.seek(offset)
+            return file.read(nbytes)
+    buffer = bytearray(nbytes)
+    view = memoryview(buffer)
+    n_read = 0
+    while n_read < nbytes:
+        n = os.preadv(fd, [view[n_read:]], offset + n_read)
+        if n == 0:
+            del view
+            del buffer[n_read:]
+            break
+        n_read += n
+    return buffer
+
+
+# PortableSpectrumReader and open .ibd file of a worker process of ImzMLParser.imap_spectra
+_map_worker = None
+
+
+def _init_map_worker(reader, ibd_path):
+    global _map_worker
+    _map_worker = (reader, open(ibd_path, 'rb'))
+
+
+def _map_spectra_chunk(func, indices):
+    reader, file = _map_worker
+    results = [None] * len(indices)
+    for k in np.argsort(np.asarray(reader.intensityOffsets)[indices], kind='stable'):
+        results[k] = func(*reader.read_spectrum_from_file(file, indices[k]))
+    return results
 
 
 def getionimage(p, mz_value=0, mz_tol=0.1, mob_value=0, mob_tol=0.01, z=1, reduce_func=sum):
@@ -517,6 +1425,14 @@ def getionimage(p, mz_value=0, mz_tol=0.1, mob_value=0, mob_tol=0.01, z=1, reduc
     mz_tol = abs(mz_tol)
     mob_tol = abs(mob_tol)
     im = np.zeros((p.imzmldict["max count of pixels y"], p.imzmldict["max count of pixels x"]))
+    if getattr(p, 'continuous', False) and p.include_mobility == False and mz_value != 0:
+        # all spectra share one m/z axis, so the window is located once and only that part of each
+        # intensity array is read
+        min_i, max_i = _bisect_spectrum(p._shared_mz_array(), mz_value, mz_tol)
+        for i, (x, y, z_) in enumerate(p.coordinates):
+            if z_ == z:
+                im[y - 1, x - 1] = reduce_func(p._get_intensity_range(i, min_i, max_i + 1))
+        return im
     for i, (x, y, z_) in enumerate(p.coordinates):
         if z_ == 0:
             UserWarning("z coordinate = 0 present, if you're getting blank images set getionimage(.., .., z=0)")
@@ -544,6 +1460,84 @@ def getionimage(p, mz_value=0, mz_tol=0.1, mob_value=0, mob_tol=0.01, z=1, reduc
     return im
 
 
+def getionimages(p, mz_values, mz_tols=0.1, z=1, reduce='sum'):
+    """
+    Get image representations of the intensity distributions of many ions at once.
+
+    Unlike calling getionimage once per m/z value, every spectrum is read only once and all m/z windows are
+    located with a single np.searchsorted call per spectrum. For ion mobility data, the intensities of all
+    mobilities within the m/z windows are combined.
+
+    :param p:
+        the ImzMLParser (or anything else with similar attributes) for the desired dataset
+    :param mz_values:
+        sequence of m/z values for which the ion images shall be returned
+    :param mz_tols:
+        Absolute tolerance for the m/z values, either a single number or one per m/z value, such that all ions
+        with values mz_value-|mz_tol| <= x <= mz_value+|mz_tol| are included. Defaults to 0.1
+    :param z:
+        z Value if spectrogram is 3-dimensional.
+    :param reduce:
+        the bahaviour for reducing the intensities within each m/z window to a single value: 'sum', 'mean', 'max',
+        or a function that takes a sequence as input and outputs a number. The named reductions are vectorized,
+        a function is called once per window and pixel. By default, the values are summed.
+
+    :return:
+        numpy array of shape (len(mz_values), max count of pixels y, max count of pixels x), where ims[k] is the
+        ion image of mz_values[k]
+    """
+    mz_values = np.asarray(mz_values, dtype=np.float64).ravel()
+    mz_tols = np.abs(np.broadcast_to(np.asarray(mz_tols, dtype=np.float64), mz_values.shape))
+    lower_bounds = mz_values - mz_tols
+    upper_bounds = mz_values + mz_tols
+    ims = np.zeros((len(mz_values), p.imzmldict["max count of pixels y"], p.imzmldict["max count of pixels x"]))
+    if getattr(p, 'continuous', False):
+        # all spectra share one m/z axis, so the windows are located once and only the range of each
+        # intensity array that is covered by any window is read
+        mzs = p._shared_mz_array()
+        min_i = np.searchsorted(mzs, lower_bounds, side='left')
+        max_i = np.searchsorted(mzs, upper_bounds, side='right')
+        start, stop = (int(min_i.min()), int(max_i.max())) if len(mz_values) else (0, 0)
+        for i, (x, y, z_) in enumerate(p.coordinates):
+            if z_ == z:
+                ints = p._get_intensity_range(i, start, stop)
+                # like getionimage, clip the windows to intensity arrays that are shorter than the m/z axis
+                ims[:, y - 1, x - 1] = _reduce_windows(ints, np.minimum(min_i - start, len(ints)),
+                                                       np.minimum(max_i - start, len(ints)), reduce)
+        return ims
+    for i, (x, y, z_) in enumerate(p.coordinates):
+        if z_ == z:
+            spectrum = p.getspectrum(i)
+            mzs, ints = np.asarray(spectrum[0]), np.asarray(spectrum[1])
+            min_i = np.searchsorted(mzs, lower_bounds, side='left')
+            max_i = np.searchsorted(mzs, upper_bounds, side='right')
+            ims[:, y - 1, x - 1] = _reduce_windows(ints, min_i, max_i, reduce)
+    return ims
+
+
+def _reduce_windows(ints, min_i, max_i, reduce):
+    """
+    Reduces ints[min_i[k]:max_i[k]] for every k to a single value. Empty windows are reduced to 0.
+    """
+    if reduce in ('sum', 'mean'):
+        cumsum = np.zeros(len(ints) + 1)
+        np.cumsum(ints, out=cumsum[1:])
+        sums = cumsum[max_i] - cumsum[min_i]
+        if reduce == 'sum':
+            return sums
+        return sums / np.maximum(max_i - min_i, 1)
+    if reduce == 'max':
+        result = np.zeros(len(min_i))
+        non_empty = max_i > min_i
+        if np.any(non_empty):
+            bounds = np.stack([min_i[non_empty], max_i[non_empty]], axis=1).ravel()
+            result[non_empty] = np.maximum.reduceat(np.append(ints, 0), bounds)[::2]
+        return result
+    if callable(reduce):
+        return [reduce(ints[lo:hi]) if hi > lo else 0 for lo, hi in zip(min_i, max_i)]
+    raise ValueError('reduce must be "sum", "mean", "max" or a function. Received: {}'.format(reduce))
+
+
 def browse(p):
     """
     Create a per-spectrum metadata browser for the parser.
@@ -662,7 +1656,9 @@ class PortableSpectrumReader(object):
 
     def __init__(self, coordinates, mzPrecision, mzOffsets, mzLengths,
                  intensityPrecision, intensityOffsets, intensityLengths,
-                 mobilityPrecision=None, mobilityOffsets=None, mobilityLengths=None):
+                 mobilityPrecision=None, mobilityOffsets=None, mobilityLengths=None,
+                 mzCompression=None, intensityCompression=None, mobilityCompression=None,
+                 mzEncodedLengths=None, intensityEncodedLengths=None, mobilityEncodedLengths=None):
         self.coordinates = coordinates
         self.mzPrecision = mzPrecision
         self.mzOffsets = mzOffsets
@@ -673,6 +1669,13 @@ class PortableSpectrumReader(object):
         self.mobilityPrecision = mobilityPrecision
         self.mobilityOffsets = mobilityOffsets
         self.mobilityLengths = mobilityLengths
+        # compression of each array and, for compressed arrays, their encoded lengths in bytes
+        self.mzCompression = mzCompression
+        self.intensityCompression = intensityCompression
+        self.mobilityCompression = mobilityCompression
+        self.mzEncodedLengths = mzEncodedLengths
+        self.intensityEncodedLengths = intensityEncodedLengths
+        self.mobilityEncodedLengths = mobilityEncodedLengths
 
         if mobilityPrecision is None and mobilityOffsets is None and mobilityLengths is None:
             self.include_mobility = False
@@ -699,18 +1702,175 @@ class PortableSpectrumReader(object):
             Sequence of mobility values corresponding to mz_array
             Only included if trapped ion mobility data is present
         """
-        file.seek(self.mzOffsets[index])
-        mz_bytes = file.read(self.mzLengths[index] * SIZE_DICT[self.mzPrecision])
-        file.seek(self.intensityOffsets[index])
-        intensity_bytes = file.read(self.intensityLengths[index] * SIZE_DICT[self.intensityPrecision])
-
-        mz_array = np.frombuffer(mz_bytes, dtype=self.mzPrecision)
-        intensity_array = np.frombuffer(intensity_bytes, dtype=self.intensityPrecision)
+        mz_array = _read_file_array(file, self.mzOffsets[index], self.mzLengths[index], self.mzPrecision,
+                                    self.mzCompression, _encoded_length(self.mzEncodedLengths, index))
+        intensity_array = _read_file_array(file, self.intensityOffsets[index], self.intensityLengths[index],
+                                           self.intensityPrecision, self.intensityCompression,
+                                           _encoded_length(self.intensityEncodedLengths, index))
 
         if self.include_mobility == True:
-            file.seek(self.mobilityOffsets[index])
-            mobility_bytes = file.read(self.mobilityLengths[index] * SIZE_DICT[self.mobilityPrecision])
-            mobility_array = np.frombuffer(mobility_bytes, dtype=self.mobilityPrecision)
+            mobility_array = _read_file_array(file, self.mobilityOffsets[index], self.mobilityLengths[index],
+                                              self.mobilityPrecision, self.mobilityCompression,
+                                              _encoded_length(self.mobilityEncodedLengths, index))
             return mz_array, intensity_array, mobility_array
         elif self.include_mobility == False:
             return mz_array, intensity_array
+
+    def read_spectra_from_file(self, file, indices, max_gap=2**16, use_mmap=False):
+        """
+        Reads the spectra at the specified indices from the .ibd file with as few reads as possible, like
+        ImzMLParser.getspectra. The byte ranges of the arrays are sorted by their offsets, and ranges that overlap
+        or are at most max_gap bytes apart are read at once.
+
+        :param file:
+            File or file-like object for the .ibd file
+        :param indices:
+            sequence of indices of the desired spectra in the .imzML file
+        :param max_gap:
+            ranges that are at most this many bytes apart are read together, including the bytes between them
+        :param use_mmap:
+            Whether to memory-map the file instead of reading it. Uncompressed arrays are then returned as
+            read-only views into the mapping, which stays alive as long as any of them does. The mapping is
+            reused by later calls with the same file. File-like objects that cannot be mapped are read instead
+
+        :return:
+            list with one tuple per index, in the same order as indices, as they would be returned by
+            read_spectrum_from_file
+        """
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if len(indices) == 0:
+            return []
+        columns = self._array_columns()
+        mapped = self._map_file(file) if use_mmap else None
+        if mapped is not None:
+            def read_bytes(offset, nbytes):
+                return mapped[int(offset):int(offset) + int(nbytes)]
+        else:
+            def read_bytes(offset, nbytes):
+                return _pread(file, offset, nbytes)
+        return list(zip(*_read_coalesced(read_bytes, columns, indices, max_gap)))
+
+    def _map_file(self, file):
+        """
+        Returns the memory mapping of file, which is reused as long as the same file is passed and has not grown.
+        """
+        cached = self.__dict__.get('_mmap_cache')
+        if cached is not None and cached[0]() is file:
+            fd = _raw_fileno(file)
+            if fd is None or os.fstat(fd).st_size == len(cached[1]):
+                return cached[1]
+        mapped = _map_ibd(file)
+        if mapped is None:
+            return None
+        try:
+            self._mmap_cache = (weakref.ref(file), mapped)
+        except TypeError:
+            pass
+        return mapped
+
+    def partition(self, n_parts, by='bytes'):
+        """
+        Splits the spectra into n_parts partitions for distributed processing, see ImzMLParser.partition.
+        """
+        return _partition(self.coordinates, self._array_columns(), n_parts, by)
+
+    def _array_columns(self):
+        columns = [(self.mzOffsets, self.mzLengths, self.mzPrecision, self.mzCompression, self.mzEncodedLengths),
+                   (self.intensityOffsets, self.intensityLengths, self.intensityPrecision, self.intensityCompression,
+                    self.intensityEncodedLengths)]
+        if self.include_mobility == True:
+            columns.append((self.mobilityOffsets, self.mobilityLengths, self.mobilityPrecision,
+                            self.mobilityCompression, self.mobilityEncodedLengths))
+        return columns
+
+    def share_memory(self):
+        """
+        Returns a copy of this reader whose coordinates, offsets and lengths are stored in one
+        multiprocessing.shared_memory block. Pickling the copy only pickles the name of the block, so that sending
+        it to many worker processes is fast and they all use the same copy of the index. Requires Python 3.8+.
+
+        The process that called share_memory owns the block and must free it with release_shared_memory, or by
+        using the returned reader as a context manager, once the workers are done.
+        """
+        from multiprocessing import shared_memory
+        arrays = [(name, np.ascontiguousarray(getattr(self, name))) for name in _SHARED_INDEX_FIELDS
+                  if getattr(self, name) is not None]
+        layout, size = [], 0
+        for name, values in arrays:
+            size = -(-size // 8) * 8
+            layout.append((name, values.dtype.str, values.shape, size))
+            size += values.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        reader = copy.copy(self)
+        reader._shm, reader._shm_layout, reader._shm_owner = shm, layout, True
+        reader._attach_shared_arrays()
+        for name, values in arrays:
+            getattr(reader, name)[...] = values
+        return reader
+
+    def release_shared_memory(self):
+        """
+        Detaches from the shared memory block of a reader created by share_memory, and frees it in the process
+        that created it. The reader cannot be used afterwards.
+        """
+        shm = self.__dict__.get('_shm')
+        if shm is None:
+            return
+        for name, _, _, _ in self._shm_layout:
+            setattr(self, name, None)
+        self._shm = None
+        shm.close()
+        if self._shm_owner:
+            shm.unlink()
+
+    def _attach_shared_arrays(self):
+        for name, dtype, shape, offset in self._shm_layout:
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, trace):
+        self.release_shared_memory()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_mmap_cache', None)
+        if state.get('_shm') is not None:
+            for name, _, _, _ in self._shm_layout:
+                del state[name]
+            state['_shm'] = self._shm.name
+            state['_shm_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(state.get('_shm'), str):
+            self._shm = _attach_shared_memory(state['_shm'])
+            self._attach_shared_arrays()
+
+
+_resource_tracker_lock = threading.Lock()
+
+
+def _attach_shared_memory(name):
+    from multiprocessing import resource_tracker, shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before Python 3.13, every process that attaches registers the block with the resource tracker, which would
+    # then unlink it behind the back of its owner. Unregistering afterwards is no option, as the tracker of a forked
+    # worker is shared with the owner and would forget the owner's registration, so skip the registration instead.
+    register = resource_tracker.register
+
+    def register_other(name, rtype):
+        if rtype != "shared_memory":
+            register(name, rtype)
+
+    with _resource_tracker_lock:
+        resource_tracker.register = register_other
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
@@ -9,18 +9,24 @@ import os
 import numpy as np
 import uuid
 import hashlib
+import shutil
 import sys
+import tempfile
+import threading
 import getopt
-from collections import namedtuple, OrderedDict, defaultdict
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from warnings import warn
 
 from wheezy.template import Engine, CoreExtension, DictLoader
 
-from pyimzml.compression import NoCompression, ZlibCompression
+from pyimzml.compression import Compression, NoCompression, compression_from_string
 
 
 # TODO: Add support for differing scan types, including SRM.
 IMZML_TEMPLATE = """\
-@require(uuid, sha1sum, mz_data_type, int_data_type, run_id, spectra, mode, obo_codes, obo_names, mz_compression, int_compression, polarity, spec_type, scan_direction, scan_pattern, scan_type, line_scan_direction, ms_levels, image_x_dimension, image_y_dimension, pixel_size_x, pixel_size_y, xml_element_strings)
+@require(uuid, sha1sum, mz_data_type, int_data_type, run_id, spectrum_count, max_x, max_y, mode, obo_codes, obo_names, mz_compression, int_compression, polarity, spec_type, scan_direction, scan_pattern, scan_type, line_scan_direction, ms_levels, image_x_dimension, image_y_dimension, pixel_size_x, pixel_size_y, xml_element_strings)
 <?xml version="1.0" encoding="ISO-8859-1"?>
 <mzML xmlns="http://psi.hupo.org/ms/mzml" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.0_idx.xsd" version="1.1">
   <cvList count="2">
@@ -63,16 +69,22 @@ IMZML_TEMPLATE = """\
   <referenceableParamGroupList count="4">
   @end
     <referenceableParamGroup id="mzArray">
-      <cvParam cvRef="MS" accession="MS:@obo_codes[mz_compression]" name="@mz_compression" value=""/>
+      <cvParam cvRef="MS" accession="@mz_compression.accession" name="@mz_compression.name" value=""/>
       <cvParam cvRef="MS" accession="MS:1000514" name="m/z array" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
       <cvParam cvRef="MS" accession="MS:@obo_codes[mz_data_type]" name="@mz_data_type" value=""/>
       <cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>
+      @if mz_compression.user_param is not None:
+      <userParam name="pyimzml compression" value="@mz_compression.user_param_value"/>
+      @end
     </referenceableParamGroup>
     <referenceableParamGroup id="intensityArray">
       <cvParam cvRef="MS" accession="MS:@obo_codes[int_data_type]" name="@int_data_type" value=""/>
       <cvParam cvRef="MS" accession="MS:1000515" name="intensity array" unitCvRef="MS" unitAccession="MS:1000131" unitName="number of detector counts"/>
-      <cvParam cvRef="MS" accession="MS:@obo_codes[int_compression]" name="@int_compression" value=""/>
+      <cvParam cvRef="MS" accession="@int_compression.accession" name="@int_compression.name" value=""/>
       <cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>
+      @if int_compression.user_param is not None:
+      <userParam name="pyimzml compression" value="@int_compression.user_param_value"/>
+      @end
     </referenceableParamGroup>
     <referenceableParamGroup id="scan1">
       <cvParam cvRef="MS" accession="MS:1000093" name="increasing m/z scan"/>
@@ -108,8 +120,8 @@ IMZML_TEMPLATE = """\
       <cvParam cvRef="IMS" accession="IMS:@obo_codes[scan_pattern]" name="@obo_names[scan_pattern]"/>
       <cvParam cvRef="IMS" accession="IMS:@obo_codes[scan_type]" name="@obo_names[scan_type]"/>
       <cvParam cvRef="IMS" accession="IMS:@obo_codes[line_scan_direction]" name="@obo_names[line_scan_direction]"/>
-      <cvParam cvRef="IMS" accession="IMS:1000042" name="max count of pixels x" value="@{str(max(s["coords"][0] for s in spectra))!!s}"/>
-      <cvParam cvRef="IMS" accession="IMS:1000043" name="max count of pixels y" value="@{str(max(s["coords"][1] for s in spectra))!!s}"/>
+      <cvParam cvRef="IMS" accession="IMS:1000042" name="max count of pixels x" value="@{str(max_x)!!s}"/>
+      <cvParam cvRef="IMS" accession="IMS:1000043" name="max count of pixels y" value="@{str(max_y)!!s}"/>
       @if image_x_dimension is not None:
       <cvParam cvRef="IMS" accession="IMS:1000044" name="max dimension x" value="@{str(image_x_dimension)!!s}" unitCvRef="UO" unitAccession="UO:0000017" unitName="micrometer"/>
       <cvParam cvRef="IMS" accession="IMS:1000046" name="pixel size (x)" value="@{str(pixel_size_x)!!s}" unitCvRef="UO" unitAccession="UO:0000017" unitName="micrometer"/>
@@ -145,8 +157,11 @@ IMZML_TEMPLATE = """\
     </dataProcessing>
   </dataProcessingList>
   <run defaultInstrumentConfigurationRef="IC1" id="@run_id">
-    <spectrumList count="@{len(spectra)!!s}" defaultDataProcessingRef="export_from_pyimzml">
-      @for index, s in enumerate(spectra):
+    <spectrumList count="@{spectrum_count!!s}" defaultDataProcessingRef="export_from_pyimzml">
+"""
+
+IMZML_SPECTRUM_TEMPLATE = """\
+@require(index, s)
       <spectrum defaultArrayLength="0" id="spectrum=@{(index+1)!!s}" index="@{(index+1)!!s}">
         <referenceableParamGroupRef ref="spectrum1"/>
         @if s["ms_level"]==1:
@@ -244,16 +259,12 @@ IMZML_TEMPLATE = """\
           </binaryDataArray>
         </binaryDataArrayList>
       </spectrum>
-      @end
-    </spectrumList>
-  </run>
-</mzML>
 """
 
 
 # TODO: provide more information about the mobility dimension, such as unit, name, accession.
 IMZML_MOBILITY_TEMPLATE = """\
-@require(uuid, sha1sum, mz_data_type, int_data_type, mob_data_type, run_id, spectra, mode, obo_codes, obo_names, mz_compression, int_compression, mob_compression, polarity, spec_type, scan_direction, scan_pattern, scan_type, line_scan_direction, ms_levels, image_x_dimension, image_y_dimension, pixel_size_x, pixel_size_y, mobility_name, mobility_accession, mobility_unit, mobility_unit_accession, xml_element_strings)
+@require(uuid, sha1sum, mz_data_type, int_data_type, mob_data_type, run_id, spectrum_count, max_x, max_y, mode, obo_codes, obo_names, mz_compression, int_compression, mob_compression, polarity, spec_type, scan_direction, scan_pattern, scan_type, line_scan_direction, ms_levels, image_x_dimension, image_y_dimension, pixel_size_x, pixel_size_y, mobility_name, mobility_accession, mobility_unit, mobility_unit_accession, xml_element_strings)
 <?xml version="1.0" encoding="ISO-8859-1"?>
 <mzML xmlns="http://psi.hupo.org/ms/mzml" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.0_idx.xsd" version="1.1">
   <cvList count="2">
@@ -299,22 +310,31 @@ IMZML_MOBILITY_TEMPLATE = """\
   <referenceableParamGroupList count="5">
   @end
     <referenceableParamGroup id="mzArray">
-      <cvParam cvRef="MS" accession="MS:@obo_codes[mz_compression]" name="@mz_compression" value=""/>
+      <cvParam cvRef="MS" accession="@mz_compression.accession" name="@mz_compression.name" value=""/>
       <cvParam cvRef="MS" accession="MS:1000514" name="m/z array" unitCvRef="MS" unitAccession="MS:1000040" unitName="m/z"/>
       <cvParam cvRef="MS" accession="MS:@obo_codes[mz_data_type]" name="@mz_data_type" value=""/>
       <cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>
+      @if mz_compression.user_param is not None:
+      <userParam name="pyimzml compression" value="@mz_compression.user_param_value"/>
+      @end
     </referenceableParamGroup>
     <referenceableParamGroup id="intensityArray">
       <cvParam cvRef="MS" accession="MS:@obo_codes[int_data_type]" name="@int_data_type" value=""/>
       <cvParam cvRef="MS" accession="MS:1000515" name="intensity array" unitCvRef="MS" unitAccession="MS:1000131" unitName="number of detector counts"/>
-      <cvParam cvRef="MS" accession="MS:@obo_codes[int_compression]" name="@int_compression" value=""/>
+      <cvParam cvRef="MS" accession="@int_compression.accession" name="@int_compression.name" value=""/>
       <cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>
+      @if int_compression.user_param is not None:
+      <userParam name="pyimzml compression" value="@int_compression.user_param_value"/>
+      @end
     </referenceableParamGroup>
     <referenceableParamGroup id="mobilityArray">
-      <cvParam cvRef="MS" accession="MS:@obo_codes[mob_compression]" name="@mob_compression" value=""/>
+      <cvParam cvRef="MS" accession="@mob_compression.accession" name="@mob_compression.name" value=""/>
       <cvParam cvRef="MS" accession="@{str(mobility_accession)!!s}" name="@{str(mobility_name)!!s}" unitCvRef="MS" unitAccession="@{str(mobility_unit_accession)!!s}" unitName="@{str(mobility_unit)!!s}"/>
       <cvParam cvRef="MS" accession="MS:@obo_codes[mob_data_type]" name="@mob_data_type" value=""/>
       <cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>
+      @if mob_compression.user_param is not None:
+      <userParam name="pyimzml compression" value="@mob_compression.user_param_value"/>
+      @end
     </referenceableParamGroup>
     <referenceableParamGroup id="scan1">
       <cvParam cvRef="MS" accession="MS:1000093" name="increasing m/z scan"/>
@@ -333,7 +353,7 @@ IMZML_MOBILITY_TEMPLATE = """\
     </referenceableParamGroup>
   </referenceableParamGroupList>
 
-  @if xml_element_strings.get("software_list_element") is not None:
+  @if xml_element_strings.get("software_list_element") is None:
   <softwareList count="1">
   @else:
   <softwareList count="@{xml_element_strings.get("software_list_count")!!s}">
@@ -352,8 +372,8 @@ IMZML_MOBILITY_TEMPLATE = """\
       <cvParam cvRef="IMS" accession="IMS:@obo_codes[scan_pattern]" name="@obo_names[scan_pattern]"/>
       <cvParam cvRef="IMS" accession="IMS:@obo_codes[scan_type]" name="@obo_names[scan_type]"/>
       <cvParam cvRef="IMS" accession="IMS:@obo_codes[line_scan_direction]" name="@obo_names[line_scan_direction]"/>
-      <cvParam cvRef="IMS" accession="IMS:1000042" name="max count of pixels x" value="@{str(max(s["coords"][0] for s in spectra))!!s}"/>
-      <cvParam cvRef="IMS" accession="IMS:1000043" name="max count of pixels y" value="@{str(max(s["coords"][1] for s in spectra))!!s}"/>
+      <cvParam cvRef="IMS" accession="IMS:1000042" name="max count of pixels x" value="@{str(max_x)!!s}"/>
+      <cvParam cvRef="IMS" accession="IMS:1000043" name="max count of pixels y" value="@{str(max_y)!!s}"/>
       @if image_x_dimension is not None:
       <cvParam cvRef="IMS" accession="IMS:1000044" name="max dimension x" value="@{str(image_x_dimension)!!s}" unitCvRef="UO" unitAccession="UO:0000017" unitName="micrometer"/>
       <cvParam cvRef="IMS" accession="IMS:1000046" name="pixel size (x)" value="@{str(pixel_size_x)!!s}" unitCvRef="UO" unitAccession="UO:0000017" unitName="micrometer"/>
@@ -391,8 +411,11 @@ IMZML_MOBILITY_TEMPLATE = """\
   </dataProcessingList>
 
   <run defaultInstrumentConfigurationRef="IC1" id="@run_id">
-    <spectrumList count="@{len(spectra)!!s}" defaultDataProcessingRef="export_from_pyimzml">
-      @for index, s in enumerate(spectra):
+    <spectrumList count="@{spectrum_count!!s}" defaultDataProcessingRef="export_from_pyimzml">
+"""
+
+IMZML_MOBILITY_SPECTRUM_TEMPLATE = """\
+@require(index, s, mobility_unit, mobility_unit_accession)
       <spectrum defaultArrayLength="0" id="spectrum=@{(index+1)!!s}" index="@{(index+1)!!s}">
         <referenceableParamGroupRef ref="spectrum1"/>
         @if s["ms_level"]==1:
@@ -501,21 +524,240 @@ IMZML_MOBILITY_TEMPLATE = """\
           </binaryDataArray>
         </binaryDataArrayList>
       </spectrum>
-      @end
+"""
+
+IMZML_FOOTER = """\
     </spectrumList>
   </run>
 </mzML>
 """
 
-class _MaxlenDict(OrderedDict):
-    def __init__(self, *args, **kwargs):
-        self.maxlen = kwargs.pop('maxlen', None)
-        OrderedDict.__init__(self, *args, **kwargs)
+# number of spectra that are buffered before their XML is rendered
+XML_FLUSH_SIZE = 1024
+
+# approximate memory used by the slot of an entry in the OrderedDict of the m/z array cache of auto mode, in addition
+# to its key and value
+MZ_CACHE_SLOT_SIZE = 100
+
+MzCacheStats = namedtuple('MzCacheStats', ['unique_mz_arrays', 'hits', 'misses', 'evictions',
+                                           'bytes_written', 'bytes_saved', 'rewrites'])
+
+
+def _spectrum_record_dtype(mz_dtype, intensity_dtype, mobility_dtype):
+    """
+    Returns the structured dtype with the scalar fields of a spectrum. The statistics of the arrays are stored in the
+    dtypes of the arrays in the .ibd file, missing optional values as NaN.
+    """
+    return np.dtype([
+        ('x', np.int64), ('y', np.int64), ('z', np.int64), ('n_coords', np.uint8),
+        ('mz_offset', np.int64), ('mz_len', np.int64), ('mz_enc_len', np.int64),
+        ('int_offset', np.int64), ('int_len', np.int64), ('int_enc_len', np.int64),
+        ('mob_offset', np.int64), ('mob_len', np.int64), ('mob_enc_len', np.int64),
+        ('mz_min', mz_dtype), ('mz_max', mz_dtype), ('mz_base', mz_dtype),
+        ('int_base', intensity_dtype), ('int_tic', _tic_dtype(intensity_dtype)),
+        ('mob_min', mobility_dtype), ('mob_max', mobility_dtype),
+        ('mass_window_lower', mz_dtype), ('mass_window_upper', mz_dtype),
+        ('scan_start_time', np.float64), ('ms_level', np.int32), ('precursor_mz', np.float64),
+        ('isolation_window_lower_offset', np.float64), ('isolation_window_upper_offset', np.float64),
+    ])
+
+
+def _tic_dtype(intensity_dtype):
+    # the total ion current easily exceeds the range and precision of the intensities
+    return np.int64 if np.dtype(intensity_dtype).kind in 'iub' else np.float64
+
+
+def _total_ion_current(intensities, intensity_dtype, starts=None):
+    """
+    Sums the intensities as they are written to the .ibd file, or the spectra beginning at starts if given, in a
+    wider dtype. A single spectrum is summed with the same reduction as a batch, so that addSpectrum and addSpectra
+    write the same totals.
+    """
+    intensities = np.asarray(intensities).astype(intensity_dtype, copy=False)
+    if starts is None:
+        return np.add.reduceat(intensities, [0], dtype=_tic_dtype(intensity_dtype))[0]
+    return np.add.reduceat(intensities, starts, dtype=_tic_dtype(intensity_dtype))
+
+
+_OPTIONAL_FLOAT_FIELDS = ['scan_start_time', 'isolation_window_lower_offset', 'isolation_window_upper_offset']
+
+
+def _column_values(column):
+    # NumPy scalars of small floats are printed with their own precision, e.g. 100.1 instead of 100.0999984741211
+    if column.dtype.kind == 'f' and column.dtype.itemsize < 8:
+        return list(column)
+    return column.tolist()
+
+
+class _BackgroundWriter(object):
+    """
+    Writes buffers to a file and updates a hash with them on a background thread, so that the caller can encode the
+    next spectra in the meantime. Both file writes and hashing of large buffers release the GIL.
+
+    At most queue_size buffers wait to be written, which bounds the memory use if the disk is slower than the caller.
+    Errors of the background thread are raised by the next call to write or close.
+    """
+    def __init__(self, file, hash, queue_size=2):
+        self.file = file
+        self.hash = hash
+        self.queue = Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="pyimzml-ibd-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            bytes = self.queue.get()
+            if bytes is None:
+                return
+            try:
+                if self.error is None:
+                    self.file.write(bytes)
+                    self.hash.update(bytes)
+            except BaseException as e:
+                self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, bytes):
+        self._raise_error()
+        self.queue.put(bytes)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+
+def _encode(data, compression):
+    return compression.encode(data), data.shape[0]
+
+
+class _ArrayWrite(object):
+    """
+    An array that is compressed by the thread pool. Its (offset, length, encoded length) in the .ibd file is known
+    once it is written. In "auto" mode, all spectra that add the same mz array while it is pending share the object.
+    """
+    def __init__(self, future, shared=None):
+        self.future = future
+        self.location = None
+        # number of other spectra referring to this mz array, None for arrays that are not in the mz array cache
+        self.shared = shared
+
+    def done(self):
+        return self.location is not None or self.future.done()
+
+
+def _mz_cache_entry_size(digest, mz_data):
+    """
+    Returns the approximate memory in bytes used by an entry of the m/z array cache that maps digest to the disk
+    location mz_data.
+    """
+    return sys.getsizeof(digest) + sys.getsizeof(mz_data) + sum(sys.getsizeof(v) for v in mz_data) \
+        + MZ_CACHE_SLOT_SIZE
+
+
+def _concatenate_spectra(arrays):
+    """
+    Returns the values of a 2-D array or a list of arrays with one array per spectrum as one 1-D array, and the
+    number of values of every spectrum.
+    """
+    if isinstance(arrays, np.ndarray) and arrays.ndim == 2:
+        return arrays.ravel(), np.full(arrays.shape[0], arrays.shape[1], dtype=np.int64)
+    arrays = [np.asarray(a) for a in arrays]
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    return (np.concatenate(arrays) if arrays else np.zeros(0)), lengths
+
+
+def _segment_argmax(values, lengths):
+    """
+    Returns the index in values of the first maximum of every segment of the given lengths. Like np.argmax, this is
+    the first NaN of segments that contain NaNs.
+    """
+    starts = np.cumsum(lengths) - lengths
+    nans = np.isnan(values)
+    maxima = np.fmax.reduceat(values, starts)
+    has_nan = np.logical_or.reduceat(nans, starts)
+    candidates = np.flatnonzero(np.where(np.repeat(has_nan, lengths), nans, values == np.repeat(maxima, lengths)))
+    return candidates[np.searchsorted(candidates, starts)]
+
+
+class _SpectrumRecords(object):
+    """
+    Growable structured array with the scalar fields of the spectra whose XML has not been written yet.
+    Fields that are not scalars (filter strings, userParams, ...) are rarely set and kept in a dict by row.
+    """
+    def __init__(self, dtype, capacity=XML_FLUSH_SIZE):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.extras = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, n):
+        """
+        Makes room for n more records.
+        """
+        if self.size + n > len(self.data):
+            data = np.zeros(max(2 * len(self.data), self.size + n), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+    def append(self, record, extras=None):
+        """
+        :param record:
+            tuple of values in the order of the fields of the dtype
+        :param extras:
+            dict of non-scalar fields or None
+        """
+        self.reserve(1)
+        self.data[self.size] = record
+        if extras:
+            self.extras[self.size] = extras
+        self.size += 1
+
+    def extend(self, n, **columns):
+        """
+        Appends n records at once. Fields that are not given are 0, optional values NaN.
+        """
+        self.reserve(n)
+        rows = self.data[self.size:self.size + n]
+        rows[...] = 0
+        for name in _OPTIONAL_FLOAT_FIELDS + ['precursor_mz']:
+            rows[name] = np.nan
+        for name, values in columns.items():
+            rows[name] = values
+        self.size += n
+
+    def clear(self):
+        self.extras = {}
+        self.size = 0
+
+    def to_dicts(self):
+        """
+        Returns the records as the dicts used by the spectrum templates.
+        """
+        names = self.data.dtype.names
+        columns = {name: _column_values(self.data[name][:self.size]) for name in names}
+        for name in _OPTIONAL_FLOAT_FIELDS:
+            columns[name] = [None if v != v else v for v in columns[name]]
+        spectra = []
+        for i in range(self.size):
+            s = {name: columns[name][i] for name in names}
+            s["coords"] = (s["x"], s["y"], s["z"]) if s["n_coords"] == 3 else (s["x"], s["y"])
+            s["mass_window"] = (s["mass_window_lower"], s["mass_window_upper"])
+            if s["precursor_mz"] != s["precursor_mz"]:
+                del s["precursor_mz"]
+            s["userParams"] = []
+            s.update(self.extras.get(i, ()))
+            spectra.append(s)
+        return spectra
 
-    def __setitem__(self, key, value):
-        if self.maxlen is not None and len(self) >= self.maxlen:
-            self.popitem(0) #pop oldest
-        OrderedDict.__setitem__(self, key, value)
 
 class ImzMLWriter(object):
     """
@@ -537,7 +779,10 @@ class ImzMLWriter(object):
             * "auto" mode writes only mz arrays that have not already been written
         :param intensity_compression:
             How to compress the intensity data before saving
-            must be an instance of :class:`~pyimzml.compression.NoCompression` or :class:`~pyimzml.compression.ZlibCompression`
+            must be an instance of :class:`~pyimzml.compression.Compression`, e.g.
+            :class:`~pyimzml.compression.ZlibCompression`, :class:`~pyimzml.compression.ZstdCompression` or
+            :class:`~pyimzml.compression.NumpressSlofCompression`, or one of the strings "none", "zlib", "zstd" and
+            "lz4"
         :param mz_compression:
             How to compress the mz array data before saving
         :param mobility_compression:
@@ -553,6 +798,22 @@ class ImzMLWriter(object):
             int: The x dimension of the image in micrometers
         :param image_y_dimension:
             int: The y dimension of the image in micrometers
+        :param async_write:
+            bool: Whether to write the .ibd file and compute its SHA-1 checksum on a background thread, so that
+            writing to disk overlaps with the preparation of the next spectra
+        :param write_queue_size:
+            int: The number of encoded buffers that may wait to be written to disk if async_write is used
+        :param mz_cache_size:
+            int: The memory in bytes for remembering which mz arrays were already written in "auto" mode. Only the
+            digest and the location in the .ibd file of an array are remembered, about 300 bytes independent of its
+            length. If more distinct arrays occur, the least recently used ones are forgotten and written again
+            when they reoccur. To count these rewrites, the digests of as many recently forgotten arrays as the
+            cache holds are kept, which takes at most as much memory again.
+            None never forgets an array
+        :param compression_threads:
+            int: The number of threads that compress the arrays of addSpectrum in parallel. The arrays are copied
+            and written in the order of the addSpectrum calls, so the file does not depend on the number of threads.
+            None compresses on the calling thread
     """
     def __init__(self, output_filename,
                  mz_dtype=np.float64,
@@ -572,7 +833,11 @@ class ImzMLWriter(object):
                  mobility_info=None,
                  image_x_dimension = None,
                  image_y_dimension = None,
-                 xml_element_strings = {}):
+                 xml_element_strings = {},
+                 async_write=False,
+                 write_queue_size=2,
+                 mz_cache_size=64 * 2 ** 20,
+                 compression_threads=None):
 
         # Whether to include ion mobility data.
         self.include_mobility = include_mobility
@@ -593,6 +858,15 @@ class ImzMLWriter(object):
         self.xml = open(self.filename, 'w')
         self.ibd = open(self.ibd_filename, 'wb+')
         self.sha1 = hashlib.sha1()
+        # offset of the next write, the file position of self.ibd lags behind it if async_write is used
+        self.ibd_offset = 0
+        self.ibd_writer = _BackgroundWriter(self.ibd, self.sha1, write_queue_size) if async_write else None
+        # Spectra whose arrays are being compressed by the thread pool, in the order they were added. Each item is
+        # the record with placeholder offsets, its extras and a dict of _ArrayWrites by field prefix ('mz', 'int',
+        # 'mob').
+        self.pending = deque()
+        self.max_pending = 4 * compression_threads if compression_threads else 0
+        self.executor = ThreadPoolExecutor(compression_threads) if compression_threads else None
         self.uuid = uuid.uuid4()
         
         self.scan_direction = scan_direction
@@ -608,17 +882,35 @@ class ImzMLWriter(object):
         self._write_ibd(self.uuid.bytes)
 
         if self.include_mobility == False:
-            self.wheezy_engine = Engine(loader=DictLoader({'imzml': IMZML_TEMPLATE}), extensions=[CoreExtension()])
-            self.imzml_template = self.wheezy_engine.get_template('imzml')
+            self.wheezy_engine = Engine(loader=DictLoader({'imzml': IMZML_TEMPLATE,
+                                                           'spectrum': IMZML_SPECTRUM_TEMPLATE}),
+                                        extensions=[CoreExtension()])
         elif self.include_mobility == True:
-            self.wheezy_engine = Engine(loader=DictLoader({'imzml': IMZML_MOBILITY_TEMPLATE}),
+            self.wheezy_engine = Engine(loader=DictLoader({'imzml': IMZML_MOBILITY_TEMPLATE,
+                                                           'spectrum': IMZML_MOBILITY_SPECTRUM_TEMPLATE}),
                                         extensions=[CoreExtension()])
-            self.imzml_template = self.wheezy_engine.get_template('imzml')
+        self.imzml_template = self.wheezy_engine.get_template('imzml')
+        self.spectrum_template = self.wheezy_engine.get_template('spectrum')
         self.spectra_group = []
-        self.spectra = []
+        # The <spectrum> elements are streamed to a temporary file in batches of XML_FLUSH_SIZE spectra, so that
+        # only the scalar fields of the current batch are kept in memory. The header depends on all spectra and is
+        # written in front of them at close.
+        self.spectrum_xml = tempfile.TemporaryFile(mode='w+', dir=os.path.dirname(os.path.abspath(self.filename)))
+        self.records = _SpectrumRecords(_spectrum_record_dtype(mz_dtype, intensity_dtype, mobility_dtype))
+        self.spectrum_count = 0
+        self.max_x = self.max_y = 0
         self.first_mz = None
-        self.hashes = defaultdict(list)  # mz_hash -> list of mz_data (disk location)
-        self.lru_cache = _MaxlenDict(maxlen=10)  # mz_array (as tuple) -> mz_data (disk location)
+        # digest of the bytes of an mz array -> (mz_data (disk location), size of the entry in bytes), LRU first
+        self.mz_digests = OrderedDict()
+        self.mz_cache_size = mz_cache_size
+        self.mz_cache_bytes = 0
+        self.mz_cache_hits = 0
+        self.mz_cache_misses = 0
+        self.mz_cache_evictions = 0
+        self.mz_cache_rewrites = 0
+        self.mz_evicted = OrderedDict()  # keys of the most recently evicted digests, oldest first
+        self.mz_bytes_written = 0
+        self.mz_bytes_saved = 0
         self._setPolarity(polarity)
 
     @staticmethod
@@ -629,18 +921,13 @@ class ImzMLWriter(object):
             return "%s-bit integer" % dtype.__name__[3:]
         
     def compression_string_to_name(self, compression_input):
-        if compression_input in [NoCompression(), ZlibCompression()]:
-            compression_output = compression_input
+        if isinstance(compression_input, Compression):
+            return compression_input
         elif compression_input is None:
-            compression_output = NoCompression()
+            return NoCompression()
         elif type(compression_input) == str:
-            if compression_input.lower() in ["none", "no compression"]:
-                compression_output = NoCompression()
-            elif compression_input.lower() in ["zlib", "zlib compression"]:
-                compression_output = ZlibCompression()
-        else:
-            raise ValueError('The input for compression must be "None" or "zlib".')
-        return compression_output
+            return compression_from_string(compression_input)
+        raise ValueError('The input for compression must be "None", "zlib", "zstd" or "lz4".')
 
     def _setPolarity(self, polarity):
         if polarity:
@@ -651,8 +938,32 @@ class ImzMLWriter(object):
         else:
             self.polarity = ""
 
+    def _flush_spectra(self):
+        """
+        Renders the XML of the buffered spectra to the temporary spectrum file.
+        """
+        records = self.records
+        if not len(records):
+            return
+        data = records.data[:len(records)]
+        self.max_x = max(self.max_x, int(data["x"].max()))
+        self.max_y = max(self.max_y, int(data["y"].max()))
+        ms_levels, first_index = np.unique(data["ms_level"], return_index=True)
+        for ms_level in ms_levels[np.argsort(first_index)].tolist():
+            if ms_level not in self.ms_levels:
+                self.ms_levels.append(ms_level)
+
+        context = {}
+        if self.include_mobility == True:
+            context['mobility_unit'], context['mobility_unit_accession'] = self.mobility_info[2:]
+        first_index = self.spectrum_count - len(records)
+        for i, s in enumerate(records.to_dicts()):
+            context.update(index=first_index + i, s=s)
+            self.spectrum_xml.write(self.spectrum_template.render(context))
+        records.clear()
+
     def _write_xml(self):
-        spectra = self.spectra
+        self._flush_spectra()
         mz_data_type = self._np_type_to_name(self.mz_dtype)
         int_data_type = self._np_type_to_name(self.intensity_dtype)
         if self.include_mobility == True:
@@ -665,8 +976,6 @@ class ImzMLWriter(object):
                      "64-bit float": "1000523",
                      "continuous": "1000030",
                      "processed": "1000031",
-                     "zlib compression": "1000574",
-                     "no compression": "1000576",
                      "line_bottom_up": "1000492",
                      "line_left_right": "1000491",
                      "line_right_left": "1000490",
@@ -698,89 +1007,182 @@ class ImzMLWriter(object):
         sha1sum = self.sha1.hexdigest().upper()
         run_id = self.run_id
         if self.mode == 'auto':
-            mode = "processed" if len(self.lru_cache) > 1 else "continuous"
+            mode = "processed" if self.mz_cache_misses > 1 else "continuous"
         else:
             mode = self.mode
         spec_type = self.spec_type
-        mz_compression = self.mz_compression.name
-        int_compression = self.intensity_compression.name
+        mz_compression = self.mz_compression
+        int_compression = self.intensity_compression
         if self.include_mobility == True:
-            mob_compression = self.mobility_compression.name
+            mob_compression = self.mobility_compression
         polarity = self.polarity
         scan_direction = self.scan_direction
         scan_pattern = self.scan_pattern
         scan_type = self.scan_type
         line_scan_direction = self.line_scan_direction
 
-        ms_levels = [s["ms_level"] for s in spectra]
-        self.ms_levels = []
-        for ms_level in ms_levels:
-            if ms_level not in self.ms_levels:
-                self.ms_levels.append(ms_level)
         ms_levels = self.ms_levels
+        spectrum_count = self.spectrum_count
+        max_x = self.max_x
+        max_y = self.max_y
 
         image_x_dimension = self.image_x_dimension
         image_y_dimension = self.image_y_dimension
         if image_x_dimension is not None:
-            if max(s["coords"][0] for s in spectra) == 1:
+            if max_x == 1:
                 pixel_size_x = image_x_dimension
             else:
-                pixel_size_x = self.image_x_dimension/(max(s["coords"][0] for s in spectra)-1)
+                pixel_size_x = self.image_x_dimension/(max_x-1)
         else:
             pixel_size_x = None
         if image_y_dimension is not None:
-            if max(s["coords"][1] for s in spectra) == 1:
+            if max_y == 1:
                 pixel_size_y = image_y_dimension
             else:
-                pixel_size_y = self.image_y_dimension/(max(s["coords"][1] for s in spectra)-1)
+                pixel_size_y = self.image_y_dimension/(max_y-1)
         else:
             pixel_size_y = None
         xml_element_strings = self.xml_element_strings
-        self.spectra = spectra
         self.xml.write(self.imzml_template.render(locals()))
+        self.spectrum_xml.seek(0)
+        shutil.copyfileobj(self.spectrum_xml, self.xml)
+        self.spectrum_xml.close()
+        self.xml.write(IMZML_FOOTER)
 
     def _write_ibd(self, bytes):
-        self.ibd.write(bytes)
-        self.sha1.update(bytes)
+        if self.ibd_writer is not None:
+            self.ibd_writer.write(bytes)
+        else:
+            self.ibd.write(bytes)
+            self.sha1.update(bytes)
+        self.ibd_offset += len(bytes)
         return len(bytes)
 
     def _encode_and_write(self, data, dtype=np.float32, compression=NoCompression()):
+        self._write_pending()
         data = np.asarray(data, dtype=dtype)
-        offset = self.ibd.tell()
-        bytes = data.tobytes()
-        bytes = compression.compress(bytes)
+        offset = self.ibd_offset
+        bytes = compression.encode(data)
         return offset, data.shape[0], self._write_ibd(bytes)
 
-    def _read_mz(self, mz_offset, mz_len, mz_enc_len):
-        '''reads a mz array from the currently open ibd file'''
-        self.ibd.seek(mz_offset)
-        data = self.ibd.read(mz_enc_len)
-        self.ibd.seek(0, 2)
-        data = self.mz_compression.decompress(data)
-        return tuple(np.fromstring(data, dtype=self.mz_dtype))
+    def _schedule_write(self, jobs, prefix, data, dtype, compression):
+        """
+        Writes an array like _encode_and_write, or, if a thread pool is used, submits it for compression and adds
+        the _ArrayWrite to jobs. The returned offsets are placeholders in that case.
+        """
+        if self.executor is None:
+            return self._encode_and_write(data, dtype, compression)
+        # copy the data because the caller may reuse the array before it is compressed
+        jobs[prefix] = _ArrayWrite(self.executor.submit(_encode, np.array(data, dtype=dtype), compression))
+        return 0, 0, 0
 
-    def _get_previous_mz(self, mzs):
+    def _write_pending(self, max_pending=0):
+        """
+        Writes the compressed arrays of the pending spectra in order, until at most max_pending spectra are left.
+        Spectra whose compression is already done are written as well.
+        """
+        pending = self.pending
+        names = self.records.data.dtype.names
+        while len(pending) > max_pending or (pending and all(job.done() for job in pending[0][2].values())):
+            record, extras, jobs = pending.popleft()
+            for prefix, job in jobs.items():
+                # shared mz arrays are written by the first spectrum that refers to them
+                if job.location is None:
+                    bytes, length = job.future.result()
+                    job.location = self.ibd_offset, length, len(bytes)
+                    job.future = None
+                    self._write_ibd(bytes)
+                    if job.shared is not None:
+                        self.mz_bytes_written += len(bytes)
+                        self.mz_bytes_saved += job.shared * len(bytes)
+                i = names.index(prefix + '_offset')
+                record[i:i + 3] = job.location
+            self._add_record(tuple(record), extras)
+
+    def _add_record(self, record, extras):
+        self.records.append(record, extras)
+        self.spectrum_count += 1
+        if len(self.records) >= XML_FLUSH_SIZE:
+            self._flush_spectra()
+
+    def _get_previous_mz(self, mzs, n_spectra=1, jobs=None):
         '''given an mz array, return the mz_data (disk location)
-        if the mz array was not previously written, write to disk first'''
-        mzs = tuple(mzs)  # must be hashable
-        if mzs in self.lru_cache:
-            return self.lru_cache[mzs]
-
-        # mz not recognized ... check hash
-        mz_hash = "%s-%s-%s" % (hash(mzs), sum(mzs), len(mzs))
-        if mz_hash in self.hashes:
-            for mz_data in self.hashes[mz_hash]:
-                test_mz = self._read_mz(*mz_data)
-                if mzs == test_mz:
-                    self.lru_cache[test_mz] = mz_data
-                    return mz_data
-        # hash not recognized
-        # must be a new mz array ... write it, add it to lru_cache and hashes
-        mz_data = self._encode_and_write(mzs, self.mz_dtype, self.mz_compression)
-        self.hashes[mz_hash].append(mz_data)
-        self.lru_cache[mzs] = mz_data
+        if the mz array was not previously written, write to disk first
+        n_spectra is the number of spectra that share the array, all but the first one count as cache hits
+        if jobs is given and a thread pool is used, a new array is compressed by the pool like in _schedule_write
+        and the returned mz_data is a placeholder until it is written'''
+        # arrays are identical if they are stored with the same bytes, so compare 128-bit digests of the bytes
+        # instead of the arrays. A collision is far less likely than a bit flip on the disk
+        mzs = np.ascontiguousarray(mzs, dtype=self.mz_dtype)
+        digest = hashlib.blake2b(mzs, digest_size=16).digest()
+        mz_data, _ = self.mz_digests.get(digest, (None, None))
+        if mz_data is not None:
+            self.mz_digests.move_to_end(digest)
+            self.mz_cache_hits += n_spectra
+            if isinstance(mz_data, _ArrayWrite):
+                if mz_data.location is None and jobs is not None:
+                    mz_data.shared += n_spectra
+                    jobs['mz'] = mz_data
+                    return 0, 0, 0
+                if mz_data.location is None:
+                    self._write_pending()
+                mz_data = mz_data.location
+            self.mz_bytes_saved += n_spectra * mz_data[2]
+            return mz_data
+        # must be a new mz array ... write it and remember its location
+        self.mz_cache_misses += 1
+        self.mz_cache_hits += n_spectra - 1
+        if self.mz_cache_evictions and self._was_evicted(digest):
+            self.mz_cache_rewrites += 1
+        if jobs is not None and self.executor is not None:
+            # the statistics of the written bytes are updated once the array is written
+            entry = _ArrayWrite(self.executor.submit(_encode, mzs.copy(), self.mz_compression), n_spectra - 1)
+            jobs['mz'] = entry
+            # charged like the location it will hold, the pending array itself is bounded by max_pending
+            size = _mz_cache_entry_size(digest, (self.ibd_offset, len(mzs), mzs.nbytes))
+            mz_data = (0, 0, 0)
+        else:
+            mz_data = entry = self._encode_and_write(mzs, self.mz_dtype, self.mz_compression)
+            self.mz_bytes_written += mz_data[2]
+            self.mz_bytes_saved += (n_spectra - 1) * mz_data[2]
+            size = _mz_cache_entry_size(digest, mz_data)
+        self.mz_digests[digest] = entry, size
+        self.mz_cache_bytes += size
+        if self.mz_cache_size is not None and self.mz_cache_bytes > self.mz_cache_size:
+            while self.mz_digests and self.mz_cache_bytes > self.mz_cache_size:
+                self._evict(*self.mz_digests.popitem(last=False))
+            # remember as many evicted digests as the cache holds, i.e. count the rewrites that a cache of twice the
+            # size would avoid
+            while len(self.mz_evicted) > max(len(self.mz_digests), 1):
+                self.mz_evicted.popitem(last=False)
         return mz_data
 
+    def _evict(self, digest, cached):
+        _, size = cached
+        self.mz_cache_evictions += 1
+        self.mz_cache_bytes -= size
+        self.mz_evicted[int.from_bytes(digest[:8], 'little')] = None
+
+    def _was_evicted(self, digest):
+        key = int.from_bytes(digest[:8], 'little')
+        if key in self.mz_evicted:
+            # the array is cached again
+            del self.mz_evicted[key]
+            return True
+        return False
+
+    def mz_cache_stats(self):
+        """
+        Returns how well the mz arrays were deduplicated in "auto" mode as a MzCacheStats with the number of
+        distinct mz arrays in the cache, cache hits and misses (i.e. mz arrays written), evictions, the number
+        of bytes of mz arrays written to and saved in the .ibd file and the number of evicted mz arrays that
+        were written again. Waits for the arrays that are still being compressed, so that the byte counts are exact.
+        """
+        self._write_pending()
+        return MzCacheStats(len(self.mz_digests), self.mz_cache_hits, self.mz_cache_misses,
+                            self.mz_cache_evictions, self.mz_bytes_written, self.mz_bytes_saved,
+                            self.mz_cache_rewrites)
+
     def addSpectrum(self, mzs, intensities, coords, mobilities=None, precursor_mz = None, 
                     scan_start_time = None, ms_level = None, filter_string = None, 
                     isolation_window_offset = None, activation = None, mass_window = None,
@@ -822,31 +1224,34 @@ class ImzMLWriter(object):
         if self.mode != "continuous" or self.first_mz is None:
             mzs = self.mz_compression.rounding(mzs)
         intensities = self.intensity_compression.rounding(intensities)
-        if self.include_mobility == False:
+        if self.include_mobility == True:
             mobilities = self.mobility_compression.rounding(mobilities)
 
+        jobs = {}  # arrays that are compressed by the thread pool
         if self.mode == "continuous":
             if self.first_mz is None:
                 self.first_mz = self._encode_and_write(mzs, self.mz_dtype, self.mz_compression)
             mz_data = self.first_mz
         elif self.mode == "processed":
-            mz_data = self._encode_and_write(mzs, self.mz_dtype, self.mz_compression)
+            mz_data = self._schedule_write(jobs, 'mz', mzs, self.mz_dtype, self.mz_compression)
         elif self.mode == "auto":
-            mz_data = self._get_previous_mz(mzs)
+            mz_data = self._get_previous_mz(mzs, jobs=jobs)
         else:
             raise TypeError("Unknown mode: %s" % self.mode)
         mz_offset, mz_len, mz_enc_len = mz_data
 
-        int_offset, int_len, int_enc_len = self._encode_and_write(intensities, self.intensity_dtype, self.intensity_compression)
+        int_offset, int_len, int_enc_len = self._schedule_write(jobs, 'int', intensities, self.intensity_dtype,
+                                                                self.intensity_compression)
         if self.include_mobility == True:
-            mob_offset, mob_len, mob_enc_len = self._encode_and_write(mobilities, self.mobility_dtype, self.mobility_compression)
+            mob_offset, mob_len, mob_enc_len = self._schedule_write(jobs, 'mob', mobilities, self.mobility_dtype,
+                                                                    self.mobility_compression)
         
         mz_min = np.min(mzs)
         mz_max = np.max(mzs)
         ix_max = np.argmax(intensities)
         mz_base = mzs[ix_max]
         int_base = intensities[ix_max]
-        int_tic = np.sum(intensities)
+        int_tic = _total_ion_current(intensities, self.intensity_dtype)
         
         if mass_window is None:
             mass_window = (mz_min, mz_max)
@@ -858,12 +1263,8 @@ class ImzMLWriter(object):
                 ms_level = 2
             else:
                 ms_level = 1
-        s = dict(coords=coords, mz_len=mz_len, mz_offset=mz_offset, mz_enc_len=mz_enc_len, 
-                 int_len=int_len, int_offset=int_offset, int_enc_len=int_enc_len, 
-                 mz_min=mz_min, mz_max=mz_max, mz_base=mz_base, 
-                 int_base=int_base, int_tic=int_tic, activation=activation,
-                 scan_start_time=scan_start_time, ms_level=ms_level,
-                 filter_string=filter_string, mass_window=mass_window, userParams=userParams)
+        nan = np.nan
+        extras = {}
         if precursor_mz:
             if isolation_window_offset is None:
                 isolation_window_lower_offset, isolation_window_upper_offset = None, None
@@ -873,14 +1274,160 @@ class ImzMLWriter(object):
                     isolation_window_lower_offset, isolation_window_upper_offset = isolation_window_offset
                 except TypeError:
                     isolation_window_lower_offset, isolation_window_upper_offset = isolation_window_offset, isolation_window_offset            
-            s.update(precursor_mz=precursor_mz,
-                    isolation_window_lower_offset=isolation_window_lower_offset,
-                    isolation_window_upper_offset=isolation_window_upper_offset,
-                    precursor_element_string=precursor_element_string)
+            isolation_window_lower_offset, isolation_window_upper_offset = [
+                nan if offset is None else offset
+                for offset in (isolation_window_lower_offset, isolation_window_upper_offset)]
+            if precursor_element_string is not None:
+                extras.update(precursor_element_string=precursor_element_string)
+        else:
+            precursor_mz = isolation_window_lower_offset = isolation_window_upper_offset = nan
+        if activation is not None:
+            extras.update(activation=activation)
+        if filter_string:
+            extras.update(filter_string=filter_string)
+        if userParams:
+            extras.update(userParams=userParams)
+        if self.include_mobility == True:
+            mob_min, mob_max = np.min(mobilities), np.max(mobilities)
+        else:
+            mob_offset = mob_len = mob_enc_len = 0
+            mob_min = mob_max = nan
+        record = (coords[0], coords[1], coords[2] if len(coords) == 3 else 0, len(coords),
+                  mz_offset, mz_len, mz_enc_len, int_offset, int_len, int_enc_len,
+                  mob_offset, mob_len, mob_enc_len, mz_min, mz_max, mz_base, int_base, int_tic,
+                  mob_min, mob_max, mass_window[0], mass_window[1],
+                  nan if scan_start_time is None else scan_start_time, ms_level, precursor_mz,
+                  isolation_window_lower_offset, isolation_window_upper_offset)
+        if jobs:
+            self.pending.append((list(record), extras, jobs))
+            self._write_pending(self.max_pending)
+        else:
+            self._add_record(record, extras)
+
+    def _encode_and_write_spectra(self, data, lengths, dtype, compression):
+        """
+        Writes the concatenated arrays of many spectra with a single write.
+        Returns the offsets, lengths and encoded lengths of the arrays.
+        """
+        self._write_pending()
+        data = np.asarray(data, dtype=dtype)
+        offset = self.ibd_offset
+        if type(compression) is NoCompression:
+            enc_lengths = lengths * data.itemsize
+            self._write_ibd(data.tobytes())
+        else:
+            chunks = [compression.encode(array) for array in np.split(data, np.cumsum(lengths)[:-1])]
+            enc_lengths = np.array([len(chunk) for chunk in chunks], dtype=np.int64)
+            self._write_ibd(b''.join(chunks))
+        return offset + np.cumsum(enc_lengths) - enc_lengths, lengths, enc_lengths
+
+    def addSpectra(self, mzs, intensities, coords, mobilities=None, scan_start_times=None):
+        """
+        Add many MS1 spectra at once, e.g. a line of pixels.
+
+        The statistics of the spectra are computed with array operations over the whole batch and each kind of array
+        is written to the .ibd file with a single write. Use addSpectrum for MSn spectra and spectra with
+        per-spectrum metadata.
+
+        :param mzs:
+            * one mz array that is shared by all spectra OR
+            * 2-D array with one mz array per row OR
+            * list of mz arrays
+        :param intensities:
+            2-D array with one intensity array per row or list of intensity arrays
+        :param coords:
+            array of shape (number of spectra, 2) or (number of spectra, 3) with the x, y (and z) positions
+        :param mobilities:
+            2-D array with one mobility array per row or list of mobility arrays
+        :param scan_start_times:
+            array with the scan start time of every spectrum
+        """
+        coords = np.asarray(coords)
+        if coords.ndim != 2 or coords.shape[1] not in (2, 3):
+            raise ValueError("coords must have the shape (number of spectra, 2) or (number of spectra, 3)")
+        n = len(coords)
+        intensities, lengths = _concatenate_spectra(intensities)
+        if len(lengths) != n:
+            raise ValueError("Got %d intensity arrays for %d coordinates" % (len(lengths), n))
+        if n == 0:
+            return
+        if not np.all(lengths):
+            raise ValueError("Spectra must not be empty")
+        shared_mzs = (isinstance(mzs, np.ndarray) and mzs.ndim == 1) or \
+                     (not isinstance(mzs, np.ndarray) and len(mzs) > 0 and np.ndim(mzs[0]) == 0)
+        if shared_mzs:
+            mzs = np.asarray(mzs)
+            if not np.all(lengths == len(mzs)):
+                raise ValueError("All intensity arrays must have the length of the shared mz array")
+        else:
+            mzs, mz_lengths = _concatenate_spectra(mzs)
+            if not np.array_equal(mz_lengths, lengths):
+                raise ValueError("Each mz array must have the length of its intensity array")
+
+        # must be rounded now to allow comparisons to later data
+        # but don't waste CPU time in continuous mode since the data will not be used anyway
+        if self.mode != "continuous" or self.first_mz is None:
+            mzs = self.mz_compression.rounding(mzs)
+        intensities = self.intensity_compression.rounding(intensities)
+        if self.include_mobility == True:
+            mobilities, mob_lengths = _concatenate_spectra(mobilities)
+            if len(mob_lengths) != n or not np.all(mob_lengths):
+                raise ValueError("Every spectrum must have a non-empty mobility array")
+            mobilities = self.mobility_compression.rounding(mobilities)
+
+        if self.mode == "continuous":
+            if self.first_mz is None:
+                self.first_mz = self._encode_and_write(mzs if shared_mzs else mzs[:lengths[0]],
+                                                       self.mz_dtype, self.mz_compression)
+            mz_data = np.array([self.first_mz] * n).T
+        elif self.mode == "processed":
+            mz_data = self._encode_and_write_spectra(np.tile(mzs, n) if shared_mzs else mzs, lengths,
+                                                     self.mz_dtype, self.mz_compression)
+        elif self.mode == "auto":
+            if shared_mzs:
+                mz_data = np.array([self._get_previous_mz(mzs, n)] * n).T
+            else:
+                mz_data = np.array([self._get_previous_mz(array)
+                                    for array in np.split(mzs, np.cumsum(lengths)[:-1])]).T
+        else:
+            raise TypeError("Unknown mode: %s" % self.mode)
+        mz_offsets, mz_lens, mz_enc_lens = mz_data
+
+        int_offsets, int_lens, int_enc_lens = self._encode_and_write_spectra(
+            intensities, lengths, self.intensity_dtype, self.intensity_compression)
+
+        starts = np.cumsum(lengths) - lengths
+        ix_max = _segment_argmax(intensities, lengths)
+        if shared_mzs:
+            mz_min = np.repeat(np.min(mzs), n)
+            mz_max = np.repeat(np.max(mzs), n)
+            mz_base = mzs[ix_max - starts]
+        else:
+            mz_min = np.minimum.reduceat(mzs, starts)
+            mz_max = np.maximum.reduceat(mzs, starts)
+            mz_base = mzs[ix_max]
+        columns = dict(x=coords[:, 0], y=coords[:, 1], n_coords=coords.shape[1],
+                       mz_offset=mz_offsets, mz_len=mz_lens, mz_enc_len=mz_enc_lens,
+                       int_offset=int_offsets, int_len=int_lens, int_enc_len=int_enc_lens,
+                       mz_min=mz_min, mz_max=mz_max, mz_base=mz_base,
+                       int_base=intensities[ix_max],
+                       int_tic=_total_ion_current(intensities, self.intensity_dtype, starts),
+                       mass_window_lower=mz_min, mass_window_upper=mz_max, ms_level=1)
+        if coords.shape[1] == 3:
+            columns.update(z=coords[:, 2])
+        if scan_start_times is not None:
+            columns.update(scan_start_time=scan_start_times)
         if self.include_mobility == True:
-            s.update(mob_len=mob_len, mob_offset=mob_offset, mob_enc_len=mob_enc_len,
-                     mob_min=np.min(mobilities), mob_max=np.max(mobilities))
-        self.spectra.append(s)
+            mob_offsets, mob_lens, mob_enc_lens = self._encode_and_write_spectra(
+                mobilities, mob_lengths, self.mobility_dtype, self.mobility_compression)
+            mob_starts = np.cumsum(mob_lengths) - mob_lengths
+            columns.update(mob_offset=mob_offsets, mob_len=mob_lens, mob_enc_len=mob_enc_lens,
+                           mob_min=np.minimum.reduceat(mobilities, mob_starts),
+                           mob_max=np.maximum.reduceat(mobilities, mob_starts))
+        self.records.extend(n, **columns)
+        self.spectrum_count += n
+        if len(self.records) >= XML_FLUSH_SIZE:
+            self._flush_spectra()
 
     def close(self):  # 'close' is a more common use for this
         """
@@ -891,6 +1438,14 @@ class ImzMLWriter(object):
 
     def finish(self):
         '''alias of close()'''
+        if self.mz_cache_rewrites:
+            warn("%d mz arrays were written again after they were evicted from the mz array cache. "
+                 "Increase mz_cache_size to avoid this. %s" % (self.mz_cache_rewrites, self.mz_cache_stats()))
+        if self.executor is not None:
+            self._write_pending()
+            self.executor.shutdown()
+        if self.ibd_writer is not None:
+            self.ibd_writer.close()
         self.ibd.close()
         self._write_xml()
         self.xml.close()
@@ -902,7 +1457,15 @@ class ImzMLWriter(object):
         if exc_t is None:
             self.finish()
         else:
+            if self.executor is not None:
+                self.executor.shutdown()
+            if self.ibd_writer is not None:
+                try:
+                    self.ibd_writer.close()
+                except Exception:
+                    pass  # the exception that ended the with block is more relevant
             self.ibd.close()
+            self.spectrum_xml.close()
             self.xml.close()
 
 # def _main(argv):
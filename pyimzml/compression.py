@@ -1,13 +1,60 @@
+import importlib
 import zlib
 
-class NoCompression(object):
+import numpy as np
+
+from pyimzml import numpress
+
+# name of the userParam that marks binary data arrays compressed with a codec that has no CV term
+COMPRESSION_USER_PARAM = "pyimzml compression"
+
+# maps CV accessions and userParam values to the compression classes that handle them
+COMPRESSIONS = {}
+
+
+def _import_codec(module, extra):
     """
-    No compression.
+    Imports the module of an optional codec when it is first used, so that files which only declare the codec can
+    still be parsed without it.
     """
-    def __init__(self):
-        pass
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError('The %s package is required for this compression, e.g. "pip install pyimzML[%s]"'
+                          % (module.partition('.')[0], extra))
+
+
+def register_compression(cls):
+    """
+    Class decorator that makes a compression known to the parser. Compressions with a CV term are looked up by
+    their accession, all others by their user_param.
+    """
+    COMPRESSIONS[cls.user_param if cls.user_param is not None else cls.accession] = cls
+    return cls
+
+
+class Compression(object):
+    """
+    Base class of all compressions.
+
+    Subclasses implement compress and decompress on bytes. Arrays are converted with encode and decode, which apply
+    byte shuffling if the compression has shuffle set.
+
+    :param round_amt:
+        Number of digits after comma. None means no rounding.
+    """
+    accession = "MS:1000572"
+    name = "binary data compression type"
+    # identifies compressions without a CV term in the COMPRESSION_USER_PARAM of the written file
+    user_param = None
+    shuffle = False
+
+    def __init__(self, round_amt=None):
+        self.round_amt = round_amt
 
     def rounding(self, data):
+        if self.round_amt is not None:
+            return np.round(np.asarray(data, dtype=np.float64), self.round_amt)
         return data
 
     def compress(self, bytes):
@@ -16,9 +63,45 @@ class NoCompression(object):
     def decompress(self, bytes):
         return bytes
 
+    def encode(self, data):
+        """
+        Converts a NumPy array into the bytes that are written to the .ibd file.
+        """
+        bytes = data.tobytes()
+        if self.shuffle:
+            bytes = _shuffle(bytes, data.dtype.itemsize)
+        return self.compress(bytes)
+
+    def decode(self, bytes, dtype):
+        """
+        Converts bytes read from the .ibd file back into a NumPy array of the given dtype.
+        """
+        bytes = self.decompress(bytes)
+        if self.shuffle:
+            bytes = _unshuffle(bytes, np.dtype(dtype).itemsize)
+        return np.frombuffer(bytes, dtype=dtype)
+
+    @property
+    def user_param_value(self):
+        if self.user_param is None:
+            return None
+        return self.user_param + ("+shuffle" if self.shuffle else "")
+
+
+@register_compression
+class NoCompression(Compression):
+    """
+    No compression.
+    """
+    accession = "MS:1000576"
     name = "no compression"
 
-class ZlibCompression(object):
+    def __init__(self):
+        self.round_amt = None
+
+
+@register_compression
+class ZlibCompression(Compression):
     """
     Zlib compression with optional rounding of values.
     Rounding helps the compression, but is lossy.
@@ -26,13 +109,8 @@ class ZlibCompression(object):
     :param round_amt:
         Number of digits after comma. None means no rounding.
     """
-    def __init__(self, round_amt=None):
-        self.round_amt = round_amt
-
-    def rounding(self, data):
-        if self.round_amt is not None:
-            return [round(x, self.round_amt) for x in data]
-        return data
+    accession = "MS:1000574"
+    name = "zlib compression"
 
     def compress(self, bytes):
         return zlib.compress(bytes)
@@ -40,4 +118,208 @@ class ZlibCompression(object):
     def decompress(self, bytes):
         return zlib.decompress(bytes)
 
-    name = "zlib compression"
+
+@register_compression
+class ZstdCompression(Compression):
+    """
+    Zstandard compression with optional byte shuffling and rounding of values. Requires the zstandard package,
+    e.g. ``pip install pyimzML[zstd]``.
+
+    There is no CV term for zstd, so the arrays are marked with a userParam and can only be read by pyimzML.
+
+    :param round_amt:
+        Number of digits after comma. None means no rounding.
+    :param level:
+        zstd compression level
+    :param shuffle:
+        Whether to group the n-th bytes of all values together before compressing, like Blosc does. This makes
+        slowly changing floating point values compress much better
+    """
+    user_param = "zstd"
+
+    def __init__(self, round_amt=None, level=3, shuffle=True):
+        self.round_amt = round_amt
+        self.level = level
+        self.shuffle = shuffle
+
+    def compress(self, bytes):
+        return _import_codec('zstandard', 'zstd').ZstdCompressor(level=self.level).compress(bytes)
+
+    def decompress(self, bytes):
+        return _import_codec('zstandard', 'zstd').ZstdDecompressor().decompress(bytes)
+
+
+@register_compression
+class Lz4Compression(Compression):
+    """
+    LZ4 frame compression with optional byte shuffling and rounding of values. Requires the lz4 package,
+    e.g. ``pip install pyimzML[lz4]``.
+
+    There is no CV term for LZ4, so the arrays are marked with a userParam and can only be read by pyimzML.
+
+    :param round_amt:
+        Number of digits after comma. None means no rounding.
+    :param shuffle:
+        Whether to group the n-th bytes of all values together before compressing, like Blosc does
+    """
+    user_param = "lz4"
+
+    def __init__(self, round_amt=None, shuffle=True):
+        self.round_amt = round_amt
+        self.shuffle = shuffle
+
+    def compress(self, bytes):
+        return _import_codec('lz4.frame', 'lz4').compress(bytes)
+
+    def decompress(self, bytes):
+        return _import_codec('lz4.frame', 'lz4').decompress(bytes)
+
+
+@register_compression
+class NumpressLinearCompression(Compression):
+    """
+    MS-Numpress linear prediction compression, meant for m/z arrays. The values are stored as fixed point integers
+    and only their deviations from a linear extrapolation of the previous two values are encoded. Lossy.
+
+    :param fixed_point:
+        Scaling factor of the fixed point integers, i.e. the values are stored with an absolute precision of
+        0.5 / fixed_point. None chooses the largest fixed point that does not overflow for each array.
+    """
+    accession = "MS:1002312"
+    name = "MS-Numpress linear prediction compression"
+
+    def __init__(self, fixed_point=None):
+        self.round_amt = None
+        self.fixed_point = fixed_point
+
+    def encode(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        fixed_point = self.fixed_point
+        if fixed_point is None:
+            fixed_point = numpress.optimal_linear_fixed_point(data)
+        return self.compress(numpress.encode_linear(data, fixed_point))
+
+    def decode(self, bytes, dtype):
+        return numpress.decode_linear(self.decompress(bytes)).astype(dtype)
+
+
+@register_compression
+class NumpressPicCompression(Compression):
+    """
+    MS-Numpress positive integer compression, meant for ion counts. The values are rounded to integers. Lossy.
+    """
+    accession = "MS:1002313"
+    name = "MS-Numpress positive integer compression"
+
+    def __init__(self):
+        self.round_amt = None
+
+    def encode(self, data):
+        return self.compress(numpress.encode_pic(data))
+
+    def decode(self, bytes, dtype):
+        return numpress.decode_pic(self.decompress(bytes)).astype(dtype)
+
+
+@register_compression
+class NumpressSlofCompression(Compression):
+    """
+    MS-Numpress short logged float compression, meant for intensity arrays. log(x + 1) of the values is stored as
+    16-bit fixed point integers. Lossy.
+
+    :param fixed_point:
+        Scaling factor of the fixed point integers. None chooses the largest fixed point that does not overflow for
+        each array.
+    """
+    accession = "MS:1002314"
+    name = "MS-Numpress short logged float compression"
+
+    def __init__(self, fixed_point=None):
+        self.round_amt = None
+        self.fixed_point = fixed_point
+
+    def encode(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        fixed_point = self.fixed_point
+        if fixed_point is None:
+            fixed_point = numpress.optimal_slof_fixed_point(data)
+        return self.compress(numpress.encode_slof(data, fixed_point))
+
+    def decode(self, bytes, dtype):
+        return numpress.decode_slof(self.decompress(bytes)).astype(dtype)
+
+
+@register_compression
+class NumpressLinearZlibCompression(NumpressLinearCompression, ZlibCompression):
+    """
+    MS-Numpress linear prediction compression followed by zlib compression.
+    """
+    accession = "MS:1002746"
+    name = "MS-Numpress linear prediction compression followed by zlib compression"
+
+
+@register_compression
+class NumpressPicZlibCompression(NumpressPicCompression, ZlibCompression):
+    """
+    MS-Numpress positive integer compression followed by zlib compression.
+    """
+    accession = "MS:1002747"
+    name = "MS-Numpress positive integer compression followed by zlib compression"
+
+
+@register_compression
+class NumpressSlofZlibCompression(NumpressSlofCompression, ZlibCompression):
+    """
+    MS-Numpress short logged float compression followed by zlib compression.
+    """
+    accession = "MS:1002748"
+    name = "MS-Numpress short logged float compression followed by zlib compression"
+
+
+def compression_from_string(name):
+    """
+    Returns the compression for a name such as "none", "zlib", "zstd" or "lz4", or one of the CV term names.
+    """
+    name = name.lower()
+    if name in ["none", "no compression"]:
+        return NoCompression()
+    elif name in ["zlib", "zlib compression"]:
+        return ZlibCompression()
+    elif name in ["zstd", "lz4"]:
+        return COMPRESSIONS[name]()
+    raise ValueError('The input for compression must be "None", "zlib", "zstd" or "lz4".')
+
+
+def compression_from_param_group(param_group):
+    """
+    Returns the compression of the binary data arrays described by a referenceableParamGroup.
+    """
+    for name, _, value, *_ in param_group.user_params:
+        if name == COMPRESSION_USER_PARAM:
+            user_param, _, options = str(value).partition("+")
+            if user_param not in COMPRESSIONS:
+                raise ValueError('Unsupported compression "%s"' % value)
+            compression = COMPRESSIONS[user_param]()
+            compression.shuffle = options == "shuffle"
+            return compression
+    for key, cls in COMPRESSIONS.items():
+        if cls.user_param is None and key in param_group:
+            return cls()
+    return NoCompression()
+
+
+def _shuffle(bytes, itemsize):
+    """
+    Groups the first bytes of all values together, followed by all second bytes, and so on.
+    """
+    data = np.frombuffer(bytes, dtype=np.uint8)
+    if itemsize <= 1 or len(data) % itemsize:
+        return bytes
+    return data.reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle(bytes, itemsize):
+    data = np.frombuffer(bytes, dtype=np.uint8)
+    if itemsize <= 1 or len(data) % itemsize:
+        return bytes
+    return data.reshape(itemsize, -1).T.tobytes()
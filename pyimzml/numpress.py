@@ -0,0 +1,176 @@
+"""
+Vectorized implementation of the MS-Numpress codecs (https://github.com/ms-numpress/ms-numpress).
+
+The byte layout is identical to the reference implementation, so arrays encoded here can be decoded by any other
+MS-Numpress implementation and vice versa:
+
+* linear prediction: the fixed point as a big-endian double, the first two values as 32-bit little-endian integers
+  and the difference of every further value to the linear extrapolation of the previous two as variable-length
+  integers.
+* positive integer: all values rounded to integers and stored as variable-length integers.
+* short logged float: the fixed point as a big-endian double and log(x + 1) of every value as 16-bit little-endian
+  integers.
+
+Variable-length integers are stored as half-bytes (nibbles): a header nibble holding the number of leading zero
+nibbles (or 8 + the number of leading 0xf nibbles for negative numbers), followed by the remaining nibbles with the
+least significant one first. The last byte is padded with a zero nibble if needed.
+"""
+import struct
+
+import numpy as np
+
+_INT32_MAX = 0x7FFFFFFF
+
+
+def optimal_linear_fixed_point(data):
+    """
+    Returns the largest fixed point for encode_linear for which no integer of the encoding overflows.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return 0.
+    if len(data) == 1:
+        return np.floor(_INT32_MAX / data[0])
+    max_double = max(data[0], data[1])
+    if len(data) > 2:
+        extrapolations = data[1:-1] + (data[1:-1] - data[:-2])
+        max_double = max(max_double, np.ceil(np.abs(data[2:] - extrapolations) + 1).max())
+    return np.floor(_INT32_MAX / max_double)
+
+
+def optimal_slof_fixed_point(data):
+    """
+    Returns the largest fixed point for encode_slof for which no value of the encoding overflows.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    max_double = max(1., np.log(data + 1).max()) if len(data) else 1.
+    return np.floor(0xFFFF / max_double)
+
+
+def encode_linear(data, fixed_point):
+    """
+    Encodes an array of increasing values, e.g. m/z values, with MS-Numpress linear prediction.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    ints = (data * fixed_point + 0.5).astype(np.int64)
+    diffs = ints[2:] - 2 * ints[1:-1] + ints[:-2]
+    if len(diffs) and (diffs.max() > _INT32_MAX or diffs.min() < -_INT32_MAX - 1):
+        raise ValueError("Fixed point %s is too large for linear prediction of the data" % fixed_point)
+    return (_encode_fixed_point(fixed_point) + (ints[:2] & 0xFFFFFFFF).astype('<u4').tobytes()
+            + _pack_nibbles(_encode_ints(diffs)))
+
+
+def decode_linear(bytes):
+    fixed_point = _decode_fixed_point(bytes)
+    n_first = min(2, (len(bytes) - 8) // 4)
+    ints = np.frombuffer(bytes, dtype='<u4', count=n_first, offset=8).astype(np.int64)
+    if n_first == 2:
+        diffs = _decode_ints(_unpack_nibbles(bytes, 16)).view(np.int32)
+        # every value is the linear extrapolation of the previous two plus its diff, so the diffs are the second
+        # differences of the values and two cumulative sums restore them
+        steps = ints[1] - ints[0] + np.cumsum(diffs, dtype=np.int64)
+        ints = np.concatenate([ints, ints[1] + np.cumsum(steps)])
+    return ints / fixed_point
+
+
+def encode_pic(data):
+    """
+    Encodes an array of non-negative values, e.g. ion counts, with MS-Numpress positive integer compression.
+    The values are rounded to integers.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) and (data.min() < 0 or data.max() + 0.5 > 0xFFFFFFFF):
+        raise ValueError("Positive integer compression can only encode values between 0 and 2**32 - 1")
+    return _pack_nibbles(_encode_ints((data + 0.5).astype(np.int64)))
+
+
+def decode_pic(bytes):
+    return _decode_ints(_unpack_nibbles(bytes, 0)).astype(np.float64)
+
+
+def encode_slof(data, fixed_point):
+    """
+    Encodes an array of non-negative values, e.g. intensities, with MS-Numpress short logged float compression.
+    """
+    logs = np.log(np.asarray(data, dtype=np.float64) + 1) * fixed_point
+    if len(logs) and (np.nanmin(logs) < 0 or np.nanmax(logs) > 0xFFFF):
+        raise ValueError("Fixed point %s is too large for short logged float compression of the data"
+                         % fixed_point)
+    return _encode_fixed_point(fixed_point) + (logs + 0.5).astype('<u2').tobytes()
+
+
+def decode_slof(bytes):
+    fixed_point = _decode_fixed_point(bytes)
+    return np.exp(np.frombuffer(bytes, dtype='<u2', offset=8) / fixed_point) - 1
+
+
+def _encode_fixed_point(fixed_point):
+    return struct.pack('>d', fixed_point)
+
+
+def _decode_fixed_point(bytes):
+    if len(bytes) < 8:
+        raise ValueError("MS-Numpress data is shorter than its fixed point")
+    return struct.unpack_from('>d', bytes, 0)[0]
+
+
+def _encode_ints(ints):
+    """
+    Encodes integers, interpreted as unsigned 32-bit numbers, as a sequence of variable-length nibble tokens.
+    """
+    ints = np.asarray(ints, dtype=np.int64) & 0xFFFFFFFF
+    # column k holds the k-th least significant nibble
+    nibbles = (ints[:, None] >> (4 * np.arange(8))) & 0xF
+    is_negative = nibbles[:, 7] == 0xF
+    is_positive = nibbles[:, 7] == 0
+    significant = np.where(is_negative[:, None], nibbles != 0xF, nibbles != 0)
+    highest = np.where(significant.any(axis=1), 7 - np.argmax(significant[:, ::-1], axis=1), -1)
+    # leading 0 (or 0xf) nibbles that are implied by the header. Numbers with any other leading nibble are stored
+    # in full, and at least one nibble of negative numbers is stored
+    n_leading = np.where(is_positive, 7 - highest, np.where(is_negative, np.minimum(7 - highest, 7), 0))
+    tokens = np.empty((len(ints), 9), dtype=np.uint8)
+    tokens[:, 0] = np.where(is_negative, n_leading + 8, n_leading)
+    tokens[:, 1:] = nibbles
+    return tokens[np.arange(9) <= (8 - n_leading)[:, None]]
+
+
+def _decode_ints(nibbles):
+    """
+    Decodes a sequence of nibble tokens written by _encode_ints into an array of unsigned 32-bit integers.
+    """
+    n = len(nibbles)
+    heads = nibbles.astype(np.int64)
+    n_leading = np.where(heads <= 8, heads, heads - 8)
+    # Locate the token headers by following the chain of token lengths from the first nibble. Pointer doubling
+    # (jump[p] is the position 2**k tokens after p in iteration k) finds all of them in log2(n) vectorized steps.
+    jump = np.append(np.minimum(np.arange(n) + 9 - n_leading, n), n)
+    starts = np.zeros(1 if n else 0, dtype=np.int64)
+    while len(starts) and starts[-1] < n:
+        starts = np.concatenate([starts, jump[starts]])
+        jump = jump[jump]
+    starts = starts[starts < n]
+    # a token that does not fit is the zero nibble that pads the last byte
+    starts = starts[starts + 9 - n_leading[starts] <= n]
+
+    n_stored = 8 - n_leading[starts]
+    padded = np.append(nibbles, np.zeros(8, dtype=nibbles.dtype)).astype(np.int64)
+    stored = padded[starts[:, None] + 1 + np.arange(8)]
+    stored[np.arange(8) >= n_stored[:, None]] = 0
+    ints = (stored << (4 * np.arange(8))).sum(axis=1)
+    is_negative = heads[starts] > 8
+    ints[is_negative] |= (0xFFFFFFFF << (4 * n_stored[is_negative])) & 0xFFFFFFFF
+    return ints.astype(np.uint32)
+
+
+def _pack_nibbles(nibbles):
+    if len(nibbles) % 2:
+        nibbles = np.append(nibbles, 0)
+    return ((nibbles[0::2] << 4) | nibbles[1::2]).astype(np.uint8).tobytes()
+
+
+def _unpack_nibbles(bytes, offset):
+    data = np.frombuffer(bytes, dtype=np.uint8, offset=offset)
+    nibbles = np.empty(2 * len(data), dtype=np.uint8)
+    nibbles[0::2] = data >> 4
+    nibbles[1::2] = data & 0xF
+    return nibbles
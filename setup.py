@@ -38,4 +38,9 @@ Python 3.3 or newer is recommended for performance reasons.""",
     packages=find_packages(exclude=('tests', 'docs')),
 
     install_requires=['numpy', 'wheezy.template'],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'sparse': ['scipy'],
+    },
 )
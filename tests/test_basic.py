@@ -1,9 +1,35 @@
+import gzip
+import hashlib
+import os
 import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import mock
 
 import numpy as np
 from pathlib import Path
+try:
+    import scipy
+except ImportError:
+    scipy = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4
+except ImportError:
+    lz4 = None
 from .context import getspectrum
+import pyimzml.compression as compression
+import pyimzml.numpress as numpress
 import pyimzml.ImzMLParser as imzmlp
 import pyimzml.ImzMLWriter as imzmlw
 
@@ -12,7 +38,7 @@ CONTINUOUS_IMZML_PATH = str(Path(__file__).parent / 'data/Example_Continuous.imz
 CONTINUOUS_IBD_PATH = str(Path(__file__).parent / 'data/Example_Continuous.ibd')
 PROCESSED_IMZML_PATH = str(Path(__file__).parent / 'data/Example_Processed.imzML')
 PROCESSED_IBD_PATH = str(Path(__file__).parent / 'data/Example_Processed.ibd')
-PARSE_LIB_TEST_CASES = ['lxml', 'ElementTree']
+PARSE_LIB_TEST_CASES = ['lxml', 'ElementTree', 'fast']
 DATA_TEST_CASES = [
     ('Continuous', CONTINUOUS_IMZML_PATH, CONTINUOUS_IBD_PATH),
     ('Processed', PROCESSED_IMZML_PATH, PROCESSED_IBD_PATH),
@@ -22,6 +48,32 @@ ALL_TEST_CASES = [(parse_lib, data_name, imzml_path, ibd_path)
                   for data_name, imzml_path, ibd_path in DATA_TEST_CASES]
 
 
+
+def _spectrum_summary(mzs, intensities):
+    # module-level, so that it can be pickled for ImzMLParser.map_spectra
+    return len(mzs), float(intensities.sum())
+
+
+class _BlockingZlibCompression(compression.ZlibCompression):
+    # keeps the arrays of ImzMLWriter pending until released (or for at most 10 s, so that failures do not hang)
+    def __init__(self, released):
+        super(_BlockingZlibCompression, self).__init__()
+        self.released = released
+
+    def compress(self, bytes):
+        self.released.wait(10)
+        return super(_BlockingZlibCompression, self).compress(bytes)
+
+
+class _PickleBomb(object):
+    def __reduce__(self):
+        return (_unpickled, ())
+
+
+def _unpickled():
+    raise AssertionError("the index cache must not be unpickled")
+
+
 class ImzMLParser(unittest.TestCase):
     def test_bisect(self):
         mzs = [100., 201.89, 201.99, 202.0, 202.01, 202.10000001, 400.]
@@ -53,6 +105,422 @@ class ImzMLParser(unittest.TestCase):
                 assert np.all(ints < 3.0)
 
 
+    def test_getspectrum_mmap(self):
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            with self.subTest(parse_lib=parse_lib, data=data_name),\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib) as parser,\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib, use_mmap=True) as mmap_parser:
+
+                for i in range(len(parser.coordinates)):
+                    mzs, ints = parser.getspectrum(i)
+                    mmap_mzs, mmap_ints = mmap_parser.getspectrum(i)
+                    assert np.all(mzs == mmap_mzs)
+                    assert np.all(ints == mmap_ints)
+                    assert not mmap_ints.flags.writeable
+                assert parser.get_spectrum_as_string(4) == mmap_parser.get_spectrum_as_string(4)
+
+        # arrays returned from an in-memory .ibd file do not keep the caller's BytesIO from being closed
+        with open(PROCESSED_IBD_PATH, 'rb') as ibd_file:
+            ibd_bytes = BytesIO(ibd_file.read())
+        with imzmlp.ImzMLParser(PROCESSED_IMZML_PATH, ibd_file=ibd_bytes, use_mmap=True) as mmap_parser:
+            mzs, ints = mmap_parser.getspectrum(4)
+        assert ibd_bytes.closed
+        with imzmlp.ImzMLParser(PROCESSED_IMZML_PATH) as parser:
+            assert np.array_equal(ints, parser.getspectrum(4)[1])
+
+    def test_index_arrays(self):
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            with self.subTest(parse_lib=parse_lib, data=data_name),\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib) as parser:
+
+                assert parser.coordinates.shape == (9, 3)
+                assert parser.coordinates.dtype == np.int32
+                assert tuple(parser.coordinates[0]) == (1, 1, 1)
+                assert parser.mzOffsets.dtype == np.int64
+                assert parser.intensityOffsets.dtype == np.int64
+                assert parser.mzLengths.dtype == np.uint32
+                assert parser.intensityLengths.dtype == np.uint32
+                assert np.all(parser.intensityLengths == 8399)
+
+    def test_fast_index_matches_tree_parser(self):
+        for data_name, imzml_path, ibd_path in DATA_TEST_CASES:
+            with self.subTest(data=data_name),\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib='ElementTree') as tree_parser,\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib='fast') as fast_parser:
+
+                for name in ['coordinates', 'mzOffsets', 'mzLengths', 'intensityOffsets', 'intensityLengths']:
+                    assert np.array_equal(getattr(fast_parser, name), getattr(tree_parser, name)), name
+                    assert getattr(fast_parser, name).dtype == getattr(tree_parser, name).dtype, name
+                assert fast_parser.polarity == tree_parser.polarity
+                assert fast_parser.imzmldict == tree_parser.imzmldict
+
+    def test_parallel_fast_index(self):
+        min_chunk_size = imzmlp.MIN_INDEX_CHUNK_SIZE
+        imzmlp.MIN_INDEX_CHUNK_SIZE = 1000
+        try:
+            for data_name, imzml_path, ibd_path in DATA_TEST_CASES:
+                with self.subTest(data=data_name),\
+                     imzmlp.ImzMLParser(imzml_path, parse_lib='ElementTree') as tree_parser,\
+                     imzmlp.ImzMLParser(imzml_path, parse_lib='fast', index_processes=2) as parallel_parser:
+
+                    for name in ['coordinates', 'mzOffsets', 'mzLengths', 'intensityOffsets', 'intensityLengths']:
+                        assert np.array_equal(getattr(parallel_parser, name), getattr(tree_parser, name)), name
+        finally:
+            imzmlp.MIN_INDEX_CHUNK_SIZE = min_chunk_size
+
+    def test_split_spectrum_ranges(self):
+        spectra = b''.join(b'<spectrum index="%d"></spectrum>' % i for i in range(100))
+        buf = b'<spectrumList>' + spectra + b'</spectrumList>'
+        start, end = len(b'<spectrumList>'), len(buf) - len(b'</spectrumList>')
+        min_chunk_size = imzmlp.MIN_INDEX_CHUNK_SIZE
+        imzmlp.MIN_INDEX_CHUNK_SIZE = 100
+        try:
+            ranges = imzmlp._split_spectrum_ranges(buf, start, end, 8)
+        finally:
+            imzmlp.MIN_INDEX_CHUNK_SIZE = min_chunk_size
+        assert len(ranges) == 8
+        assert ranges[0][0] == start and ranges[-1][1] == end
+        for (_, prev_end), (next_start, _) in zip(ranges[:-1], ranges[1:]):
+            assert prev_end == next_start
+            assert buf[next_start:next_start + 10] == b'<spectrum '
+        assert imzmlp._split_spectrum_ranges(buf, start, end, 8) == [(start, end)]
+
+    def test_scan_spectrum_index(self):
+        xml = (b'<spectrum index="0"><referenceableParamGroupRef ref="spectrum1"/><scanList><scan>'
+               b'<cvParam accession="IMS:1000050" name="position x" value="3"/>'
+               b'<cvParam value="7" accession="IMS:1000051" name="position y"/></scan></scanList>'
+               b'<binaryDataArray><referenceableParamGroupRef ref="mzArray"/>'
+               b'<cvParam accession="IMS:1000103" value="5"/><cvParam accession="IMS:1000102" value="16"/>'
+               b'</binaryDataArray><binaryDataArray><referenceableParamGroupRef ref="intensityArray"/>'
+               b'<cvParam accession="IMS:1000102" value="-36"/><cvParam accession="IMS:1000103" value="5"/>'
+               b'<cvParam accession="IMS:1000104" value="13"/></binaryDataArray></spectrum>')
+        offsets, lengths, encoded_lengths, coordinates = imzmlp._scan_spectrum_index(
+            xml * 2, 0, 2 * len(xml), ['mzArray', 'intensityArray'])
+        assert list(offsets[0]) == [16, 16]
+        assert list(offsets[1]) == [-36, -36]
+        assert list(lengths[1]) == [5, 5]
+        assert list(encoded_lengths[0]) == [-1, -1]
+        assert list(encoded_lengths[1]) == [13, 13]
+        assert list(coordinates) == [3, 7, 1, 3, 7, 1]
+
+        # single-quoted attributes are valid XML, too
+        single_quoted = xml.replace(b'"', b"'")
+        assert imzmlp._scan_spectrum_index(single_quoted, 0, len(single_quoted), ['mzArray', 'intensityArray']) \
+            == imzmlp._scan_spectrum_index(xml, 0, len(xml), ['mzArray', 'intensityArray'])
+
+    def test_fix_offsets(self):
+        offsets = [2**31 - 10, -2**31 + 6, -10, 6]
+        fixed = imzmlp._fix_offsets(offsets)
+        assert list(fixed) == [2**31 - 10, 2**31 + 6, 2**32 - 10, 2**32 + 6]
+
+    def test_index_cache(self):
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            with self.subTest(parse_lib=parse_lib, data=data_name),\
+                 tempfile.TemporaryDirectory() as cache_dir,\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib) as parser:
+
+                with imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib, index_cache=cache_dir) as first_parser:
+                    assert np.all(first_parser.coordinates == parser.coordinates)
+                cache_files = list(Path(cache_dir).glob('*.idx'))
+                assert len(cache_files) == 1
+
+                with mock.patch.object(imzmlp.ImzMLParser, '_ImzMLParser__iter_read_spectrum_meta',
+                                       side_effect=AssertionError("the .imzML must not be parsed again")), \
+                        imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib, index_cache=cache_dir) as cached_parser:
+                    assert np.all(cached_parser.coordinates == parser.coordinates)
+                    assert np.all(cached_parser.mzOffsets == parser.mzOffsets)
+                    assert np.all(cached_parser.intensityLengths == parser.intensityLengths)
+                    assert cached_parser.polarity == parser.polarity
+                    assert cached_parser.mzPrecision == parser.mzPrecision
+                    assert cached_parser.imzmldict == parser.imzmldict
+                    assert cached_parser.metadata.pretty() == parser.metadata.pretty()
+                    assert np.all(cached_parser.getspectrum(4)[1] == parser.getspectrum(4)[1])
+
+                # stale, partial, corrupt and pickled sidecars are ignored and rebuilt without unpickling them
+                with np.load(str(cache_files[0])) as npz:
+                    cache = dict(npz)
+                sidecars = [dict(cache, key=np.zeros(3, dtype=np.int64)),
+                            dict(cache, uuid=np.array('{00000000-0000-0000-0000-000000000000}')),
+                            {name: cache[name] for name in ['version', 'key', 'uuid', 'header', 'polarity']},
+                            {'version': cache['version']}]
+                for sidecar in sidecars + [b'corrupt', _PickleBomb()]:
+                    with open(str(cache_files[0]), 'wb') as f:
+                        if isinstance(sidecar, dict):
+                            np.savez(f, **sidecar)
+                        elif isinstance(sidecar, bytes):
+                            f.write(sidecar)
+                        else:
+                            pickle.dump(sidecar, f)
+                    with imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib, index_cache=cache_dir) as rebuilt_parser:
+                        assert np.all(rebuilt_parser.coordinates == parser.coordinates)
+                        assert np.all(rebuilt_parser.intensityOffsets == parser.intensityOffsets)
+
+    def test_index_cache_regenerated_file(self):
+        # a regenerated file with the same size and mtime is only told apart by its UUID
+        mzs = np.linspace(100, 1000, 20)
+        ints = np.linspace(0, 1, 20)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imzml_path = str(Path(tmp_dir) / 'regenerated.imzML')
+            for coords in [[(1, 1, 1), (2, 1, 1)], [(2, 1, 1), (1, 1, 1)]]:
+                stat = os.stat(imzml_path) if os.path.exists(imzml_path) else None
+                with imzmlw.ImzMLWriter(imzml_path, mode='processed') as writer:
+                    for coord in coords:
+                        writer.addSpectrum(mzs, ints, coord)
+                if stat is not None:
+                    assert os.stat(imzml_path).st_size == stat.st_size
+                    os.utime(imzml_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                with imzmlp.ImzMLParser(imzml_path, index_cache=True) as parser:
+                    assert [tuple(c) for c in parser.coordinates] == coords
+
+    def test_to_datacube(self):
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            for use_mmap in [False, True]:
+                with self.subTest(parse_lib=parse_lib, data=data_name, use_mmap=use_mmap),\
+                     imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib, use_mmap=use_mmap) as parser:
+
+                    if data_name != 'Continuous':
+                        with self.assertRaises(ValueError):
+                            parser.to_datacube()
+                        continue
+                    spectra = [parser.getspectrum(i) for i in range(len(parser.coordinates))]
+                    mzs, datacube = parser.to_datacube()
+                    assert datacube.shape == (9, 8399)
+                    assert datacube.dtype == np.float32
+                    assert np.array_equal(mzs, spectra[0][0])
+                    assert np.array_equal(datacube, np.stack([ints for _, ints in spectra]))
+
+                    mz_range = (300.0, 400.0)
+                    window = (spectra[0][0] >= mz_range[0]) & (spectra[0][0] <= mz_range[1])
+                    mzs, datacube = parser.to_datacube(dtype=np.float64, mz_range=mz_range)
+                    assert datacube.dtype == np.float64
+                    assert np.array_equal(mzs, spectra[0][0][window])
+                    assert np.array_equal(datacube, np.stack([ints[window] for _, ints in spectra]))
+
+                    mzs, image = parser.to_datacube(mz_range=mz_range, layout='image')
+                    assert image.shape == (3, 3, len(mzs))
+                    for (x, y, z), (_, ints) in zip(parser.coordinates, spectra):
+                        assert np.array_equal(image[y - 1, x - 1], ints[window])
+
+                    # irregularly spaced intensity arrays are read one by one
+                    parser.intensityOffsets = parser.intensityOffsets[::-1].copy()
+                    mzs, datacube = parser.to_datacube()
+                    assert np.array_equal(datacube, np.stack([ints for _, ints in spectra[::-1]]))
+
+    @unittest.skipIf(scipy is None, 'scipy is not installed')
+    def test_to_sparse(self):
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            with self.subTest(parse_lib=parse_lib, data=data_name),\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib) as parser:
+
+                spectra = [parser.getspectrum(i) for i in range(len(parser.coordinates))]
+                edges, matrix = parser.to_sparse(bin_width=0.5)
+                assert matrix.shape == (9, len(edges) - 1)
+                assert edges[0] <= min(mzs.min() for mzs, _ in spectra) < edges[1]
+                for i, (mzs, ints) in enumerate(spectra):
+                    expected, _ = np.histogram(mzs, bins=edges, weights=ints.astype(np.float64))
+                    assert np.allclose(matrix[i].toarray().ravel(), expected, rtol=1e-4, atol=1e-5)
+                assert np.isclose(matrix.sum(), sum(ints.sum(dtype=np.float64) for _, ints in spectra), rtol=1e-4)
+
+                grid = np.linspace(300, 400, 11)
+                edges, matrix = parser.to_sparse(mz_grid=grid)
+                assert matrix.shape == (9, 10)
+                for i, (mzs, ints) in enumerate(spectra):
+                    expected, _ = np.histogram(mzs[mzs < 400], bins=grid, weights=ints[mzs < 400].astype(np.float64))
+                    assert np.allclose(matrix[i].toarray().ravel(), expected, rtol=1e-4, atol=1e-5)
+
+                edges, matrix = parser.to_sparse(ppm=100)
+                assert np.allclose(edges[1:] / edges[:-1], 1 + 1e-4)
+                assert np.isclose(matrix.sum(), sum(ints.sum(dtype=np.float64) for _, ints in spectra), rtol=1e-4)
+
+                with self.assertRaises(ValueError):
+                    parser.to_sparse(bin_width=0.5, ppm=10)
+
+        # m/z values that are not positive have no logarithmic bin
+        mzs = np.array([-1., 0., 100., 100.005, 200.])
+        for mode in ['processed', 'continuous']:
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as tmp_dir:
+                path = str(Path(tmp_dir) / 'nonpositive.imzML')
+                with imzmlw.ImzMLWriter(path, mode=mode) as writer:
+                    for i in range(3):
+                        writer.addSpectrum(mzs, np.arange(1., 6.) * (i + 1), (i + 1, 1))
+                with imzmlp.ImzMLParser(path) as parser:
+                    edges, matrix = parser.to_sparse(ppm=100)
+                    assert edges[0] <= 100 and edges[-1] > 200 and len(edges) < 10000
+                    assert np.allclose(matrix.sum(axis=1).A.ravel(), [12, 24, 36])
+
+    def test_getspectra(self):
+        indices = [4, 0, 8, 5, 4]
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            for use_mmap in [False, True]:
+                with self.subTest(parse_lib=parse_lib, data=data_name, use_mmap=use_mmap),\
+                     imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib, use_mmap=use_mmap) as parser:
+
+                    for max_gap in [0, 2**16]:
+                        spectra = parser.getspectra(indices, max_gap=max_gap)
+                        assert len(spectra) == len(indices)
+                        for index, (mzs, ints) in zip(indices, spectra):
+                            expected_mzs, expected_ints = parser.getspectrum(index)
+                            assert np.array_equal(mzs, expected_mzs)
+                            assert np.array_equal(ints, expected_ints)
+                    assert parser.getspectra([]) == []
+
+    def test_concurrent_reads(self):
+        for data_name, imzml_path, ibd_path in DATA_TEST_CASES:
+            with self.subTest(data=data_name), imzmlp.ImzMLParser(imzml_path) as parser:
+                indices = list(range(len(parser.coordinates))) * 20
+                expected = [parser.getspectrum(i) for i in indices]
+                with ThreadPoolExecutor(8) as executor:
+                    spectra = list(executor.map(parser.getspectrum, indices))
+                    batches = list(executor.map(parser.getspectra, [indices[i::7] for i in range(7)]))
+                for (mzs, ints), (expected_mzs, expected_ints) in zip(spectra, expected):
+                    assert np.array_equal(mzs, expected_mzs) and np.array_equal(ints, expected_ints)
+                for i, batch in enumerate(batches):
+                    for (mzs, ints), (expected_mzs, expected_ints) in zip(batch, expected[i::7]):
+                        assert np.array_equal(mzs, expected_mzs) and np.array_equal(ints, expected_ints)
+
+    def test_pread(self):
+        data = bytes(range(100))
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            file.seek(3)
+            for f in [file, BytesIO(data)]:
+                assert bytes(imzmlp._pread(f, 10, 5)) == data[10:15]
+                assert bytes(imzmlp._pread(f, 95, 10)) == data[95:]
+                assert bytes(imzmlp._pread(f, 200, 10)) == b''
+            # the file position is not used
+            assert file.tell() == 3
+
+    def test_wrapped_ibd_file(self):
+        # wrappers such as gzip.GzipFile have a file descriptor of the compressed file, which must not be read
+        for data_name, imzml_path, ibd_path in DATA_TEST_CASES:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                gz_path = str(Path(tmp_dir) / 'wrapped.ibd.gz')
+                with open(ibd_path, 'rb') as ibd_file, gzip.open(gz_path, 'wb') as gz_file:
+                    gz_file.write(ibd_file.read())
+                for use_mmap in [False, True]:
+                    with self.subTest(data=data_name, use_mmap=use_mmap),\
+                         imzmlp.ImzMLParser(imzml_path) as parser,\
+                         imzmlp.ImzMLParser(imzml_path, ibd_file=gzip.open(gz_path, 'rb'),
+                                            use_mmap=use_mmap) as gz_parser:
+                        indices = list(range(len(parser.coordinates)))
+                        for expected, spectrum in zip([parser.getspectrum(i) for i in indices],
+                                                      gz_parser.getspectra(indices)):
+                            assert all(np.array_equal(a, b) for a, b in zip(expected, spectrum))
+                        reader = parser.portable_spectrum_reader()
+                        with gzip.open(gz_path, 'rb') as gz_file:
+                            for expected, spectrum in zip(
+                                    [parser.getspectrum(i) for i in indices],
+                                    reader.read_spectra_from_file(gz_file, indices, use_mmap=use_mmap)):
+                                assert all(np.array_equal(a, b) for a, b in zip(expected, spectrum))
+
+    def test_map_spectra(self):
+        for data_name, imzml_path, ibd_path in DATA_TEST_CASES:
+            with self.subTest(data=data_name), imzmlp.ImzMLParser(imzml_path) as parser:
+                expected = [_spectrum_summary(*parser.getspectrum(i)) for i in range(len(parser.coordinates))]
+                assert parser.map_spectra(_spectrum_summary, processes=2) == expected
+                indices = [8, 0, 3, 3, 5]
+                results = parser.imap_spectra(_spectrum_summary, indices=indices, processes=2, chunksize=2)
+                assert list(results) == [expected[i] for i in indices]
+                assert parser.map_spectra(_spectrum_summary, indices=[], processes=2) == []
+                # without multiprocessing.shared_memory (Python < 3.8), the workers get a pickled copy of the index
+                with mock.patch.dict(sys.modules, {'multiprocessing.shared_memory': None}):
+                    assert parser.map_spectra(_spectrum_summary, processes=2) == expected
+
+        with open(PROCESSED_IBD_PATH, 'rb') as ibd_file:
+            parser = imzmlp.ImzMLParser(PROCESSED_IMZML_PATH, ibd_file=BytesIO(ibd_file.read()))
+        with self.assertRaises(ValueError):
+            parser.map_spectra(_spectrum_summary)
+
+    def test_coalesce_ranges(self):
+        offsets = [100, 0, 10, 50, 205]
+        nbytes = [10, 10, 20, 10, 5]
+        starts, ends, block_ids = imzmlp._coalesce_ranges(offsets, nbytes, max_gap=0)
+        assert list(starts) == [0, 50, 100, 205]
+        assert list(ends) == [30, 60, 110, 210]
+        assert list(block_ids) == [2, 0, 0, 1, 3]
+        starts, ends, block_ids = imzmlp._coalesce_ranges(offsets, nbytes, max_gap=20)
+        assert list(starts) == [0, 100, 205]
+        assert list(ends) == [60, 110, 210]
+        assert list(block_ids) == [1, 0, 0, 0, 2]
+
+    def test_partition(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imzml_path = str(Path(tmp_dir) / 'uneven.imzML')
+            with imzmlw.ImzMLWriter(imzml_path, mode='processed') as writer:
+                for i in range(40):
+                    n = 1000 if i < 4 else 10
+                    writer.addSpectrum(np.arange(n, dtype=np.float64), np.ones(n), (i % 8 + 1, i // 8 + 1))
+            with imzmlp.ImzMLParser(imzml_path) as parser:
+                nbytes = (np.asarray(parser.mzLengths) * 8 + np.asarray(parser.intensityLengths) * 4)
+                for by in ['bytes', 'pixels', 'spatial_tiles']:
+                    with self.subTest(by=by):
+                        parts = parser.partition(4, by=by)
+                        assert len(parts) == 4
+                        assert sorted(np.concatenate(parts)) == list(range(40))
+                        for part in parts:
+                            assert np.all(np.diff(np.asarray(parser.intensityOffsets)[part]) > 0)
+                        if by != 'bytes':
+                            assert [len(part) for part in parts] == [10] * 4
+                parts = parser.partition(4, by='bytes')
+                part_bytes = [nbytes[part].sum() for part in parts]
+                assert max(part_bytes) - min(part_bytes) <= 12000
+                assert len(parts[0]) < 10
+                # 8 x 5 pixels are split into 2 x 2 tiles
+                for part in parser.partition(4, by='spatial_tiles'):
+                    coords = np.asarray(parser.coordinates)[part]
+                    assert np.ptp(coords[:, 0]) == 3 and np.ptp(coords[:, 1]) <= 3
+                assert sum(len(part) for part in parser.partition(50, by='pixels')) == 40
+                with self.assertRaises(ValueError):
+                    parser.partition(4, by='rows')
+                with self.assertRaises(ValueError):
+                    parser.partition(0)
+
+    def test_compressed_arrays(self):
+        mzs = np.linspace(100, 1000, 50)
+        spectra = [(mzs, np.random.rand(len(mzs)).astype(np.float32)) for _ in range(6)]
+        compressions = [compression.ZlibCompression]
+        if zstandard is not None:
+            compressions += [compression.ZstdCompression, lambda: compression.ZstdCompression(shuffle=False)]
+        if lz4 is not None:
+            compressions.append(compression.Lz4Compression)
+        for mode, make_compression in [(mode, c) for mode in ['continuous', 'processed'] for c in compressions]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                imzml_path = str(Path(tmp_dir) / 'compressed.imzML')
+                written_compression = make_compression()
+                with imzmlw.ImzMLWriter(imzml_path, mode=mode, mz_compression=make_compression(),
+                                        intensity_compression=written_compression) as writer:
+                    for i, (spectrum_mzs, ints) in enumerate(spectra):
+                        writer.addSpectrum(spectrum_mzs, ints, (i % 3 + 1, i // 3 + 1, 1))
+
+                for parse_lib in PARSE_LIB_TEST_CASES:
+                    for use_mmap in [False, True]:
+                        with self.subTest(mode=mode, compression=written_compression.user_param_value,
+                                          parse_lib=parse_lib, use_mmap=use_mmap),\
+                             imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib, use_mmap=use_mmap) as parser:
+
+                            assert type(parser.intensityCompression) == type(written_compression)
+                            assert parser.intensityCompression.shuffle == written_compression.shuffle
+                            assert len(parser.intensityEncodedLengths) == len(spectra)
+                            for i, (expected_mzs, expected_ints) in enumerate(spectra):
+                                parsed_mzs, parsed_ints = parser.getspectrum(i)
+                                assert np.array_equal(parsed_mzs, expected_mzs)
+                                assert np.array_equal(parsed_ints, expected_ints)
+                                assert parser.get_spectrum_as_string(i)[1] == expected_ints.tobytes()
+                            for i, (parsed_mzs, parsed_ints) in enumerate(parser.getspectra(range(len(spectra)))):
+                                assert np.array_equal(parsed_ints, spectra[i][1])
+                            image = imzmlp.getionimage(parser, 500, mz_tol=50)
+                            window = (mzs >= 450) & (mzs <= 550)
+                            assert np.isclose(image[0, 0], spectra[0][1][window].sum())
+                            if mode == 'continuous':
+                                _, datacube = parser.to_datacube()
+                                assert np.array_equal(datacube, [ints for _, ints in spectra])
+
+                            with open(parser.filename[:-len('.imzML')] + '.ibd', 'rb') as ibd_file:
+                                reader = pickle.loads(pickle.dumps(parser.portable_spectrum_reader()))
+                                portable_mzs, portable_ints = reader.read_spectrum_from_file(ibd_file, 2)
+                                assert np.array_equal(portable_mzs, spectra[2][0])
+                                assert np.array_equal(portable_ints, spectra[2][1])
+
     def test_files_instead_of_paths(self):
         for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
             with self.subTest(parse_lib=parse_lib, data=data_name),\
@@ -143,6 +611,123 @@ class ImzMLParser(unittest.TestCase):
 
 
 
+class IonImages(unittest.TestCase):
+    def test_getionimages(self):
+        mz_values = [150.0, 300.5, 451.2, 700.0, 900.0]
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            with self.subTest(parse_lib=parse_lib, data=data_name),\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib) as parser:
+
+                ims = imzmlp.getionimages(parser, mz_values, mz_tols=0.5)
+                max_ims = imzmlp.getionimages(parser, mz_values, mz_tols=0.5, reduce='max')
+                func_ims = imzmlp.getionimages(parser, mz_values, mz_tols=0.5, reduce=np.median)
+                assert ims.shape == (len(mz_values), 3, 3)
+                for k, mz_value in enumerate(mz_values):
+                    im = imzmlp.getionimage(parser, mz_value, mz_tol=0.5)
+                    assert np.allclose(ims[k], im, rtol=1e-5)
+                    max_im = imzmlp.getionimage(parser, mz_value, mz_tol=0.5,
+                                                reduce_func=lambda ints: max(ints, default=0))
+                    assert np.allclose(max_ims[k], max_im)
+                    median_im = imzmlp.getionimage(parser, mz_value, mz_tol=0.5,
+                                                   reduce_func=lambda ints: np.median(ints) if len(ints) else 0)
+                    assert np.allclose(func_ims[k], median_im)
+                assert np.any(ims[1] > 0)
+                assert np.all(ims[4] == 0)
+
+        # a continuous spectrum whose intensity array is shorter than the shared m/z axis
+        with imzmlp.ImzMLParser(CONTINUOUS_IMZML_PATH) as parser, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            parser.intensityLengths[4] //= 2
+            ims = imzmlp.getionimages(parser, mz_values, mz_tols=0.5)
+            for k, mz_value in enumerate(mz_values):
+                assert np.allclose(ims[k], imzmlp.getionimage(parser, mz_value, mz_tol=0.5), rtol=1e-5)
+
+
+    def test_continuous_fast_path(self):
+        for parse_lib, data_name, imzml_path, ibd_path in ALL_TEST_CASES:
+            with self.subTest(parse_lib=parse_lib, data=data_name),\
+                 imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib) as parser:
+
+                assert parser.continuous == (data_name == 'Continuous')
+                expected = np.zeros((3, 3))
+                for i, (x, y, z) in enumerate(parser.coordinates):
+                    mzs, ints = parser.getspectrum(i)
+                    expected[y - 1, x - 1] = ints[(mzs >= 300.0) & (mzs <= 301.0)].sum()
+                    if parser.continuous:
+                        assert mzs is parser.getspectrum(0)[0]
+                        assert not mzs.flags.writeable
+                assert np.allclose(imzmlp.getionimage(parser, 300.5, mz_tol=0.5), expected, rtol=1e-5)
+                assert np.allclose(imzmlp.getionimages(parser, [300.5], mz_tols=0.5)[0], expected, rtol=1e-5)
+
+
+class Compression(unittest.TestCase):
+    def test_rounding(self):
+        rounded = compression.ZlibCompression(round_amt=2).rounding([1.2345, 2.3456])
+        assert np.allclose(rounded, [1.23, 2.35])
+        data = [1.2345]
+        assert compression.NoCompression().rounding(data) is data
+
+    def test_shuffle(self):
+        data = np.arange(10, dtype=np.float32)
+        shuffled = compression._shuffle(data.tobytes(), 4)
+        assert shuffled[:10] == data.view(np.uint8)[::4].tobytes()
+        assert compression._unshuffle(shuffled, 4) == data.tobytes()
+
+    def test_compression_from_string(self):
+        assert isinstance(compression.compression_from_string('zlib'), compression.ZlibCompression)
+        assert isinstance(compression.compression_from_string('None'), compression.NoCompression)
+        with self.assertRaises(ValueError):
+            compression.compression_from_string('bzip2')
+
+    def test_missing_codec(self):
+        # the codec's package is only needed once arrays are compressed or decompressed
+        with mock.patch('importlib.import_module', side_effect=ImportError):
+            for name in ['zstd', 'lz4']:
+                codec = compression.compression_from_string(name)
+                with self.assertRaises(ImportError):
+                    codec.decode(b'', np.float32)
+
+    def test_numpress_reference_bytes(self):
+        # encoded with the reference implementation of MS-Numpress
+        mzs = [100.0, 100.01, 100.025, 100.03, 250.5]
+        assert numpress.encode_linear(mzs, 1e5).hex() == '40f86a000000000080969800689a980054f1d81c246795e0'
+        assert np.allclose(numpress.decode_linear(bytes.fromhex('40f86a000000000080969800689a980054f1d81c246795e0')),
+                           mzs, atol=1e-5)
+        assert numpress.encode_pic([0., 3., 17., 255.4, 70000.]).hex() == '8736116ff3071110'
+        assert list(numpress.decode_pic(bytes.fromhex('8736116ff3071110'))) == [0, 3, 17, 255, 70000]
+        assert numpress.encode_slof([0., 1., 1000.], 1e3).hex() == '408f4000000000000000b502fd1a'
+
+    def test_numpress_round_trip(self):
+        for n in [0, 1, 2, 1000]:
+            mzs = np.sort(np.random.uniform(100, 1000, n))
+            ints = np.random.exponential(1000, n)
+            for codec in [compression.NumpressLinearCompression(), compression.NumpressLinearZlibCompression()]:
+                assert np.allclose(codec.decode(codec.encode(mzs), np.float64), mzs, rtol=0, atol=1e-6)
+            for codec in [compression.NumpressSlofCompression(), compression.NumpressSlofZlibCompression()]:
+                assert np.allclose(codec.decode(codec.encode(ints), np.float32), ints, rtol=1e-3, atol=1e-3)
+            for codec in [compression.NumpressPicCompression(), compression.NumpressPicZlibCompression()]:
+                assert np.array_equal(codec.decode(codec.encode(ints), np.float64), np.round(ints))
+
+    def test_write_numpress(self):
+        mzs = np.linspace(100, 1000, 500)
+        ints = np.random.exponential(1000, len(mzs)).astype(np.float32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imzml_path = str(Path(tmp_dir) / 'numpress.imzML')
+            with imzmlw.ImzMLWriter(imzml_path, mode='processed',
+                                    mz_compression=compression.NumpressLinearCompression(),
+                                    intensity_compression=compression.NumpressSlofZlibCompression()) as writer:
+                writer.addSpectrum(mzs, ints, (1, 1, 1))
+            for parse_lib in PARSE_LIB_TEST_CASES:
+                with self.subTest(parse_lib=parse_lib),\
+                     imzmlp.ImzMLParser(imzml_path, parse_lib=parse_lib) as parser:
+
+                    assert isinstance(parser.mzCompression, compression.NumpressLinearCompression)
+                    assert isinstance(parser.intensityCompression, compression.NumpressSlofZlibCompression)
+                    parsed_mzs, parsed_ints = parser.getspectrum(0)
+                    assert np.allclose(parsed_mzs, mzs, rtol=0, atol=1e-6)
+                    assert np.allclose(parsed_ints, ints, rtol=1e-3)
+
+
 class PortableSpectrumReader(unittest.TestCase):
     def test_read_file(self):
         spectrum_idx = 4
@@ -163,13 +748,397 @@ class PortableSpectrumReader(unittest.TestCase):
                 assert np.all(normal_ints == portable_ints)
 
 
+    def test_read_spectra_from_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            compressed_path = str(Path(tmp_dir) / 'compressed.imzML')
+            with imzmlw.ImzMLWriter(compressed_path, mode='processed', intensity_compression='zlib') as writer:
+                for i in range(10):
+                    writer.addSpectrum(np.sort(np.random.uniform(100, 1000, 20 + i)), np.random.rand(20 + i),
+                                       (i + 1, 1))
+            cases = DATA_TEST_CASES + [('Compressed', compressed_path, str(Path(compressed_path).with_suffix('.ibd')))]
+            indices = [4, 0, 8, 5, 4]
+            for data_name, imzml_path, ibd_path in cases:
+                with imzmlp.ImzMLParser(imzml_path, ibd_file=None) as parser, open(ibd_path, 'rb') as ibd_file:
+                    reader = pickle.loads(pickle.dumps(parser.portable_spectrum_reader()))
+                    for use_mmap, max_gap in [(False, 0), (False, 2**16), (True, 2**16)]:
+                        with self.subTest(data=data_name, use_mmap=use_mmap, max_gap=max_gap):
+                            spectra = reader.read_spectra_from_file(ibd_file, indices, max_gap=max_gap,
+                                                                    use_mmap=use_mmap)
+                            assert len(spectra) == len(indices)
+                            for index, (mzs, ints) in zip(indices, spectra):
+                                expected_mzs, expected_ints = reader.read_spectrum_from_file(ibd_file, index)
+                                assert np.array_equal(mzs, expected_mzs)
+                                assert np.array_equal(ints, expected_ints)
+                                if use_mmap:
+                                    assert not mzs.flags.writeable
+                    assert reader.read_spectra_from_file(ibd_file, []) == []
+                    # mapping the file neither moves the file position nor happens again on later calls
+                    ibd_file.seek(3)
+                    reader.read_spectra_from_file(ibd_file, indices, use_mmap=True)
+                    mapped = reader._mmap_cache[1]
+                    reader.read_spectra_from_file(ibd_file, indices, use_mmap=True)
+                    assert reader._mmap_cache[1] is mapped
+                    assert ibd_file.tell() == 3
+                    assert '_mmap_cache' not in pickle.loads(pickle.dumps(reader)).__dict__
+
+    def test_share_memory(self):
+        for data_name, imzml_path, ibd_path in DATA_TEST_CASES:
+            with self.subTest(data=data_name), imzmlp.ImzMLParser(imzml_path) as parser,\
+                 open(ibd_path, 'rb') as ibd_file:
+
+                reader = parser.portable_spectrum_reader()
+                with reader.share_memory() as shared_reader:
+                    assert np.array_equal(shared_reader.coordinates, parser.coordinates)
+                    assert np.array_equal(shared_reader.intensityOffsets, parser.intensityOffsets)
+                    # only the name of the shared memory block is pickled
+                    pickled = pickle.dumps(shared_reader)
+                    assert len(pickled) < len(pickle.dumps(reader))
+                    attached_reader = pickle.loads(pickled)
+                    for i in range(len(parser.coordinates)):
+                        for array, expected in zip(attached_reader.read_spectrum_from_file(ibd_file, i),
+                                                   parser.getspectrum(i)):
+                            assert np.array_equal(array, expected)
+                    # readers that attached to the block do not free it
+                    attached_reader.release_shared_memory()
+                    shm_name = shared_reader._shm.name
+                    imzmlp._attach_shared_memory(shm_name).close()
+                assert shared_reader.coordinates is None
+                with self.assertRaises(FileNotFoundError):
+                    imzmlp._attach_shared_memory(shm_name)
+
+    def test_share_memory_spawn(self):
+        # attaching must not register the block with the resource tracker, which would unlink it behind the back
+        # of its owner or complain about unknown blocks on stderr
+        script = (
+            'import multiprocessing, pickle\n'
+            'import numpy as np\n'
+            'import pyimzml.ImzMLParser as imzmlp\n'
+            'if __name__ == "__main__":\n'
+            '    multiprocessing.set_start_method("spawn")\n'
+            '    with imzmlp.ImzMLParser(%r) as parser:\n'
+            '        with parser.portable_spectrum_reader().share_memory() as reader:\n'
+            '            pickle.loads(pickle.dumps(reader)).release_shared_memory()\n'
+            '        print(len(parser.map_spectra(np.dot, processes=2)))\n' % PROCESSED_IMZML_PATH)
+        result = subprocess.run([sys.executable, '-c', script], cwd=str(Path(__file__).parent.parent),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=120)
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.strip() == '9'
+        assert result.stderr == ''
+
+    def test_partition(self):
+        for data_name, imzml_path, ibd_path in DATA_TEST_CASES:
+            with self.subTest(data=data_name), imzmlp.ImzMLParser(imzml_path) as parser:
+                reader = pickle.loads(pickle.dumps(parser.portable_spectrum_reader()))
+                for by in ['bytes', 'pixels', 'spatial_tiles']:
+                    for part, expected in zip(reader.partition(3, by=by), parser.partition(3, by=by)):
+                        assert np.array_equal(part, expected)
+
+
 class ImzMLWriter(unittest.TestCase):
     def test_simple_write(self):
         mzs = np.linspace(100,1000,20)
         ints = np.random.rand(mzs.shape[0])
         coords = [1,1,1]
-        with imzmlw.ImzMLWriter("test.mzML", mode="processed") as imzml:
-            imzml.addSpectrum(mzs, ints, coords=coords)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with imzmlw.ImzMLWriter(str(Path(tmp_dir) / "test.mzML"), mode="processed") as imzml:
+                imzml.addSpectrum(mzs, ints, coords=coords)
+
+    def test_streamed_spectra(self):
+        mobility_info = ('mean inverse reduced ion mobility array', 'MS:1003006',
+                         'volt-second per square centimeter', 'MS:1002814')
+        coords = [(x, y, 1) for y in range(1, 6) for x in range(1, 9)]
+        spectra = [(np.sort(np.random.uniform(100, 1000, 10 + i)), np.random.rand(10 + i), np.random.rand(10 + i))
+                   for i in range(len(coords))]
+        for include_mobility in [False, True]:
+            with self.subTest(include_mobility=include_mobility), tempfile.TemporaryDirectory() as tmp_dir:
+                imzml_path = str(Path(tmp_dir) / 'streamed.imzML')
+                with imzmlw.ImzMLWriter(imzml_path, mode='processed', include_mobility=include_mobility,
+                                        mobility_info=mobility_info) as writer:
+                    for (mzs, ints, mobs), coord in zip(spectra, coords):
+                        writer.addSpectrum(mzs, ints, coord, mobilities=mobs if include_mobility else None)
+                    assert writer.spectrum_count == len(coords)
+                # only the .imzML and .ibd files are left behind
+                assert sorted(p.name for p in Path(tmp_dir).iterdir()) == ['streamed.ibd', 'streamed.imzML']
+
+                with imzmlp.ImzMLParser(imzml_path, include_mobility=include_mobility) as parser:
+                    assert parser.imzmldict['max count of pixels x'] == 8
+                    assert parser.imzmldict['max count of pixels y'] == 5
+                    assert [tuple(c) for c in parser.coordinates] == coords
+                    for i, (mzs, ints, mobs) in enumerate(spectra):
+                        spectrum = parser.getspectrum(i)
+                        assert np.allclose(spectrum[0], mzs)
+                        assert np.allclose(spectrum[1], ints, rtol=1e-6)
+                        if include_mobility:
+                            assert np.allclose(spectrum[2], mobs)
+
+    def test_spectrum_records(self):
+        records = imzmlw._SpectrumRecords(imzmlw._spectrum_record_dtype(np.float64, np.float32, np.float64), capacity=2)
+        n_fields = len(records.data.dtype.names)
+        records.append((1, 2, 0, 2) + (0,) * 9 + (0.5,) * 9 + (np.nan, 1, np.nan, np.nan, np.nan))
+        records.append((3, 4, 5, 3) + (0,) * 9 + (0.5,) * 9 + (1.5, 2, 300., 1., 2.), {'filter_string': 'FTMS'})
+        records.append((6, 7, 0, 2) + (0,) * (n_fields - 4))
+        assert len(records) == 3 and len(records.data) == 4
+
+        spectra = records.to_dicts()
+        assert [s['coords'] for s in spectra] == [(1, 2), (3, 4, 5), (6, 7)]
+        assert spectra[0]['scan_start_time'] is None and 'precursor_mz' not in spectra[0]
+        assert spectra[0]['userParams'] == [] and 'filter_string' not in spectra[0]
+        assert spectra[1]['scan_start_time'] == 1.5 and spectra[1]['precursor_mz'] == 300.
+        assert spectra[1]['filter_string'] == 'FTMS'
+        assert spectra[1]['mass_window'] == (0.5, 0.5)
+        records.clear()
+        assert len(records) == 0 and records.to_dicts() == []
+
+    def test_flushed_batches(self):
+        n_spectra = 2 * imzmlw.XML_FLUSH_SIZE + 5
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imzml_path = str(Path(tmp_dir) / 'batches.imzML')
+            with imzmlw.ImzMLWriter(imzml_path, mode='continuous') as writer:
+                for i in range(n_spectra):
+                    precursor_mz = 2. if i == n_spectra - 1 else None
+                    writer.addSpectrum(np.arange(1., 4.), np.full(3, i), (i % 100 + 1, i // 100 + 1),
+                                       scan_start_time=i / 100, precursor_mz=precursor_mz)
+                    assert len(writer.records) < imzmlw.XML_FLUSH_SIZE
+            with imzmlp.ImzMLParser(imzml_path) as parser:
+                assert len(parser.coordinates) == n_spectra
+                assert parser.imzmldict['max count of pixels x'] == 100
+                assert parser.imzmldict['max count of pixels y'] == n_spectra // 100 + 1
+                assert np.all(parser.getspectrum(n_spectra - 1)[1] == n_spectra - 1)
+            imzml = Path(imzml_path).read_text()
+            assert imzml.count('name="ms level" value="2"') == 1
+            assert 'name="scan start time" value="%s"' % ((n_spectra - 1) / 100) in imzml
+
+    def test_add_spectra(self):
+        n_spectra = 30
+        lengths = np.random.randint(1, 20, n_spectra)
+        ragged_mzs = [np.sort(np.random.uniform(100, 1000, n)) for n in lengths]
+        mzs_2d = np.sort(np.random.uniform(100, 1000, (n_spectra, 10)), axis=1)
+        shared_mzs = mzs_2d[0]
+        coords = np.stack([np.arange(n_spectra) % 6 + 1, np.arange(n_spectra) // 6 + 1], axis=1)
+        scan_start_times = np.arange(n_spectra) / 10
+        cases = [
+            ('continuous', shared_mzs, [shared_mzs] * n_spectra, np.random.rand(n_spectra, 10)),
+            ('processed', mzs_2d, list(mzs_2d), np.random.rand(n_spectra, 10)),
+            ('processed', ragged_mzs, ragged_mzs, [np.random.rand(n) for n in lengths]),
+            ('auto', [shared_mzs] * 20 + list(mzs_2d[20:]), [shared_mzs] * 20 + list(mzs_2d[20:]),
+             np.random.rand(n_spectra, 10)),
+        ]
+        for mode, mzs, mz_list, intensities in cases:
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as tmp_dir:
+                paths = [str(Path(tmp_dir) / 'single.imzML'), str(Path(tmp_dir) / 'bulk.imzML')]
+                with imzmlw.ImzMLWriter(paths[0], mode=mode) as writer:
+                    for i in range(n_spectra):
+                        writer.addSpectrum(mz_list[i], intensities[i], tuple(coords[i]),
+                                           scan_start_time=scan_start_times[i])
+                with imzmlw.ImzMLWriter(paths[1], mode=mode) as writer:
+                    for batch in [slice(0, 10), slice(10, None), slice(0, 0)]:
+                        batch_mzs = mzs if mzs is shared_mzs else mzs[batch]
+                        writer.addSpectra(batch_mzs, intensities[batch], coords[batch],
+                                          scan_start_times=scan_start_times[batch])
+
+                # the spectra are identical except for their offsets in the .ibd file
+                file_specific = (r'name="(external offset|ibd SHA-1|universally unique identifier)" value="[^"]*"'
+                                 r'|<run [^>]*>')
+                xmls = [re.sub(file_specific, '', Path(path).read_text()) for path in paths]
+                assert xmls[0] == xmls[1]
+                with imzmlp.ImzMLParser(paths[0]) as single, imzmlp.ImzMLParser(paths[1]) as bulk:
+                    for i in range(n_spectra):
+                        assert np.array_equal(single.getspectrum(i)[0], bulk.getspectrum(i)[0])
+                        assert np.array_equal(single.getspectrum(i)[1], bulk.getspectrum(i)[1])
+
+    def test_segment_argmax(self):
+        # base peaks of addSpectra must match np.argmax in addSpectrum, also for intensities with NaNs
+        for values, lengths in [([1., np.nan, 2., 5., 3.], [3, 2]), ([1., 2., 5., np.nan], [2, 2]),
+                                ([np.nan, np.nan, 4., 4.], [2, 2]), ([3, 1, 2, 7], [1, 3])]:
+            values = np.array(values)
+            expected = [start + np.argmax(segment) for start, segment
+                        in zip(np.cumsum(lengths) - lengths, np.split(values, np.cumsum(lengths)[:-1]))]
+            assert list(imzmlw._segment_argmax(values, np.array(lengths))) == expected
+
+    def test_add_spectra_errors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with imzmlw.ImzMLWriter(str(Path(tmp_dir) / 'errors.imzML'), mode='processed') as writer:
+                with self.assertRaises(ValueError):
+                    writer.addSpectra(np.arange(3.), np.ones((2, 3)), [1, 2])
+                with self.assertRaises(ValueError):
+                    writer.addSpectra(np.arange(3.), np.ones((2, 3)), [(1, 1)])
+                with self.assertRaises(ValueError):
+                    writer.addSpectra(np.arange(4.), np.ones((2, 3)), [(1, 1), (2, 1)])
+                with self.assertRaises(ValueError):
+                    writer.addSpectra([np.arange(3.), np.arange(2.)], [np.ones(3), np.ones(3)], [(1, 1), (2, 1)])
+                with self.assertRaises(ValueError):
+                    writer.addSpectra([np.arange(3.), []], [np.ones(3), []], [(1, 1), (2, 1)])
+
+    def test_add_spectra_integer_tic(self):
+        intensities = np.full((2, 3), 2 ** 31 - 1, dtype=np.int32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imzml_path = Path(tmp_dir) / 'int.imzML'
+            with imzmlw.ImzMLWriter(str(imzml_path), mode='processed', intensity_dtype=np.int32) as writer:
+                writer.addSpectrum(np.arange(3.), intensities[0], (1, 1))
+                writer.addSpectra(np.arange(3.), intensities, [(2, 1), (3, 1)])
+            tics = re.findall(r'name="total ion current" value="([^"]*)"', imzml_path.read_text())
+            assert tics == [str(3 * (2 ** 31 - 1))] * 3
+
+    def test_add_spectra_float_tic(self):
+        # intensities over a wide dynamic range are not summed exactly, so both paths must sum in the same order
+        intensities = (10 ** np.random.uniform(-3, 8, (50, 1000))).astype(np.float32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            imzml_paths = [Path(tmp_dir) / 'single.imzML', Path(tmp_dir) / 'bulk.imzML']
+            with imzmlw.ImzMLWriter(str(imzml_paths[0]), mode='processed') as writer:
+                for i, ints in enumerate(intensities):
+                    writer.addSpectrum(np.arange(1000.), ints, (i + 1, 1))
+            with imzmlw.ImzMLWriter(str(imzml_paths[1]), mode='processed') as writer:
+                writer.addSpectra(np.arange(1000.), intensities, [(i + 1, 1) for i in range(50)])
+            single_tics, bulk_tics = [re.findall(r'name="total ion current" value="([^"]*)"', path.read_text())
+                                      for path in imzml_paths]
+            assert len(single_tics) == 50 and single_tics == bulk_tics
+
+    def test_auto_mode_deduplication(self):
+        mz_axes = [np.linspace(100, 1000, 100) + i for i in range(12)]
+        intensities = np.random.rand(100)
+        for n_axes, expected_mode in [(1, 'continuous'), (12, 'processed')]:
+            with self.subTest(n_axes=n_axes), tempfile.TemporaryDirectory() as tmp_dir:
+                path = str(Path(tmp_dir) / 'auto.imzML')
+                with imzmlw.ImzMLWriter(path, mode='auto', mz_dtype=np.float32) as writer:
+                    for i in range(48):
+                        # a copy in another dtype is the same array once stored as float32
+                        mzs = mz_axes[i % n_axes].astype(np.float32) if i % 2 else list(mz_axes[i % n_axes])
+                        writer.addSpectrum(mzs, intensities, (i + 1, 1))
+                    assert len(writer.mz_digests) == n_axes
+                    stats = writer.mz_cache_stats()
+                    assert (stats.hits, stats.misses, stats.evictions) == (48 - n_axes, n_axes, 0)
+                    assert (stats.bytes_written, stats.bytes_saved) == (n_axes * 400, (48 - n_axes) * 400)
+                ibd_size = Path(path).with_suffix('.ibd').stat().st_size
+                assert ibd_size == 16 + n_axes * 100 * 4 + 48 * 100 * 4
+                with imzmlp.ImzMLParser(path) as parser:
+                    assert parser.metadata.file_description.param_by_name[expected_mode]
+                    for i in range(48):
+                        assert np.allclose(parser.getspectrum(i)[0], mz_axes[i % n_axes])
+
+        # every spectrum of a batch that shares one mz array counts in the statistics
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with imzmlw.ImzMLWriter(str(Path(tmp_dir) / 'bulk.imzML'), mode='auto') as writer:
+                writer.addSpectra(mz_axes[0], np.ones((5, 100)), [(i + 1, 1) for i in range(5)])
+                writer.addSpectra(mz_axes[0], np.ones((3, 100)), [(i + 1, 2) for i in range(3)])
+                assert writer.mz_cache_stats() == imzmlw.MzCacheStats(1, 7, 1, 0, 800, 7 * 800, 0)
+
+    def test_mz_cache_size(self):
+        mz_axes = [np.linspace(100, 1000, 10) + i for i in range(3)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = str(Path(tmp_dir) / 'cache.imzML')
+            # every entry is charged by the memory of its digest and location
+            entry_size = imzmlw._mz_cache_entry_size(bytes(16), (16, 10, 80))
+            assert 200 < entry_size < 400
+            writer = imzmlw.ImzMLWriter(path, mode='auto', mz_cache_size=2 * entry_size)
+            for i in range(6):
+                writer.addSpectrum(mz_axes[[0, 1, 0, 2, 1, 0][i]], np.ones(10), (i + 1, 1))
+            # axis 1 was evicted when axis 2 was added, axis 0 when axis 1 was written again
+            assert writer.mz_cache_stats() == imzmlw.MzCacheStats(2, 1, 5, 3, 5 * 80, 80, 2)
+            with self.assertWarns(UserWarning):
+                writer.close()
+            with imzmlp.ImzMLParser(path) as parser:
+                for i in range(6):
+                    assert np.array_equal(parser.getspectrum(i)[0], mz_axes[[0, 1, 0, 2, 1, 0][i]])
+
+    def test_mz_cache_evictions_without_rewrites(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = imzmlw.ImzMLWriter(str(Path(tmp_dir) / 'unique.imzML'), mode='auto',
+                                        mz_cache_size=2 * imzmlw._mz_cache_entry_size(bytes(16), (16, 3, 24)))
+            for i in range(5000):
+                writer.addSpectrum(np.arange(3.) + i, np.ones(3), (i % 100 + 1, i // 100 + 1))
+            # only as many evicted digests as the cache holds are kept, so the rewrite of the long forgotten
+            # array 0 is not counted
+            assert len(writer.mz_evicted) == 2
+            writer.addSpectrum(np.arange(3.) + 4997, np.ones(3), (1, 51))
+            writer.addSpectrum(np.arange(3.), np.ones(3), (2, 51))
+            assert len(writer.mz_evicted) == 2
+            stats = writer.mz_cache_stats()
+            assert (stats.hits, stats.evictions, stats.rewrites) == (0, 5000, 1)
+            with self.assertWarns(UserWarning):
+                writer.close()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = imzmlw.ImzMLWriter(str(Path(tmp_dir) / 'unique.imzML'), mode='auto',
+                                        mz_cache_size=2 * imzmlw._mz_cache_entry_size(bytes(16), (16, 3, 24)))
+            for i in range(10):
+                writer.addSpectrum(np.arange(3.) + i, np.ones(3), (i + 1, 1))
+            assert writer.mz_cache_stats().evictions == 8
+            with warnings.catch_warnings():
+                warnings.simplefilter('error')
+                writer.close()
+
+    def test_async_write(self):
+        mz_axes = [np.sort(np.random.uniform(100, 1000, 50)) for _ in range(3)]
+        spectra = [(mz_axes[i % 3], np.random.rand(50), (i % 10 + 1, i // 10 + 1)) for i in range(100)]
+        for mode in ['auto', 'processed']:
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as tmp_dir:
+                paths = [str(Path(tmp_dir) / 'sync.imzML'), str(Path(tmp_dir) / 'async.imzML')]
+                for path, async_write in zip(paths, [False, True]):
+                    with imzmlw.ImzMLWriter(path, mode=mode, intensity_compression='zlib',
+                                            async_write=async_write, write_queue_size=1) as writer:
+                        for mzs, intensities, coords in spectra:
+                            writer.addSpectrum(mzs, intensities, coords)
+                # the files only differ in the uuid written at the start of the .ibd file and its checksum
+                ibds = [Path(path).with_suffix('.ibd').read_bytes() for path in paths]
+                assert ibds[0][16:] == ibds[1][16:]
+                with imzmlp.ImzMLParser(paths[1]) as parser:
+                    sha1 = parser.metadata.file_description['ibd SHA-1']
+                    assert sha1 == hashlib.sha1(ibds[1]).hexdigest().upper()
+                    for i, (mzs, intensities, coords) in enumerate(spectra):
+                        assert np.array_equal(parser.getspectrum(i)[0], mzs)
+
+    def test_compression_threads(self):
+        mz_axes = [np.sort(np.random.uniform(100, 1000, 200)) for _ in range(3)]
+        spectra = [(mz_axes[i % 3], np.random.rand(200), (i % 10 + 1, i // 10 + 1)) for i in range(60)]
+        for mode in ['auto', 'processed', 'continuous']:
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as tmp_dir:
+                ibds = []
+                for compression_threads in [None, 3]:
+                    path = str(Path(tmp_dir) / ('threads_%s.imzML' % compression_threads))
+                    intensities = np.empty(200)
+                    with imzmlw.ImzMLWriter(path, mode=mode, mz_compression='zlib', intensity_compression='zlib',
+                                            compression_threads=compression_threads) as writer:
+                        for mzs, spectrum_intensities, coords in spectra:
+                            # reusing the input array must not change spectra that are still being compressed
+                            intensities[:] = spectrum_intensities
+                            writer.addSpectrum(mzs, intensities, coords)
+                    ibds.append(Path(path).with_suffix('.ibd').read_bytes()[16:])
+                    with imzmlp.ImzMLParser(path) as parser:
+                        for i, (mzs, spectrum_intensities, coords) in enumerate(spectra):
+                            assert tuple(parser.coordinates[i][:2]) == coords
+                            assert np.allclose(parser.getspectrum(i)[1], spectrum_intensities)
+                assert ibds[0] == ibds[1]
+
+    def test_auto_mode_compression_threads(self):
+        mz_axes = [np.linspace(100, 1000, 100) + i for i in range(4)]
+        order = [0, 1, 0, 2, 3, 1]
+        released = threading.Event()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = str(Path(tmp_dir) / 'auto.imzML')
+            with imzmlw.ImzMLWriter(path, mode='auto', mz_compression=_BlockingZlibCompression(released),
+                                    compression_threads=2) as writer:
+                for i, axis in enumerate(order):
+                    writer.addSpectrum(mz_axes[axis], np.full(100, i), (i + 1, 1))
+                # new mz arrays are compressed by the pool instead of blocking addSpectrum
+                assert len(writer.pending) == len(order)
+                released.set()
+                stats = writer.mz_cache_stats()
+                assert (stats.hits, stats.misses) == (2, 4)
+                assert stats.bytes_saved == sum(len(_BlockingZlibCompression(released).encode(mz_axes[axis]))
+                                                for axis in [0, 1])
+            assert not writer.pending
+            with imzmlp.ImzMLParser(path) as parser:
+                assert len(set(parser.mzOffsets)) == 4
+                for i, axis in enumerate(order):
+                    mzs, intensities = parser.getspectrum(i)
+                    assert np.array_equal(mzs, mz_axes[axis]) and np.all(intensities == i)
+
+    def test_background_writer_error(self):
+        with tempfile.TemporaryFile() as file:
+            writer = imzmlw._BackgroundWriter(file, hashlib.sha1())
+            file.close()
+            writer.write(b'abc')
+            with self.assertRaises(ValueError):
+                writer.close()
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file